@@ -3,17 +3,31 @@
 from flask import Flask
 from flask import request
 from flask import send_file
+from flask import Response
 import os
+import re
+import mimetypes
 import json
 import shutil
 import subprocess
+import threading
 import time
 import logging
 import logging.handlers
 import argparse
+import heapq
 import fileencrypt
-import tempfile
 import sys
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 logger = logging.getLogger( "git-http" )
 
@@ -28,10 +42,236 @@ def check_output( command ):
     except Exception as ex:
         return "%s" % ex
 
+class GitError( Exception ):
+    pass
+
+def run_git( command ):
+    """
+    run the git command
+
+    Returns:
+        the output of the command
+
+    Raises:
+        GitError if the command fails
+    """
+    try:
+        return subprocess.check_output( command, stderr = subprocess.STDOUT )
+    except subprocess.CalledProcessError as e:
+        raise GitError( "%s exits with %d: %s" % ( " ".join( command[0:2] ), e.returncode, e.output.strip() ) )
+    except OSError as ex:
+        raise GitError( "fail to run %s: %s" % ( " ".join( command[0:2] ), ex ) )
+
+class GitReader:
+    """
+    read the refs and objects of the git repository without forking a git process for every read
+
+    - the refs are parsed from the loose ref files and .git/packed-refs, they are cached until the
+      modification time of any ref directory or packed-refs is changed
+    - the objects are read from a long-lived "git cat-file --batch" process
+    """
+    def __init__( self, directory ):
+        self.git_dir = os.path.join( directory, ".git" )
+        self._lock = threading.Lock()
+        self._cat_file = None
+        self._refs = {}
+        self._refs_signature = None
+        self._log_head = None
+        self._log = None
+
+    def get_head( self ):
+        """
+        Returns:
+            the current branch name or None if the HEAD is detached
+        """
+        with open( os.path.join( self.git_dir, "HEAD" ) ) as fp:
+            head = fp.read().strip()
+        return head[len( "ref: refs/heads/" ):] if head.startswith( "ref: refs/heads/" ) else None
+
+    def get_head_commit( self ):
+        """
+        Returns:
+            the commit id of HEAD or None if no commit is made
+        """
+        with open( os.path.join( self.git_dir, "HEAD" ) ) as fp:
+            head = fp.read().strip()
+        if head.startswith( "ref: " ):
+            return self.get_refs().get( head[len( "ref: " ):] )
+        return head
+
+    def get_branches( self ):
+        return sorted( [ ref[len( "refs/heads/" ):] for ref in self.get_refs() if ref.startswith( "refs/heads/" ) ] )
+
+    def get_tags( self ):
+        return sorted( [ ref[len( "refs/tags/" ):] for ref in self.get_refs() if ref.startswith( "refs/tags/" ) ] )
+
+    def get_refs( self ):
+        """
+        get all the branches and tags
+
+        Returns:
+            a dict: ref name => object id
+        """
+        signature = self._get_refs_signature()
+        with self._lock:
+            if signature != self._refs_signature:
+                self._refs = self._read_refs()
+                self._refs_signature = signature
+            return self._refs
+
+    def read_object( self, name ):
+        """
+        read a object from the repository
+
+        Args:
+            name - the object name accepted by git, like "<commit-id>" or "<label>:<filename>"
+
+        Returns:
+            a tuple (type, content) or None if the object does not exist
+        """
+        if "\n" in name or "\r" in name:
+            # the cat-file process reads one object name per line
+            logger.error( "invalid object name %r" % name )
+            return None
+        with self._lock:
+            try:
+                return self._read_object( name )
+            except Exception as ex:
+                logger.error( "fail to read object %s with error %s" % ( name, ex ) )
+                self._close_cat_file()
+                return None
+
+    def log( self ):
+        """
+        Returns:
+            the same output as command "git log"
+        """
+        head = self.get_head_commit()
+        if head is None:
+            return ""
+        with self._lock:
+            if head == self._log_head:
+                return self._log
+        log = self._format_log( head )
+        with self._lock:
+            self._log_head, self._log = head, log
+        return log
+
+    def _get_refs_signature( self ):
+        # a ref is updated by renaming a lock file, so the modification time of its directory is changed
+        packed_refs = os.path.join( self.git_dir, "packed-refs" )
+        signature = [ os.path.getmtime( packed_refs ) if os.path.exists( packed_refs ) else 0 ]
+        for name in ( "refs/heads", "refs/tags" ):
+            for dirpath, dirnames, filenames in os.walk( os.path.join( self.git_dir, name ) ):
+                signature.append( ( dirpath, os.path.getmtime( dirpath ) ) )
+        return signature
+
+    def _read_refs( self ):
+        refs = {}
+        packed_refs = os.path.join( self.git_dir, "packed-refs" )
+        if os.path.exists( packed_refs ):
+            with open( packed_refs ) as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len( fields ) == 2 and not line.startswith( "#" ) and not line.startswith( "^" ):
+                        refs[fields[1]] = fields[0]
+        for name in ( "refs/heads", "refs/tags" ):
+            for dirpath, dirnames, filenames in os.walk( os.path.join( self.git_dir, name ) ):
+                for filename in filenames:
+                    path = os.path.join( dirpath, filename )
+                    with open( path ) as fp:
+                        refs[os.path.relpath( path, self.git_dir ).replace( os.sep, "/" )] = fp.read().strip()
+        return refs
+
+    def _read_object( self, name ):
+        if self._cat_file is None or self._cat_file.poll() is not None:
+            self._cat_file = subprocess.Popen( [ "git", "cat-file", "--batch" ], cwd = self.git_dir,
+                                               stdin = subprocess.PIPE, stdout = subprocess.PIPE )
+        self._cat_file.stdin.write( ( "%s\n" % name ).encode( "utf-8" ) )
+        self._cat_file.stdin.flush()
+        header = self._cat_file.stdout.readline().decode( "utf-8" ).rstrip( "\n" )
+        if header in ( "%s missing" % name, "%s ambiguous" % name ):
+            return None
+        fields = header.split()
+        if len( fields ) != 3 or not re.match( "^[0-9a-f]{40}([0-9a-f]{24})?$", fields[0] ) or not fields[2].isdigit() \
+                or ( re.match( "^[0-9a-f]{40}$", name ) and fields[0] != name ):
+            raise IOError( "unexpected header %r of object %s from git cat-file" % ( header, name ) )
+        content = self._cat_file.stdout.read( int( fields[2] ) + 1 )
+        if content[-1:] != b"\n":
+            raise IOError( "unexpected content of object %s from git cat-file" % name )
+        return fields[1], content[:-1]
+
+    def _close_cat_file( self ):
+        if self._cat_file is not None:
+            self._cat_file.kill()
+            self._cat_file.wait()
+            self._cat_file = None
+
+    def _format_log( self, head ):
+        """
+        walk the commits from head in reverse chronological order of their committer date
+        """
+        result = []
+        visited = set( [ head ] )
+        commit = self._read_commit( head )
+        heap = [] if commit is None else [ ( -commit[2], 0, head, commit ) ]
+        n = 1
+        while heap:
+            _, _, commit_id, ( parents, author, commit_time, message ) = heapq.heappop( heap )
+            for parent in parents:
+                if parent not in visited:
+                    visited.add( parent )
+                    parent_commit = self._read_commit( parent )
+                    if parent_commit is not None:
+                        heapq.heappush( heap, ( -parent_commit[2], n, parent, parent_commit ) )
+                        n += 1
+            name, timestamp, timezone = author.rsplit( " ", 2 )
+            lines = [ "commit %s" % commit_id ]
+            if len( parents ) > 1:
+                lines.append( "Merge: %s" % " ".join( [ parent[0:7] for parent in parents ] ) )
+            lines.append( "Author: %s" % name )
+            lines.append( "Date:   %s" % self._format_date( int( timestamp ), timezone ) )
+            lines.append( "" )
+            lines.extend( [ "    %s" % line for line in message.rstrip( "\n" ).split( "\n" ) ] )
+            result.append( "\n".join( lines ) + "\n" )
+        return "\n".join( result )
+
+    def _read_commit( self, commit_id ):
+        """
+        read the commit object
+
+        Returns:
+            a tuple ( parents, author, committer time, message ) or None if the object is not a commit
+        """
+        obj = self.read_object( commit_id )
+        if obj is None or obj[0] != "commit":
+            return None
+        content = obj[1].decode( "utf-8", "replace" )
+        header, message = content.split( "\n\n", 1 ) if "\n\n" in content else ( content, "" )
+        parents = []
+        # the commit created by some tools may miss the author or the committer
+        author = "unknown 0 +0000"
+        commit_time = 0
+        for line in header.split( "\n" ):
+            if line.startswith( "parent " ):
+                parents.append( line[len( "parent " ):] )
+            elif line.startswith( "author " ):
+                author = line[len( "author " ):]
+            elif line.startswith( "committer " ):
+                commit_time = int( line.rsplit( " ", 2 )[1] )
+        return parents, author, commit_time, message
+
+    def _format_date( self, timestamp, timezone ):
+        offset = ( int( timezone[1:3] ) * 3600 + int( timezone[3:5] ) * 60 ) * ( -1 if timezone[0] == "-" else 1 )
+        t = time.gmtime( timestamp + offset )
+        return "%s %d %s %s" % ( time.strftime( "%a %b", t ), t.tm_mday, time.strftime( "%H:%M:%S %Y", t ), timezone )
+
+
 class Git:
     def __init__( self, enable_git, directory ):
         self.enable_git = enable_git
         self.directory = directory
+        self.reader = GitReader( directory )
         if self.enable_git:
             # init repository if it is not initialized
             if not os.path.exists( os.path.join( self.directory, ".git" ) ):
@@ -91,8 +331,7 @@ class Git:
         return check_output( ['git', 'rm', filename ] )
 
     def log( self ):
-        self.fix_index_corrupt()
-        return check_output( ["git", "log" ] )
+        return self.reader.log()
 
     def status( self ):
         self.fix_index_corrupt()
@@ -123,21 +362,67 @@ class Git:
         logger.info( "commit the files with message:%s" % msg )
         return check_output( ['git', 'commit', '-m', msg ] )
 
+    def commit_files( self, filenames, msg = None ):
+        """
+        add the added, modified or removed files and commit them in one commit. A file which
+        can not be staged is skipped, so it does not fail the other files
+
+        Returns:
+            the id of the commit, it is the current HEAD if no file is changed
+
+        Raises:
+            GitError if fail to commit the files
+        """
+        self.fix_index_corrupt()
+        if msg is None:
+            msg = "update on %s" % ( time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime() ) )
+
+        logger.info( "commit %d files with message:%s" % ( len( filenames ), msg ) )
+        existing_files = [ filename for filename in filenames if os.path.lexists( filename ) ]
+        removed_files = [ filename for filename in filenames if not os.path.lexists( filename ) ]
+        if removed_files:
+            try:
+                run_git( ['git', 'rm', '-r', '--cached', '--ignore-unmatch', '-q', '--' ] + removed_files )
+            except GitError as ex:
+                logger.error( "fail to remove %d files with error %s, remove them one by one" % ( len( removed_files ), ex ) )
+                for filename in removed_files:
+                    self._unstage_file( filename )
+        if existing_files:
+            try:
+                run_git( ['git', 'add', '--all', '--' ] + existing_files )
+            except GitError as ex:
+                # a file may be removed after checked, stage the files one by one
+                logger.error( "fail to add %d files with error %s, add them one by one" % ( len( existing_files ), ex ) )
+                for filename in existing_files:
+                    try:
+                        run_git( ['git', 'add', '--all', '--', filename ] )
+                    except GitError as ex:
+                        logger.error( "fail to add file %s with error %s" % ( filename, ex ) )
+                        self._unstage_file( filename )
+        # "git diff --quiet" exits with 1 if there are differences
+        status = subprocess.call( ['git', 'diff', '--cached', '--quiet' ] )
+        if status not in ( 0, 1 ):
+            raise GitError( "git diff exits with %d" % status )
+        if status == 1:
+            run_git( ['git', 'commit', '-m', msg ] )
+        return run_git( ['git', 'rev-parse', 'HEAD'] ).strip()
+
+    def _unstage_file( self, filename ):
+        """
+        remove the file or directory from the index, it is skipped if fail to remove it
+        """
+        try:
+            run_git( ['git', 'rm', '-r', '--cached', '--ignore-unmatch', '-q', '--', filename ] )
+        except GitError as ex:
+            logger.error( "fail to remove file %s from index with error %s" % ( filename, ex ) )
+
     def has_uncommited_files( self ):
         self.fix_index_corrupt()
         out = check_output( ['git', "diff", "--cached"] ).strip()
         return len( out ) > 0
 
     def get_branches( self ):
-        self.fix_index_corrupt()
-        branches = []
-        for line in check_output( ['git', 'branch', '--no-color']).split("\n"):
-            fields = line.split()
-            if len( fields ) == 1:
-                branches.append( fields[0] )
-            elif len( fields ) == 2 and fields[0] == '*':
-                branches.append( fields[1] )
-        return branches
+        return self.reader.get_branches()
 
     def exist_branch( self, branch_name ):
         """
@@ -147,15 +432,15 @@ class Git:
         """
         return branch_name in self.get_branches()
 
-    def list_branch( slef ):
+    def list_branch( self ):
         """
         list all the branches
 
         Returns:
-            all branches in the git repository in json
+            the same output as command "git branch"
         """
-        self.fix_index_corrupt()
-        return check_output( ["git", "branch" ] )
+        head = self.reader.get_head()
+        return "".join( [ "%s %s\n" % ( "*" if branch == head else " ", branch ) for branch in self.get_branches() ] )
 
     def checkout( self, branch, parent = None ):
         self.fix_index_corrupt()
@@ -186,8 +471,17 @@ class Git:
         """
         list all the tags
         """
-        self.fix_index_corrupt()
-        return check_output( ['git', 'tag'] )
+        return "".join( [ "%s\n" % tag for tag in self.reader.get_tags() ] )
+
+    def show( self, label, filename ):
+        """
+        get the content of file in the commit, branch or tag
+
+        Returns:
+            the file content or None if the file does not exist
+        """
+        obj = self.reader.read_object( "%s:%s" % ( label, filename ) )
+        return obj[1] if obj is not None and obj[0] == "blob" else None
 
     def in_repository( self, filename ):
         """
@@ -199,10 +493,124 @@ class Git:
     def git_filename( self, filename ):
         return filename[len( self.directory )+ 1: ] if filename.startswith( self.directory ) else None
 
+class DirectoryListCache:
+    """
+    cache the entries of the directories, the cached entries of a directory are used until
+    the modification time of the directory is changed
+    """
+    def __init__( self, max_dirs = 1000 ):
+        self.max_dirs = max_dirs
+        self._lock = threading.Lock()
+        # path => ( mtime, entries )
+        self._dirs = OrderedDict()
+
+    def list( self, path ):
+        """
+        list the directory
+
+        Returns:
+            the sorted list of tuple ( name, is_dir, is_symlink )
+        """
+        mtime = os.stat( path ).st_mtime
+        with self._lock:
+            if path in self._dirs and self._dirs[path][0] == mtime:
+                self._dirs[path] = self._dirs.pop( path )
+                return self._dirs[path][1]
+        entries = sorted( self._read_entries( path ) )
+        with self._lock:
+            self._dirs.pop( path, None )
+            self._dirs[path] = ( mtime, entries )
+            while len( self._dirs ) > self.max_dirs:
+                self._dirs.popitem( last = False )
+        return entries
+
+    def _read_entries( self, path ):
+        if scandir is not None:
+            return [ ( entry.name, entry.is_dir(), entry.is_symlink() ) for entry in scandir( path ) ]
+        entries = []
+        for name in os.listdir( path ):
+            filename = os.path.join( path, name )
+            entries.append( ( name, os.path.isdir( filename ), os.path.islink( filename ) ) )
+        return entries
+
+
+class CommitBatch:
+    """
+    the files committed together in one commit
+    """
+    def __init__( self ):
+        self.files = []
+        self.commit_id = None
+        self.done = threading.Event()
+
+    def wait( self ):
+        """
+        wait until the files are committed
+
+        Returns:
+            the id of the commit or None if fail to commit the files
+        """
+        self.done.wait()
+        return self.commit_id
+
+class CommitScheduler:
+    """
+    commit the files in batch. The staged files are committed together when the batch has
+    batch_size files or the interval is elapsed since the first file of the batch is staged
+    """
+    def __init__( self, git, interval = 0.5, batch_size = 100 ):
+        self.git = git
+        self.interval = interval
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._batch = None
+        self._deadline = 0
+        # the full batches waiting for commit
+        self._full_batches = []
+        th = threading.Thread( target = self._run )
+        th.daemon = True
+        th.start()
+
+    def stage( self, filename ):
+        """
+        stage a added, modified or removed file for next commit
+
+        Returns:
+            the CommitBatch which the file will be committed in
+        """
+        with self._cond:
+            if self._batch is None:
+                self._batch = CommitBatch()
+                self._deadline = time.time() + self.interval
+                self._cond.notify()
+            batch = self._batch
+            if filename not in batch.files:
+                batch.files.append( filename )
+            if len( batch.files ) >= self.batch_size:
+                self._full_batches.append( batch )
+                self._batch = None
+                self._cond.notify()
+            return batch
+
+    def _run( self ):
+        while True:
+            with self._cond:
+                while not self._full_batches and ( self._batch is None or time.time() < self._deadline ):
+                    self._cond.wait( None if self._batch is None else self._deadline - time.time() )
+                if self._full_batches:
+                    batch = self._full_batches.pop( 0 )
+                else:
+                    batch, self._batch = self._batch, None
+            try:
+                batch.commit_id = self.git.commit_files( batch.files )
+            except Exception as ex:
+                logger.error( "fail to commit %d files with error %s" % ( len( batch.files ), ex ) )
+            finally:
+                batch.done.set()
 
 
 class GitHttp:
-    def __init__( self, directory, enable_git, encryptor = None ):
+    def __init__( self, directory, enable_git, encryptor = None, commit_interval = 0.5, commit_batch_size = 100 ):
         self.directory = os.path.abspath( directory )
         if not os.path.exists( self.directory ):
             os.makedirs(self.directory)
@@ -210,11 +618,28 @@ class GitHttp:
 
         self.git = Git( enable_git, self.directory)
         self.encryptor = encryptor
+        self.list_cache = DirectoryListCache()
         self._encrypt_files()
+        self.commit_scheduler = None
         if self.git.in_git():
             self.git.commit_all_modified()
+            self.commit_scheduler = CommitScheduler( self.git, commit_interval, commit_batch_size )
 
     def list( self):
+        """
+        list the files and directories
+
+        Args:
+            Parameters from client:
+            - dir(optional), the directory to list, default is the root directory
+            - recursive(optional), list the sub-directories recursively, default is false
+            - depth(optional), the max depth of sub-directories listed recursively, default is unlimited
+            - limit(optional), the max number of entries returned, default is unlimited
+            - cursor(optional), list the entries after the cursor returned in the X-Next-Cursor header
+
+        Returns:
+            the entries in json, the X-Next-Cursor header is returned if there are more entries
+        """
         if 'dir' in request.args:
             path = os.path.abspath( "%s/%s" % (self.directory, request.args['dir']) )
             if not path.startswith( self.directory ):
@@ -226,25 +651,44 @@ class GitHttp:
         if not os.path.exists( path ):
             return "Not found", 404
 
-        #list the directory and return files with full path
-        if os.path.isdir( path ):
-            files = []
-            for f in os.listdir( path ):
-                if f == ".git":
-                    continue
-                files.append( "%s/%s" % (path, f ) )
-        else:
-            files = [ path ]
+        if not os.path.isdir( path ):
+            return json.dumps( [ {"file":path[len(self.directory):]} ] )
 
+        recursive = to_boolean( request.args['recursive'] ) if 'recursive' in request.args else False
+        depth = int( request.args['depth'] ) if recursive and 'depth' in request.args else ( None if recursive else 1 )
+        limit = int( request.args['limit'] ) if 'limit' in request.args else None
+        cursor = tuple( request.args['cursor'].split( "/" ) ) if 'cursor' in request.args else ()
 
-        # return all the files
         result = []
-        for f in files:
-            if os.path.isdir( f ):
-                result.append( {"dir":f[len(self.directory):]} )
-            else:
-                result.append( {"file":f[len(self.directory):]})
-        return json.dumps( result )
+        headers = {}
+        for parts, is_dir in self._list_dir( path, (), depth, cursor ):
+            if limit is not None and len( result ) >= limit:
+                headers["X-Next-Cursor"] = "/".join( cursor )
+                break
+            f = "%s/%s" % ( path[len(self.directory):], "/".join( parts ) )
+            result.append( {"dir":f} if is_dir else {"file":f} )
+            cursor = parts
+        return json.dumps( result ), 200, headers
+
+    def _list_dir( self, path, parts, depth, cursor ):
+        """
+        list the directory in depth-first order, the entries before or equal to cursor are skipped
+
+        Returns:
+            a generator of ( the path parts relative to the listed directory, is_dir )
+        """
+        for name, is_dir, is_symlink in self.list_cache.list( path ):
+            if name == ".git":
+                continue
+            entry_parts = parts + ( name, )
+            # the sub-directory entries may be after the cursor even if the sub-directory is not
+            if entry_parts > cursor:
+                yield entry_parts, is_dir
+            elif not is_dir or cursor[:len( entry_parts )] != entry_parts:
+                continue
+            if is_dir and not is_symlink and ( depth is None or depth > 1 ):
+                for entry in self._list_dir( os.path.join( path, name ), entry_parts, None if depth is None else depth - 1, cursor ):
+                    yield entry
 
     def status( self ):
         """
@@ -277,6 +721,8 @@ class GitHttp:
         Args:
             Parameters from client:
             - file the file name
+            - commit(optional), commit the file in a batch, default is true
+            - wait(optional), wait until the batch is committed and return the commit id, default is true
 
         """
         if 'file' not in request.args:
@@ -298,8 +744,9 @@ class GitHttp:
                 self.encryptor.encrypt_file( filename )
 
             if self.git.in_git():
+                if commit:
+                    return self._wait_commit( self.commit_scheduler.stage( self.git.git_filename( filename ) ), "save file successfully" )
                 self.git.add( self.git.git_filename( filename ) )
-                if commit: self.git.commit()
 
             return "save file successfully"
         except Exception as ex:
@@ -313,6 +760,8 @@ class GitHttp:
         Args:
             Parameters from the client:
             - file the file name
+            - commit(optional), commit the removal in a batch, default is true
+            - wait(optional), wait until the batch is committed and return the commit id, default is true
         """
         try:
             filename = os.path.abspath( "%s/%s" % (self.directory, request.args['file'] ) )
@@ -322,8 +771,13 @@ class GitHttp:
                 return "Not found", 404
             if self.git.in_repository( filename ):
                 logging.info( "try to remove file %s in git repository" % filename )
+                if commit:
+                    if os.path.isdir( filename ):
+                        shutil.rmtree( filename )
+                    else:
+                        os.remove( filename )
+                    return self._wait_commit( self.commit_scheduler.stage( self.git.git_filename( filename ) ), "remove the file successfully" )
                 self.git.remove( self.git.git_filename( filename ) )
-                if commit: self.git.commit()
                 return "remove the file successfully"
             elif os.path.isdir( filename ):
                 logging.info( "try to remove directory %s" % filename )
@@ -344,7 +798,8 @@ class GitHttp:
 
 
         if 'label' in request.args and self.git.in_git():
-            return check_output( ['git', 'show', '%s:%s' % (request.args['label'], request.args['file'] ) ] ),
+            content = self.git.show( request.args['label'], request.args['file'] )
+            return ( content, 200 ) if content is not None else ( "Not found", 404 )
 
         filename = os.path.abspath( "%s/%s" % (self.directory, request.args['file'] ))
 
@@ -356,13 +811,41 @@ class GitHttp:
 
 
         if self.encryptor is not None:
-            tmp_file = self._create_temp_file()
-            self.encryptor.decrypt_file( filename, tmp_file )
-            rv = send_file( tmp_file )
-            os.remove( tmp_file )
-        else:
-            rv = send_file( filename )
-        return rv
+            return self._send_decrypted_file( filename )
+        return send_file( filename, conditional = True )
+
+    def _wait_commit( self, batch, msg ):
+        """
+        wait for the commit of batch if the client requires
+        """
+        if 'wait' in request.args and not to_boolean( request.args['wait'] ):
+            return "%s, commit is pending" % msg
+        commit_id = batch.wait()
+        if commit_id is None:
+            return "Fail to commit file", 500
+        return "%s in commit %s" % ( msg, commit_id )
+
+    def _send_decrypted_file( self, filename ):
+        """
+        decrypt the file block by block into the response, the Range header is supported
+        """
+        size = self.encryptor.get_decrypted_size( filename )
+        if size is None:
+            return "Fail to decrypt file", 500
+
+        start, end, status = 0, size, 200
+        headers = { "Accept-Ranges": "bytes" }
+        if request.range is not None:
+            r = request.range.range_for_length( size )
+            if r is None:
+                return "Requested range not satisfiable", 416, { "Content-Range": "bytes */%d" % size }
+            start, end = r
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % ( start, end - 1, size )
+        headers["Content-Length"] = "%d" % ( end - start )
+        mimetype = mimetypes.guess_type( filename )[0] or "application/octet-stream"
+        return Response( self.encryptor.decrypt_range( filename, start, end ), status = status, headers = headers,
+                         mimetype = mimetype, direct_passthrough = True )
 
     def make_branch( self ):
         if not self.git.in_git():
@@ -468,16 +951,22 @@ class GitHttp:
         if self.encryptor is None: return
 
         files = []
-        os.path.walk( self.directory, lambda arg, dirname, names: files.extend( [ os.path.join( dirname, name) for name in names] ), None )
-        for f in files:
-            if os.path.isfile( f ) and not f.startswith( "%s/" % os.path.join( self.directory, ".git" ) ):
-                logger.info( "encrypt file %s" % f )
-                self.encryptor.encrypt_file( f )
+        for dirname, dirnames, filenames in os.walk( self.directory ):
+            if dirname == self.directory and ".git" in dirnames:
+                dirnames.remove( ".git" )
+            files.extend( [ os.path.join( dirname, name ) for name in filenames ] )
+
+        # encrypt the files concurrently, the chunks of a file are encrypted in the encryptor's thread pool
+        pool = ThreadPool( self.encryptor.workers )
+        try:
+            pool.map( self._encrypt_file, files )
+        finally:
+            pool.close()
 
-    def _create_temp_file( self ):
-        f, filename = tempfile.mkstemp()
-        os.close( f )
-        return filename
+    def _encrypt_file( self, filename ):
+        if os.path.isfile( filename ) and not self.encryptor.is_file_encrypted( filename ):
+            logger.info( "encrypt file %s" % filename )
+            self.encryptor.encrypt_file( filename )
 
 
 
@@ -489,6 +978,8 @@ def parse_args():
     parser.add_argument( "--port", help = "the port to listen", required = False, default = "5000" )
     parser.add_argument( "--aes-key", help = "16 bytes AES key", required = False )
     parser.add_argument( "--aes-file", help = "the file which contains 16 bytes AES key", required = False )
+    parser.add_argument( "--commit-interval", help = "the max seconds to wait for more files to commit together, default is 0.5", type = float, required = False, default = 0.5 )
+    parser.add_argument( "--commit-batch-size", help = "the max number of files committed together, default is 100", type = int, required = False, default = 100 )
     parser.add_argument( "--logfile", help = "the name of log file", required = False )
     parser.add_argument( "--loglevel", help = "one of following log level:CRITICAL,ERROR,WARNING,INFO,DEBUG", required = False, default = "DEBUG" )
     return parser.parse_args()
@@ -520,7 +1011,7 @@ def main():
     init_logger( args.loglevel, args.logfile )
     aes_key = get_aes_key( args )
     encryptor = fileencrypt.AESFileEncryptor( aes_key ) if aes_key is not None else None
-    git_http = GitHttp( args.dir, not args.without_git, encryptor = encryptor )
+    git_http = GitHttp( args.dir, not args.without_git, encryptor = encryptor, commit_interval = args.commit_interval, commit_batch_size = args.commit_batch_size )
 
     app = Flask(__name__)
     app.add_url_rule( "/heartbeat", "heartbeat", heartbeat, methods = ['GET'] )
@@ -6,25 +6,48 @@ import subprocess
 import sys
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 import socket
+import sqlite3
 import logging
 from logging import StreamHandler
 from logging.handlers import RotatingFileHandler
 
 logger = logging.getLogger("registry-replicator")
 
+# the size of block read from the master registry when copying a blob
+BLOB_READ_SIZE = 1024 * 1024
+
+
+def create_session(pool_size):
+    """
+    create a http session which keeps at most pool_size connections alive to a registry
+
+    :param pool_size: the max number of connections kept in the pool
+    :return: the requests.Session object
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
 class Blob:
-    def __init__(self, url, image, media_type=None, digest=None):
+    def __init__(self, url, image, media_type=None, digest=None, session=None):
         """
         :param url: the base url of docker registry
         :param image: the image name
         :param digest: the digest (tar sum) of the blob
+        :param session: the requests.Session to access the registry, a new connection is used
+            for each request if no session is provided
         """
         self.url = url
+        self.session = session or requests
         self.image = image
         self.media_type = media_type
         self.digest = digest
@@ -39,10 +62,11 @@ class Blob:
         :return: a file object if layer is downloaded successfully
             None if fail to download the layer
         """
-        r = requests.get("%s/v2/%s/blobs/%s" % (self.url, self.image, self.digest), stream=True)
-        if r.status_code / 100 == 2:
+        r = self.session.get("%s/v2/%s/blobs/%s" % (self.url, self.image, self.digest), stream=True)
+        if r.status_code // 100 == 2:
             return r.raw
         else:
+            r.close()
             return None
 
     def exist(self):
@@ -51,7 +75,7 @@ class Blob:
 
         :return: a tuple (existence, content_length), existence is true if the blob exists already
         """
-        r = requests.head("%s/v2/%s/blobs/%s" % (self.url, self.image, self.digest))
+        r = self.session.head("%s/v2/%s/blobs/%s" % (self.url, self.image, self.digest))
         return r.status_code == 200, r.headers['content-length'] if r.status_code == 200 else 0
 
     def get_upload_url(self):
@@ -61,9 +85,23 @@ class Blob:
         Returns:
             the location
         """
-        r = requests.post("%s/v2/%s/blobs/uploads/" % (self.url, self.image))
+        r = self.session.post("%s/v2/%s/blobs/uploads/" % (self.url, self.image))
         return r.headers['location'] if r.status_code == 202 else ""
 
+    def mount(self, from_image):
+        """
+        mount this blob from another repository in the same registry
+
+        :param from_image: the image which has this blob already
+        :return: a tuple (mounted, upload_url), the upload_url can be used to upload the blob if
+            the blob is not mounted
+        """
+        r = self.session.post("%s/v2/%s/blobs/uploads/" % (self.url, self.image),
+                              params={"mount": self.digest, "from": from_image})
+        if r.status_code == 201:
+            return True, ""
+        return False, r.headers['location'] if r.status_code == 202 else ""
+
     def upload(self, upload_url, data, last=False):
         """
         upload the blob data to the url
@@ -78,32 +116,78 @@ class Blob:
         headers = {"Content-Length": "%d" % len(data), "Content-Type": "application/octet-stream"}
         if last:
             digest = self.digest or "sha256:%s" % self.sha256.hexdigest()
-            r = requests.put(upload_url, data=data, headers=headers, params={'digest': digest})
+            r = self.session.put(upload_url, data=data, headers=headers, params={'digest': digest})
             return r.status_code == 201
         else:
             # print upload_url
             # print headers
-            r = requests.patch(upload_url, data=data, headers=headers)
+            r = self.session.patch(upload_url, data=data, headers=headers)
             # print "status_code = %d" % r.status_code
             # print r.headers
             # update the uploaded_length field
             self.uploaded_length = self.uploaded_length + (len(data) if r.status_code == 202 else 0)
             return r.headers['Location'] if r.status_code == 202 else ""
 
+    def upload_stream(self, upload_url, stream, chunk_size=0):
+        """
+        upload the blob data read from the stream
+
+        if chunk_size is 0, all the data is sent in one streaming PATCH request, otherwise one
+        PATCH request is sent for every chunk_size bytes. The sha256 of the data is computed while
+        uploading and the upload is cancelled if it does not match the blob digest
+
+        :param upload_url: the upload url from method get_upload_url()
+        :param stream: the file object to read the blob data
+        :param chunk_size: the size of data sent in a PATCH request, 0 for one request
+        :return: true if the blob is uploaded and verified successfully
+        """
+        sha256 = hashlib.sha256()
+        headers = {"Content-Type": "application/octet-stream"}
+
+        def read_chunk(data, size):
+            while data:
+                sha256.update(data)
+                self.uploaded_length += len(data)
+                yield data
+                size -= len(data)
+                if size <= 0:
+                    break
+                data = stream.read(min(BLOB_READ_SIZE, size))
+
+        chunk_size = chunk_size or sys.maxsize
+        data = stream.read(min(BLOB_READ_SIZE, chunk_size))
+        while data:
+            r = self.session.patch(upload_url, data=read_chunk(data, chunk_size), headers=headers)
+            if r.status_code != 202:
+                logger.error("fail to upload blob {} with status {}".format(self.digest, r.status_code))
+                return False
+            upload_url = r.headers['Location']
+            data = stream.read(min(BLOB_READ_SIZE, chunk_size))
+
+        digest = "sha256:%s" % sha256.hexdigest()
+        if self.digest and self.digest != digest:
+            logger.error("the digest {} of uploaded data does not match blob {}".format(digest, self.digest))
+            self.session.delete(upload_url)
+            return False
+        r = self.session.put(upload_url, params={'digest': self.digest or digest}, headers={"Content-Length": "0"})
+        return r.status_code == 201
+
 
 class Manifest21:
-    def __init__(self, url, image, tag, content):
+    def __init__(self, url, image, tag, content, session=None):
         """
         construct a Manifest21 object
 
         :param url: the registry url
         :param image: the image name
         :param content: the manifest in json format
+        :param session: the requests.Session used by the blobs in the manifest
         """
         self.url = url
         self.image = image
         self.tag = tag
         self.content = content
+        self.session = session
 
     def get_blobs(self):
         """
@@ -116,7 +200,7 @@ class Manifest21:
             fsLayers = self.content['fsLayers']
             for layer in fsLayers:
                 if "blobSum" in layer:
-                    result.append(Blob(self.url, self.image, layer["blobSum"]))
+                    result.append(Blob(self.url, self.image, digest=layer["blobSum"], session=self.session))
         return result
 
 
@@ -125,22 +209,24 @@ class ManifestList:
     ManifestList defined in the
     """
 
-    def __init__(self, url, image, tag, content):
+    def __init__(self, url, image, tag, content, session=None):
         self.url = url
         self.image = image
         self.tag = tag
         self.content = content
+        self.session = session
 
     def get_manifests(self):
         return self.content['manifests']
 
 
 class Manifest22:
-    def __init__(self, url, image, tag, content):
+    def __init__(self, url, image, tag, content, session=None):
         self.url = url
         self.image = image
         self.tag = tag
         self.content = content
+        self.session = session
 
     def get_layers(self):
         """
@@ -159,16 +245,29 @@ class Manifest22:
         result = [Blob(self.url,
                        self.image,
                        media_type=self.content['config']['mediaType'],
-                       digest=self.content['config']['digest'])]
+                       digest=self.content['config']['digest'],
+                       session=self.session)]
         for layer in self.content['layers']:
-            blob = Blob(self.url, self.image, media_type=layer['mediaType'], digest=layer['digest'])
+            blob = Blob(self.url, self.image, media_type=layer['mediaType'], digest=layer['digest'],
+                        session=self.session)
             result.append(blob)
         return result
 
 
+MANIFEST_ACCEPT = 'application/vnd.docker.distribution.manifest.list.v2+json,' \
+                  'application/vnd.docker.distribution.manifest.v1+prettyjws,' \
+                  'application/json,' \
+                  'application/vnd.docker.distribution.manifest.v2+json'
+
+
 class DockerRegistryClient:
-    def __init__(self, url):
+    def __init__(self, url, pool_size=10):
+        """
+        :param url: the base url of docker registry
+        :param pool_size: the max number of connections kept alive to the registry
+        """
         self.url = url
+        self.session = create_session(pool_size)
 
     def list_repositories(self):
         """
@@ -176,8 +275,8 @@ class DockerRegistryClient:
 
         :return the image name list
         """
-        r = requests.get("%s/v2/_catalog" % self.url)
-        if r.status_code / 100 == 2:
+        r = self.session.get("%s/v2/_catalog" % self.url)
+        if r.status_code // 100 == 2:
             result = r.json()
             return result['repositories'] if result else []
         return []
@@ -190,8 +289,8 @@ class DockerRegistryClient:
 
         :return: tags in frozenset
         """
-        r = requests.get("%s/v2/%s/tags/list" % (self.url, image_name))
-        if r.status_code / 100 == 2:
+        r = self.session.get("%s/v2/%s/tags/list" % (self.url, image_name))
+        if r.status_code // 100 == 2:
             result = r.json()
             return frozenset(result['tags'])
         return frozenset([])
@@ -204,7 +303,7 @@ class DockerRegistryClient:
         :param image_name: the image name
         :param digest: the image digest
         """
-        return Blob(self.url, image_name, digest=digest, media_type=media_type)
+        return Blob(self.url, image_name, digest=digest, media_type=media_type, session=self.session)
 
     def get_manifest(self, image_name, tag):
         """
@@ -221,24 +320,38 @@ class DockerRegistryClient:
         """
         headers = {
             # 'Authorization': 'Bearer %s' % (token),
-            'Accept': 'application/vnd.docker.distribution.manifest.list.v2+json,application/vnd.docker.distribution.manifest.v1+prettyjws,application/json,application/vnd.docker.distribution.manifest.v2+json'
+            'Accept': MANIFEST_ACCEPT
         }
 
-        r = requests.get("%s/v2/%s/manifests/%s" % (self.url, image_name, tag), headers=headers)
+        r = self.session.get("%s/v2/%s/manifests/%s" % (self.url, image_name, tag), headers=headers)
         result = r.json()
         # only support manifest version 2 format
         if "schemaVersion" not in result:
             return None
         if result["schemaVersion"] == 1:
-            return Manifest21(self.url, image_name, tag, result)
+            return Manifest21(self.url, image_name, tag, result, self.session)
         elif result["schemaVersion"] == 2:
             if "manifests" in result:
-                return ManifestList(self.url, image_name, tag, result)
+                return ManifestList(self.url, image_name, tag, result, self.session)
             else:
-                return Manifest22(self.url, image_name, tag, result)
+                return Manifest22(self.url, image_name, tag, result, self.session)
         # other version: not support
         return None
 
+    def get_manifest_digest(self, image_name, tag):
+        """
+        get the digest of the image manifest without downloading it
+
+        :param image_name: the image name
+        :param tag: the image tag
+        :return: the Docker-Content-Digest of the manifest or None if it is not available
+        """
+        r = self.session.head("%s/v2/%s/manifests/%s" % (self.url, image_name, tag),
+                              headers={'Accept': MANIFEST_ACCEPT})
+        if r.status_code == 200:
+            return r.headers.get('Docker-Content-Digest')
+        return None
+
     def put_manifest(self, image, tag, manifest):
         """
         put the manifest to registry
@@ -251,8 +364,8 @@ class DockerRegistryClient:
             headers = {"Content-Type": "application/vnd.docker.distribution.manifest.v1+prettyjws"}
         else:
             headers = {"Content-Type": "application/vnd.docker.distribution.manifest.v2+json"}
-        r = requests.put("%s/v2/%s/manifests/%s" % (self.url, image, tag), headers=headers, json=manifest)
-        return r.status_code / 100 == 2
+        r = self.session.put("%s/v2/%s/manifests/%s" % (self.url, image, tag), headers=headers, json=manifest)
+        return r.status_code // 100 == 2
 
     def put_manifest_list(self, image, tag, manifest_list):
         """
@@ -263,8 +376,8 @@ class DockerRegistryClient:
         :return: True if put the manifest to registry successfully
         """
         headers = {"Content-Type": "application/vnd.docker.distribution.manifest.list.v2+json"}
-        r = requests.put("%s/v2/%s/manifests/%s" % (self.url, image, tag), headers=headers, json=manifest_list)
-        return r.status_code / 100 == 2
+        r = self.session.put("%s/v2/%s/manifests/%s" % (self.url, image, tag), headers=headers, json=manifest_list)
+        return r.status_code // 100 == 2
 
     def download_blob(self, image_name, blob_digest):
         """
@@ -273,9 +386,10 @@ class DockerRegistryClient:
         :param blob_digest: the blob digest
         :return: the blob data or None
         """
-        r = requests.get("%s/v2/%s/blobs/%s" % (self.url, image_name, blob_digest), stream=True)
-        if r.status_code / 100 == 2:
+        r = self.session.get("%s/v2/%s/blobs/%s" % (self.url, image_name, blob_digest), stream=True)
+        if r.status_code // 100 == 2:
             return r.raw
+        r.close()
         return None
 
 
@@ -384,52 +498,173 @@ class ExcludeRegistryFinder(RegistryFinder):
         return ips - self._exclude_ips
 
 
+class ReplicationCache:
+    """
+    remember the replicated tags and the known blobs in a sqlite database
+
+    - the manifest digest of every tag replicated from master to slave, a tag is replicated
+      again only if its manifest digest in master is changed
+    - the blobs known to exist in the repositories of a registry
+    """
+
+    def __init__(self, filename=":memory:"):
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tags (master TEXT, slave TEXT, image TEXT, tag TEXT, "
+                               "digest TEXT, PRIMARY KEY (master, slave, image, tag))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (registry TEXT, digest TEXT, image TEXT, "
+                               "PRIMARY KEY (registry, digest, image))")
+
+    def get_tag_digest(self, master, slave, image, tag):
+        """
+        get the manifest digest of the tag replicated from master to slave
+        :return: the digest or None if the tag is not replicated
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM tags WHERE master=? AND slave=? AND image=? AND tag=?",
+                                     (master, slave, image, tag)).fetchone()
+            return row[0] if row else None
+
+    def set_tag_digest(self, master, slave, image, tag, digest):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)", (master, slave, image, tag, digest))
+
+    def has_blob(self, registry, digest, image):
+        """
+        :return: True if the blob is known to exist in the image of registry
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM blobs WHERE registry=? AND digest=? AND image=?",
+                                     (registry, digest, image)).fetchone()
+            return row is not None
+
+    def find_blob_image(self, registry, digest):
+        """
+        :return: an image in registry which has the blob or None if no such image is known
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT image FROM blobs WHERE registry=? AND digest=? LIMIT 1",
+                                     (registry, digest)).fetchone()
+            return row[0] if row else None
+
+    def add_blob(self, registry, digest, image):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)", (registry, digest, image))
+
+    def remove_blobs(self, registry, digests, image):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM blobs WHERE registry=? AND digest=? AND image=?",
+                                   [(registry, digest, image) for digest in digests])
+
+
 class DockerRegistryReplicator:
-    def __init__(self, master_registry, local_registry):
+    def __init__(self, master_registry, local_registry, image_workers=4, blob_workers=8, cache=None,
+                 upload_chunk_size=0):
         """
         create a replicator with master & slave registry client object
 
+        the images are replicated concurrently by image_workers threads and the blobs of all the images
+        are copied by blob_workers threads. A blob shared by several images is copied only once
+
         :param master_registry: the master DockerRegistryClient object
         :param local_registry: the local DockerRegistryClient oject
+        :param image_workers: the number of threads to replicate images
+        :param blob_workers: the number of threads to copy blobs
+        :param cache: the ReplicationCache shared by the replication passes
+        :param upload_chunk_size: the size of data uploaded in a request, 0 to upload a blob in one request
         """
         self._master_registry = master_registry
         self._local_registry = local_registry
+        self._image_workers = image_workers
+        self._blob_workers = blob_workers
+        self._cache = cache or ReplicationCache()
+        self._upload_chunk_size = upload_chunk_size
+        self._blob_executor = None
+        self._lock = threading.Lock()
+        # the in-flight or finished blob copy, digest => Future
+        self._blob_tasks = {}
 
     def replicate(self):
         """
         replicate all the images from master to slave
         """
+        start = time.time()
         master_repositories = self._master_registry.list_repositories()
-        slave_repositories = self._local_registry.list_repositories()
-        for image in master_repositories:
-            master_tags = self._master_registry.list_tags(image)
-            if image not in slave_repositories:
-                slave_tags = frozenset([])
-            else:
+        with ThreadPoolExecutor(self._image_workers) as image_executor, \
+                ThreadPoolExecutor(self._blob_workers) as blob_executor:
+            self._blob_executor = blob_executor
+            try:
+                images = list(image_executor.map(self._get_changed_tags, master_repositories))
+                futures = [image_executor.submit(self.replicate_image, image, tag, digest)
+                           for image, tags in images for tag, digest in tags]
+                results = [future.result() for future in futures]
+            finally:
+                self._blob_executor = None
+                with self._lock:
+                    self._blob_tasks.clear()
+        if len(results) > 0:
+            logger.info("{} of {} images are replicated in {:.1f} seconds".format(len([r for r in results if r]),
+                                                                                 len(results),
+                                                                                 time.time() - start))
+
+    def _get_changed_tags(self, image):
+        """
+        get the tags of image which should be replicated
+
+        a tag is replicated if its manifest digest in master is different from the replicated one. If
+        the tag was not replicated by this replicator, it is replicated only if it is not in slave
+        :return: a tuple (image, a list of (tag, manifest digest in master))
+        """
+        master = self._master_registry.url
+        slave = self._local_registry.url
+        slave_tags = None
+        changed_tags = []
+        for tag in self._master_registry.list_tags(image):
+            digest = self._master_registry.get_manifest_digest(image, tag)
+            replicated_digest = self._cache.get_tag_digest(master, slave, image, tag)
+            if replicated_digest is not None:
+                if replicated_digest != digest:
+                    changed_tags.append((tag, digest))
+                continue
+            if slave_tags is None:
                 slave_tags = self._local_registry.list_tags(image)
-            for tag in master_tags.difference(slave_tags):
-                self.replicate_image(image, tag)
+            if tag not in slave_tags:
+                changed_tags.append((tag, digest))
+            elif digest is not None:
+                self._cache.set_tag_digest(master, slave, image, tag, digest)
+        return image, changed_tags
 
-    def replicate_image(self, image, tag):
+    def replicate_image(self, image, tag, digest=None):
         """
         replicate a image from master to slave
 
         :param image: the name of image should be replicated
         :param tag: the image tag
+        :param digest: the manifest digest of the image in master, it is remembered after the image is replicated
         :return True if succeed to replicate the image, False if fail to replicate the image
         """
         logger.info("start to replicate image {}:{}".format(image, tag))
-        manifest = self._master_registry.get_manifest(image, tag)
-        if isinstance(manifest, Manifest21):
-            return self.replicate_manifest21(manifest)
-        elif isinstance(manifest, Manifest22):
-            return self.replicate_manifest22(manifest)
-        elif isinstance(manifest, ManifestList):
-            for item in manifest.get_manifests():
-                self.replicate_manifest21(self._master_registry.get_manifest(image, item['digest']))
-
-            # put the ManifestList content to the slave
-            return self._local_registry.put_manifest_list(image, tag, manifest)
+        try:
+            result = False
+            manifest = self._master_registry.get_manifest(image, tag)
+            if isinstance(manifest, Manifest21):
+                result = self.replicate_manifest21(manifest)
+            elif isinstance(manifest, Manifest22):
+                result = self.replicate_manifest22(manifest)
+            elif isinstance(manifest, ManifestList):
+                for item in manifest.get_manifests():
+                    self.replicate_manifest21(self._master_registry.get_manifest(image, item['digest']))
+
+                # put the ManifestList content to the slave
+                result = self._local_registry.put_manifest_list(image, tag, manifest.content)
+            if result and digest is not None:
+                self._cache.set_tag_digest(self._master_registry.url, self._local_registry.url, image, tag, digest)
+            return result
+        except Exception as ex:
+            logger.error("fail to replicate image {}:{} with error:{}".format(image, tag, ex))
+        return False
 
     def replicate_manifest21(self, manifest):
         """
@@ -437,37 +672,98 @@ class DockerRegistryReplicator:
         :param manifest: the Manifest21 object
         :return: True if replicate the manifest successfully
         """
-        blobs = manifest.get_blobs()
         # replicate all blocks from the master to slave
-        for blob in blobs:
-            logger.info("start to push blob %s" % blob.digest)
-            exist, length = blob.exist()
-            if exist:
-                slave_blob = self._local_registry.create_blob(blob.image, blob.digest, blob.media_type)
-                # if the blob exists already in slave, do not replicate it
-                if slave_blob.exist()[0]:
-                    continue
-                # get the upload url
-                upload_url = slave_blob.get_upload_url()
-                logger.info("upload_url=%s" % upload_url)
-
-                # pull the data from registry
-                data_stream = blob.pull()
-                if data_stream and upload_url:
-                    while True:
-                        # read a block and push it to the slave registry
-                        data = data_stream.read(1024 * 1024)
-                        if not data:
-                            break
-                        upload_url = slave_blob.upload(upload_url, data, False)
-
-                    # indicate all the blocks are uploaded
-                    slave_blob.upload(upload_url, "", True)
-        return self._local_registry.put_manifest(manifest.image, manifest.tag, manifest.content)
+        blobs = manifest.get_blobs()
+        futures = [self._submit_blob(blob) for blob in blobs]
+        if not all([future.result() for future in futures]):
+            logger.error("fail to replicate the blobs of {}:{}".format(manifest.image, manifest.tag))
+            return False
+        if self._local_registry.put_manifest(manifest.image, manifest.tag, manifest.content):
+            return True
+        # the cached blobs may be removed from the slave, check them again in next replication
+        self._cache.remove_blobs(self._local_registry.url, [blob.digest for blob in blobs], manifest.image)
+        return False
 
     def replicate_manifest22(self, manifest):
         return self.replicate_manifest21(manifest)
 
+    def _submit_blob(self, blob):
+        """
+        submit the blob to be copied, the blob is copied only once even if it is submitted several times
+
+        :return: a Future of the copy result
+        """
+        with self._lock:
+            key = (blob.image, blob.digest)
+            if key in self._blob_tasks:
+                return self._blob_tasks[key]
+            # the same blob of another image is being copied, mount it after the copy
+            in_flight = self._blob_tasks.get(blob.digest)
+            if self._blob_executor is None:
+                future = Future()
+                future.set_result(self._replicate_blob(blob, in_flight))
+            else:
+                future = self._blob_executor.submit(self._replicate_blob, blob, in_flight)
+            self._blob_tasks[key] = future
+            if in_flight is None:
+                self._blob_tasks[blob.digest] = future
+            return future
+
+    def _replicate_blob(self, blob, in_flight=None):
+        """
+        copy a blob from master to slave
+
+        :param blob: the Blob in master
+        :param in_flight: the Future of copying the same blob to another image in slave
+        :return: True if the blob exists in slave after the copy
+        """
+        if in_flight is not None:
+            in_flight.result()
+        slave = self._local_registry.url
+        if self._cache.has_blob(slave, blob.digest, blob.image):
+            return True
+        slave_blob = self._local_registry.create_blob(blob.image, blob.digest, blob.media_type)
+        # if the blob exists already in slave, do not replicate it
+        if slave_blob.exist()[0]:
+            self._cache.add_blob(slave, blob.digest, blob.image)
+            return True
+        upload_url = ""
+        from_image = self._cache.find_blob_image(slave, blob.digest)
+        if from_image is not None:
+            mounted, upload_url = slave_blob.mount(from_image)
+            if mounted:
+                logger.info("blob {} is mounted from {} to {}".format(blob.digest, from_image, blob.image))
+                self._cache.add_blob(slave, blob.digest, blob.image)
+                return True
+        logger.info("start to push blob %s" % blob.digest)
+        if not self._copy_blob(blob, slave_blob, upload_url or slave_blob.get_upload_url()):
+            return False
+        self._cache.add_blob(slave, blob.digest, blob.image)
+        return True
+
+    def _copy_blob(self, blob, slave_blob, upload_url):
+        """
+        stream the blob data from master to slave
+        :return: True if the blob is uploaded to slave successfully
+        """
+        logger.info("upload_url=%s" % upload_url)
+
+        # pull the data from registry
+        data_stream = blob.pull()
+        if not data_stream:
+            return False
+        uploaded = False
+        try:
+            uploaded = bool(upload_url) and slave_blob.upload_stream(upload_url, data_stream, self._upload_chunk_size)
+            return uploaded
+        finally:
+            if uploaded:
+                # the data is read completely, return the connection to the pool
+                data_stream.release_conn()
+            else:
+                # the unread data is left in the connection, it can't be reused
+                data_stream.close()
+
 
 def load_config(config_file):
     """
@@ -534,6 +830,14 @@ def parse_args():
     parser.add_argument("--replicate-interval", help="the registry replicate interval, default is 30 seconds", type=int,
                         default=30)
     parser.add_argument("--http-scheme", help="the http scheme", choices=["http", "https"], default="http")
+    parser.add_argument("--image-workers", help="the number of threads to replicate images, default is 4", type=int,
+                        default=4)
+    parser.add_argument("--blob-workers", help="the number of threads to copy blobs, default is 8", type=int,
+                        default=8)
+    parser.add_argument("--upload-chunk-size", help="the bytes of blob data uploaded in a request, default is 0 to "
+                                                    "upload a blob in one streaming request", type=int, default=0)
+    parser.add_argument("--cache-file", help="the sqlite file to remember the replicated tags and blobs, "
+                                             "default is in memory", default=":memory:")
     parser.add_argument("--log-file", help="the log file name")
     parser.add_argument("--log-level", help="the log level", default="DEBUG")
     return parser.parse_args()
@@ -544,15 +848,21 @@ def main():
     init_logger(args.log_file, args.log_level)
     registry_finder = RefreshableRegistryFinder(
         ExcludeRegistryFinder(create_registry_finder(args.registry_addr), args.local_addr), 10)
-    local_url = "{}://{}:{}".format(args.scheme, args.local_addr, args.registry_port)
+    local_url = "{}://{}:{}".format(args.http_scheme, args.local_addr, args.registry_port)
+    cache = ReplicationCache(args.cache_file)
+    pool_size = args.image_workers + args.blob_workers
+    slave_registry = DockerRegistryClient(local_url, pool_size)
+    replicators = {}
     while True:
         registries = registry_finder.get_registries()
         for registry in registries:
-            registry_url = "{}://{}:{}".format(args.scheme, registry, args.registry_port)
-            master_registry = DockerRegistryClient(registry_url)
-            slave_registry = DockerRegistryClient(local_url)
-            replicator = DockerRegistryReplicator(master_registry, slave_registry)
-            replicator.replicate()
+            registry_url = "{}://{}:{}".format(args.http_scheme, registry, args.registry_port)
+            if registry_url not in replicators:
+                master_registry = DockerRegistryClient(registry_url, pool_size)
+                replicators[registry_url] = DockerRegistryReplicator(master_registry, slave_registry,
+                                                                     args.image_workers, args.blob_workers, cache,
+                                                                     args.upload_chunk_size)
+            replicators[registry_url].replicate()
         time.sleep(args.replicate_interval)
 
 
@@ -3,17 +3,41 @@
 import argparse
 import os
 import random
+import shutil
 import struct
 import tempfile
+import threading
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from Crypto.Cipher import AES
 
-__init__ = ["AESFileEncryptor"]
+__init__ = ["AESFileEncryptor", "EncryptingReader", "DecryptingReader"]
+
+# the header of chunked format: magic, size, chunk size, nonce prefix
+CHUNKED_HEADER_FORMAT = "<QI8s"
+# the GCM authentication tag appended to every chunk
+TAG_SIZE = 16
 
 class AESFileEncryptor:
-    magic = "MyAESEncrypt"
-    def __init__( self, key, blockSize = 4096 ):
-        self.key = key
+    """
+    encrypt/decrypt file with AES
+
+    The file is encrypted in chunked format: every chunk is encrypted and authenticated independently
+    with AES-GCM, the nonce of a chunk is the nonce prefix in the header plus the chunk index. So the
+    chunks can be encrypted/decrypted in parallel and a chunk can be decrypted without reading others.
+
+    The files encrypted in the old format (AES-CBC in blocks) can still be decrypted.
+    """
+    magic = b"MyAESEncrypt"
+    chunked_magic = b"MyAESChunked"
+    def __init__( self, key, blockSize = 4096, chunkSize = 1024 * 1024, workers = None ):
+        self.key = key if isinstance( key, bytes ) else key.encode( "utf-8" )
         self.blockSize = blockSize
+        self.chunkSize = chunkSize
+        self.workers = workers or cpu_count()
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     def encrypt_data( self, iv, data ):
         return self._encrypt_data( self._create_aes( iv ), data )
@@ -25,25 +49,12 @@ class AESFileEncryptor:
         if self.is_file_encrypted( filename ):
             return True
 
-        iv = self.create_init_vector()
-        aes = self._create_aes( iv )
-        tmp_filename = self._create_temp_file() if out_file is None or os.path.abspath( filename ) == os.path.abspath( out_file ) else out_file
-        size = os.path.getsize( filename )
-        with open( tmp_filename, "wb" ) as fout:
-            # write magic
-            fout.write( AESFileEncryptor.magic )
-            # write size
-            fout.write( struct.pack('<Q', size) )
-            # write iv
-            fout.write( iv )
-            # encrypt block by block
-            with open( filename ) as fin:
-                while True:
-                    data = fin.read( self.blockSize )
-                    if len(data) == 0: break
-                    data = self.encrypt_data( iv, data )
-                    fout.write( data )
+        tmp_filename = self._create_temp_file( os.path.dirname( os.path.abspath( filename ) ) ) if out_file is None or os.path.abspath( filename ) == os.path.abspath( out_file ) else out_file
+        with open( filename, "rb" ) as fin:
+            with open( tmp_filename, "wb" ) as fout:
+                shutil.copyfileobj( EncryptingReader( self, fin ), fout, self.chunkSize )
         if out_file is None or os.path.abspath( filename ) == os.path.abspath( out_file ):
+            shutil.copymode( filename, tmp_filename )
             os.rename( tmp_filename, filename )
         return True
 
@@ -57,15 +68,17 @@ class AESFileEncryptor:
         return: None or the name of decrypted file
         """
         tmp_filename = self._create_temp_file() if out_file is None else out_file
-        with open( filename ) as fin:
-            # check the magic
-            m = fin.read( len( AESFileEncryptor.magic ) )
-            if m != AESFileEncryptor.magic: return None
-            # read size
-            size = struct.unpack('<Q', fin.read(struct.calcsize('<Q')))[0]
-            # read iv
-            iv = fin.read( 16 )
-            if len( iv ) != 16: return None
+        reader = self.open_decrypted( filename )
+        if reader is not None:
+            with reader:
+                with open( tmp_filename, "wb" ) as fout:
+                    shutil.copyfileobj( reader, fout, self.chunkSize )
+            return tmp_filename
+
+        with open( filename, "rb" ) as fin:
+            header = self.read_header( fin )
+            if header is None: return None
+            size, iv = header
 
             # read and descrypt file
             with open( tmp_filename, "wb" ) as fout:
@@ -82,10 +95,137 @@ class AESFileEncryptor:
         return tmp_filename
 
 
+    def open_decrypted( self, filename ):
+        """
+        open the file encrypted in chunked format
+
+        return: a DecryptingReader or None if the file is not encrypted in chunked format
+        """
+        fin = open( filename, "rb" )
+        if fin.read( len( AESFileEncryptor.chunked_magic ) ) != AESFileEncryptor.chunked_magic:
+            fin.close()
+            return None
+        fin.seek( 0 )
+        try:
+            return DecryptingReader( self, fin )
+        except Exception:
+            # the header is broken
+            fin.close()
+            raise
+
+    def read_header( self, fin ):
+        """
+        read the header of the file encrypted in the old format
+
+        return: a tuple (size, iv) or None if the file is not encrypted
+        """
+        # check the magic
+        m = fin.read( len( AESFileEncryptor.magic ) )
+        if m != AESFileEncryptor.magic: return None
+        # read size
+        size = struct.unpack('<Q', fin.read(struct.calcsize('<Q')))[0]
+        # read iv
+        iv = fin.read( 16 )
+        if len( iv ) != 16: return None
+        return size, iv
+
+    def get_decrypted_size( self, filename ):
+        """
+        get the size of the file before encryption
+
+        return: the size or None if the file is not encrypted
+        """
+        reader = self.open_decrypted( filename )
+        if reader is not None:
+            with reader:
+                return reader.size
+        with open( filename, "rb" ) as fin:
+            header = self.read_header( fin )
+            return header[0] if header is not None else None
+
+    def decrypt_range( self, filename, start = 0, end = None ):
+        """
+        decrypt the data between start and end of the file block by block
+
+        every block is encrypted independently, so the decryption starts from the block
+        which contains the start offset
+
+        start: the offset of the first decrypted byte
+        end: the offset after the last decrypted byte, None for the end of file
+        return: a generator of the decrypted data
+        """
+        reader = self.open_decrypted( filename )
+        if reader is not None:
+            with reader:
+                end = reader.size if end is None else min( end, reader.size )
+                reader.seek( start )
+                while start < end:
+                    data = reader.read( min( self.chunkSize, end - start ) )
+                    if len( data ) == 0: break
+                    start += len( data )
+                    yield data
+            return
+
+        with open( filename, "rb" ) as fin:
+            header = self.read_header( fin )
+            if header is None: return
+            size, iv = header
+            end = size if end is None else min( end, size )
+            offset = start - start % self.blockSize
+            fin.seek( offset, os.SEEK_CUR )
+            while offset < end:
+                data = fin.read( self.blockSize )
+                if len( data ) == 0: break
+                data = self.decrypt_data( iv, data )
+                yield data[max( start - offset, 0 ): end - offset]
+                offset += len( data )
+
     def is_file_encrypted( self, filename ):
-        with open( filename ) as fp:
-            data = fp.read()
-            return True if data[0:len( AESFileEncryptor.magic )] == AESFileEncryptor.magic else False
+        with open( filename, "rb" ) as fp:
+            return fp.read( len( AESFileEncryptor.magic ) ) in ( AESFileEncryptor.magic, AESFileEncryptor.chunked_magic )
+
+    def encrypt_chunk( self, header, nonce_prefix, index, data, last ):
+        """
+        encrypt a chunk, the header and if it is the last chunk are authenticated with the chunk
+        """
+        aes = self._create_gcm( header, nonce_prefix, index, last )
+        data, tag = aes.encrypt_and_digest( data )
+        return data + tag
+
+    def decrypt_chunk( self, header, nonce_prefix, index, data, last ):
+        """
+        decrypt a chunk, ValueError is raised if the chunk is modified
+        """
+        aes = self._create_gcm( header, nonce_prefix, index, last )
+        return aes.decrypt_and_verify( data[:-TAG_SIZE], data[-TAG_SIZE:] )
+
+    def map_chunks( self, func, tasks ):
+        """
+        call func with the arguments of tasks in the thread pool
+
+        at most 2 * workers tasks are in progress, so the memory is bounded even if there are many tasks
+
+        return: a generator of the func results in the order of tasks
+        """
+        pool = self._get_pool()
+        pending = deque()
+        for task in tasks:
+            pending.append( pool.apply_async( func, task ) )
+            if len( pending ) >= self.workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _get_pool( self ):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool( self.workers )
+            return self._pool
+
+    def _create_gcm( self, header, nonce_prefix, index, last ):
+        aes = AES.new( self.key, AES.MODE_GCM, nonce = nonce_prefix + struct.pack( ">I", index ) )
+        aes.update( header + ( b"\x01" if last else b"\x00" ) )
+        return aes
 
     def _encrypt_data( self, aes, data ):
         return aes.encrypt( data ) if len( data ) % 16 == 0  else aes.encrypt( data + ' ' * ( 16 - len( data ) % 16 ) )
@@ -96,8 +236,8 @@ class AESFileEncryptor:
     def _create_aes( self, iv ):
         return AES.new(self.key, AES.MODE_CBC, iv )
 
-    def _create_temp_file( self ):
-        f, name = tempfile.mkstemp()
+    def _create_temp_file( self, dir = None ):
+        f, name = tempfile.mkstemp( dir = dir )
         os.close(f)
         return name
 
@@ -107,17 +247,129 @@ class AESFileEncryptor:
         """
         return ''.join([chr(random.randint(0, 0xFF)) for i in range(16)])
 
+class ChunkReader:
+    """
+    a file-like object to read the data produced chunk by chunk
+    """
+    def __init__( self ):
+        self._chunks = iter( [] )
+        self._buffer = b""
+
+    def read( self, size = -1 ):
+        while size < 0 or len( self._buffer ) < size:
+            chunk = next( self._chunks, None )
+            if chunk is None: break
+            self._buffer = self._buffer + chunk if self._buffer else chunk
+        if size < 0 or size >= len( self._buffer ):
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[0:size], self._buffer[size:]
+        return data
+
+    def close( self ):
+        self._fin.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+class EncryptingReader( ChunkReader ):
+    """
+    a file-like object to read the encrypted data of a plain file object in chunked format
+    """
+    def __init__( self, encryptor, fin, size = None ):
+        """
+        encryptor: the AESFileEncryptor
+        fin: the plain file object
+        size: the size of the plain data, default is the size of fin
+        """
+        ChunkReader.__init__( self )
+        self._encryptor = encryptor
+        self._fin = fin
+        self.size = os.fstat( fin.fileno() ).st_size - fin.tell() if size is None else size
+        self._nonce_prefix = os.urandom( 8 )
+        self._header = AESFileEncryptor.chunked_magic + struct.pack( CHUNKED_HEADER_FORMAT, self.size, encryptor.chunkSize, self._nonce_prefix )
+        self._buffer = self._header
+        self._chunks = encryptor.map_chunks( encryptor.encrypt_chunk, self._read_chunks() )
+
+    def _read_chunks( self ):
+        chunk_size = self._encryptor.chunkSize
+        chunks = max( ( self.size + chunk_size - 1 ) // chunk_size, 1 )
+        for index in range( chunks ):
+            data = self._fin.read( min( chunk_size, self.size - index * chunk_size ) )
+            yield self._header, self._nonce_prefix, index, data, index == chunks - 1
+
+class DecryptingReader( ChunkReader ):
+    """
+    a file-like object to read the plain data of a file object encrypted in chunked format,
+    it supports seek() and decrypts only the chunks after the position
+    """
+    def __init__( self, encryptor, fin ):
+        """
+        encryptor: the AESFileEncryptor
+        fin: the encrypted file object which supports seek()
+        """
+        ChunkReader.__init__( self )
+        self._encryptor = encryptor
+        self._fin = fin
+        if fin.read( len( AESFileEncryptor.chunked_magic ) ) != AESFileEncryptor.chunked_magic:
+            raise ValueError( "not a chunked encrypted file" )
+        header = fin.read( struct.calcsize( CHUNKED_HEADER_FORMAT ) )
+        self.size, self.chunk_size, self._nonce_prefix = struct.unpack( CHUNKED_HEADER_FORMAT, header )
+        self._header = AESFileEncryptor.chunked_magic + header
+        self.chunks = max( ( self.size + self.chunk_size - 1 ) // self.chunk_size, 1 )
+        self._pos = 0
+        self.seek( 0 )
+
+    def read_chunk( self, index ):
+        """
+        decrypt the chunk by index without reading other chunks
+        """
+        return self._encryptor.decrypt_chunk( *self._read_chunk( index ) )
+
+    def read( self, size = -1 ):
+        data = ChunkReader.read( self, size )
+        self._pos += len( data )
+        return data
+
+    def seek( self, offset, whence = os.SEEK_SET ):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max( 0, min( offset, self.size ) )
+        self._chunks = self._encryptor.map_chunks( self._encryptor.decrypt_chunk, self._read_chunks( self._pos // self.chunk_size ) )
+        self._buffer = b""
+        # skip the data before the position in the first chunk
+        ChunkReader.read( self, self._pos % self.chunk_size )
+        return self._pos
+
+    def tell( self ):
+        return self._pos
+
+    def _read_chunk( self, index ):
+        self._fin.seek( len( self._header ) + index * ( self.chunk_size + TAG_SIZE ) )
+        data = self._fin.read( min( self.chunk_size, self.size - index * self.chunk_size ) + TAG_SIZE )
+        return self._header, self._nonce_prefix, index, data, index == self.chunks - 1
+
+    def _read_chunks( self, start ):
+        for index in range( start, self.chunks ):
+            yield self._read_chunk( index )
+
 def encrypt_file( args ):
-    encryptor = AESFileEncryptor( args.key )
+    encryptor = AESFileEncryptor( args.key, workers = args.workers )
     encryptor.encrypt_file( args.file, args.out )
 
 def decrypt_file( args ):
-    encryptor = AESFileEncryptor( args.key )
+    encryptor = AESFileEncryptor( args.key, workers = args.workers )
     encryptor.decrypt_file( args.file, args.out )
 
 def parse_args():
     parser = argparse.ArgumentParser( description = "encrypt/descrypt data/file with AES algorithm" )
     parser.add_argument( "--key", help = "the 16 bytes encrypt/descrypt key", required = True )
+    parser.add_argument( "--workers", help = "the number of threads to encrypt/decrypt chunks, default is the number of cpus", type = int, required = False )
     subparsers = parser.add_subparsers( help = "sub commands")
     encrypt_parser = subparsers.add_parser( "encrypt", help = "encrypt file" )
     encrypt_parser.add_argument( "--file", help = "the encrypt file name", required = True )
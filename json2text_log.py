@@ -2,7 +2,26 @@
 import abc
 import argparse
 import json
+import multiprocessing
+import os
 import sys
+import tempfile
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
 
 """
 convert log from json format to human readable text format
@@ -12,6 +31,31 @@ the json log can be read from stdin or from a file
 The text log can be written to the file or stdout
 """
 
+_json_decoder = json.JSONDecoder()
+
+
+def _json_loads(line):
+    # decoding the utf-8 line directly skips the encoding detection of json.loads()
+    return _json_decoder.decode(line.decode("utf-8"))
+
+
+# the json decoders, the fastest installed one is used by default
+JSON_BACKENDS = {"json": _json_loads}
+if simdjson is not None:
+    JSON_BACKENDS["simdjson"] = simdjson.loads
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = orjson.loads
+DEFAULT_JSON_BACKEND = "orjson" if orjson is not None else "simdjson" if simdjson is not None else "json"
+
+# the bytes read in one batch
+BATCH_SIZE = 4 * 1024 * 1024
+
+# the bytes of input file converted by one job
+JOB_SIZE = 64 * 1024 * 1024
+
+# the min seconds between saving the checkpoints
+CHECKPOINT_INTERVAL = 1
+
 
 class JsonLogReader:
     @abc.abstractmethod
@@ -22,6 +66,21 @@ class JsonLogReader:
         """
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def read_lines(self):
+        """
+        read a batch of raw log lines
+        :return: a list of lines in bytes or None if no more line is available
+        """
+        raise NotImplementedError()
+
+    def commit(self):
+        """
+        mark the lines read so far as processed, it is called after their text logs are written
+        :return: None
+        """
+        pass
+
     @abc.abstractmethod
     def close(self):
         """
@@ -41,6 +100,23 @@ class TextLogWriter:
         """
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def write_logs(self, text_logs):
+        """
+        write a batch of text logs
+        :param text_logs: the text logs joined with the line separator, ends with the line separator
+        :return: None
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def flush(self):
+        """
+        flush the written text logs
+        :return: None
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def close(self):
         """
@@ -50,8 +126,65 @@ class TextLogWriter:
         raise NotImplementedError()
 
 
+class LineSplitter:
+    """
+    read the binary stream in large chunks and split them to lines
+    """
+
+    def __init__(self, fp, batch_size=BATCH_SIZE, offset=0, partial_at_eof=True):
+        """
+        :param fp: the binary stream
+        :param batch_size: the max bytes read at a time
+        :param offset: the offset of the stream position
+        :param partial_at_eof: return the last line without line separator at the end of stream,
+            it is kept for the data appended later if it is False
+        """
+        self._fp = fp
+        # read1() returns the available data without waiting for a full chunk from pipe
+        self._read = fp.read1 if hasattr(fp, "read1") else fp.read
+        self._batch_size = batch_size
+        self._remaining = b""
+        self._partial_at_eof = partial_at_eof
+        # the offset after the last line returned
+        self.offset = offset
+
+    def read_lines(self):
+        """
+        read the complete lines in the next chunk
+        :return: a list of lines or None if the end of stream is reached
+        """
+        while True:
+            data = self._read(self._batch_size)
+            if not data:
+                if not self._remaining or not self._partial_at_eof:
+                    return None
+                return self.take_remaining()
+            pos = data.rfind(b"\n")
+            if pos < 0:
+                self._remaining += data
+                continue
+            lines = (self._remaining + data[:pos]).split(b"\n")
+            self.offset += len(self._remaining) + pos + 1
+            self._remaining = data[pos + 1:]
+            return lines
+
+    def take_remaining(self):
+        """
+        take the last line without line separator
+        :return: a list of the line, it is empty if no such line
+        """
+        if not self._remaining:
+            return []
+        lines, self._remaining = [self._remaining], b""
+        self.offset += len(lines[0])
+        return lines
+
+
 class StdinJsonLogReader(JsonLogReader):
 
+    def __init__(self):
+        self._splitter = None
+
     def read_log(self):
         for log in sys.stdin:
             try:
@@ -60,14 +193,34 @@ class StdinJsonLogReader(JsonLogReader):
                 pass
         return None
 
+    def read_lines(self):
+        if self._splitter is None:
+            self._splitter = LineSplitter(getattr(sys.stdin, "buffer", sys.stdin))
+        return self._splitter.read_lines()
+
     def close(self):
         pass
 
 
 class FileJsonLogReader(JsonLogReader):
 
-    def __init__(self, file_name):
-        self._fp = open(file_name)
+    def __init__(self, file_name, checkpoint_file=None):
+        """
+        :param file_name: the json log file
+        :param checkpoint_file: the file to save the offset of the processed lines, the reading is
+            resumed from the offset if the log file is not changed to a new file
+        """
+        self._file_name = file_name
+        self._fp = open(file_name, "rb")
+        self._checkpoint_file = checkpoint_file
+        self._checkpoint_time = 0
+        self._checkpoint = None
+        offset = self._load_checkpoint()
+        self._fp.seek(offset)
+        self._splitter = self._create_splitter(offset)
+
+    def _create_splitter(self, offset):
+        return LineSplitter(self._fp, offset=offset)
 
     def read_log(self):
         for line in self._fp:
@@ -77,15 +230,134 @@ class FileJsonLogReader(JsonLogReader):
                 pass
         return None
 
+    def read_lines(self):
+        return self._splitter.read_lines()
+
+    def commit(self):
+        self._save_checkpoint(force=False)
+
     def close(self):
+        self._save_checkpoint(force=True)
         self._fp.close()
 
+    def _load_checkpoint(self):
+        """
+        :return: the offset in the checkpoint or 0 if the checkpoint is missing or for another file
+        """
+        if self._checkpoint_file is None or not os.path.exists(self._checkpoint_file):
+            return 0
+        with open(self._checkpoint_file) as fp:
+            checkpoint = json.load(fp)
+        st = os.fstat(self._fp.fileno())
+        if checkpoint["inode"] != st.st_ino or checkpoint["offset"] > st.st_size:
+            return 0
+        return checkpoint["offset"]
+
+    def _save_checkpoint(self, force):
+        """
+        save the offset of the lines read to the checkpoint file at most once per CHECKPOINT_INTERVAL seconds
+        :param force: save the checkpoint at once
+        """
+        if self._checkpoint_file is None:
+            return
+        now = time.time()
+        if not force and now - self._checkpoint_time < CHECKPOINT_INTERVAL:
+            return
+        self._checkpoint_time = now
+        checkpoint = {"file": self._file_name, "inode": os.fstat(self._fp.fileno()).st_ino, "offset": self._splitter.offset}
+        if checkpoint == self._checkpoint:
+            return
+        tmp_file = self._checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(checkpoint, fp)
+        os.rename(tmp_file, self._checkpoint_file)
+        self._checkpoint = checkpoint
+
+
+class FollowFileJsonLogReader(FileJsonLogReader):
+    """
+    follow the lines appended to the json log file like "tail -F"
+
+    the directory of the file is watched with inotify if inotify_simple is installed, otherwise the
+    file is checked every poll_interval seconds. The file is reopened from the beginning if it is
+    rotated or truncated.
+    """
+
+    def __init__(self, file_name, checkpoint_file=None, poll_interval=1.0):
+        FileJsonLogReader.__init__(self, file_name, checkpoint_file)
+        self._poll_interval = poll_interval
+        self._inotify = None
+        if INotify is not None:
+            self._inotify = INotify()
+            self._inotify.add_watch(os.path.dirname(os.path.abspath(file_name)),
+                                    inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.DELETE)
+
+    def _create_splitter(self, offset):
+        return LineSplitter(self._fp, offset=offset, partial_at_eof=False)
+
+    def read_log(self):
+        raise NotImplementedError("the log can only be followed in batch mode")
+
+    def read_lines(self):
+        """
+        wait for the lines appended to the file
+        :return: a list of lines, it never returns None
+        """
+        while True:
+            lines = self._splitter.read_lines()
+            if lines is not None:
+                return lines
+            if self._is_rotated():
+                # the lines may be appended to the old file after the end of file is reached and
+                # before it is rotated, read them until the end of the old file
+                lines = self._splitter.read_lines()
+                if lines is not None:
+                    return lines
+                # the last line without line separator in the old file is complete
+                lines = self._splitter.take_remaining()
+                self._fp.close()
+                self._fp = open(self._file_name, "rb")
+                self._splitter = self._create_splitter(0)
+                self._save_checkpoint(force=True)
+                if lines:
+                    return lines
+                continue
+            self._save_checkpoint(force=True)
+            self._wait()
+
+    def close(self):
+        FileJsonLogReader.close(self)
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _wait(self):
+        if self._inotify is None:
+            time.sleep(self._poll_interval)
+        else:
+            self._inotify.read(timeout=int(self._poll_interval * 1000))
+
+    def _is_rotated(self):
+        """
+        :return: True if a new file is created with the same name or the file is truncated
+        """
+        try:
+            st = os.stat(self._file_name)
+        except OSError:
+            # the file is moved and the new file is not created yet
+            return False
+        return st.st_ino != os.fstat(self._fp.fileno()).st_ino or st.st_size < self._fp.tell()
+
 
 class StdoutTextLogWriter(TextLogWriter):
 
     def write_log(self, text_log):
-        sys.stdout.write(text_log)
-        sys.stdout.write("\n")
+        sys.stdout.write(text_log + "\n")
+
+    def write_logs(self, text_logs):
+        sys.stdout.write(text_logs)
+
+    def flush(self):
+        sys.stdout.flush()
 
     def close(self):
         pass
@@ -97,57 +369,299 @@ class FileTextLogWriter(TextLogWriter):
         self._fp = open(file_name, "w")
 
     def write_log(self, text_log):
-        self._fp.write(text_log)
-        self._fp.write("\n")
+        self._fp.write(text_log + "\n")
+
+    def write_logs(self, text_logs):
+        self._fp.write(text_logs)
+
+    def flush(self):
+        self._fp.flush()
 
     def close(self):
         self._fp.close()
 
 
+def parse_where(conditions):
+    """
+    parse the filter conditions
+    :param conditions: a list of conditions in FIELD=VALUE format
+    :return: a list of ( field, value ) tuple
+    """
+    where = []
+    for condition in conditions or []:
+        pos = condition.find("=")
+        if pos <= 0:
+            raise ValueError("invalid condition %s, it should be in FIELD=VALUE format" % condition)
+        where.append((condition[0:pos], condition[pos + 1:]))
+    return where
+
+
 class Json2TextLogConverter:
-    def __init__(self, fields, delimiter, log_reader, log_writer):
+    def __init__(self, fields, delimiter, log_reader, log_writer, json_backend=DEFAULT_JSON_BACKEND, where=None):
+        """
+        :param where: a list of ( field, value ) tuple, only the logs matching all of them are converted.
+            The value matches a string field equal to it or a number/boolean/null field in the same json text
+        """
         self._fields = fields
         self._delimiter = delimiter
         self._log_reader = log_reader
         self._log_writer = log_writer
+        self._loads = JSON_BACKENDS[json_backend]
+        self._where = where or []
+        # the lines without the values can be skipped before decoding, the value is not checked
+        # if it can be escaped in the json text
+        self._needles = [value.encode("utf-8") for field, value in self._where
+                         if json.dumps(value, ensure_ascii=False)[1:-1] == value]
 
     def run(self):
         while True:
             json_log = self._log_reader.read_log()
             if json_log is None:
                 break
+            if not self._match(json_log):
+                continue
             values = []
             for field in self._fields:
                 if field in json_log:
                     values.append(json_log[field])
             self._log_writer.write_log(self._delimiter.join(values))
 
+    def run_batch(self):
+        """
+        read the lines in batch and write the converted text logs of a batch in one write
+        """
+        while True:
+            lines = self._log_reader.read_lines()
+            if lines is None:
+                break
+            self._log_writer.write_logs(self.convert_lines(lines))
+            self._log_writer.flush()
+            self._log_reader.commit()
+
+    def convert_lines(self, lines):
+        """
+        convert the json log lines to text
+        :param lines: the json log lines
+        :return: the text logs joined with line separator
+        """
+        loads = self._loads
+        fields = self._fields
+        join = self._delimiter.join
+        needles = self._needles
+        text_logs = []
+        for line in lines:
+            if needles and not all(needle in line for needle in needles):
+                continue
+            try:
+                json_log = loads(line)
+            except Exception:
+                continue
+            if not isinstance(json_log, dict) or not self._match(json_log):
+                continue
+            text_logs.append(join([json_log[field] for field in fields if field in json_log]))
+        if not text_logs:
+            return ""
+        text_logs.append("")
+        return "\n".join(text_logs)
+
+    def _match(self, json_log):
+        for field, value in self._where:
+            if field not in json_log:
+                return False
+            field_value = json_log[field]
+            if isinstance(field_value, (dict, list)):
+                return False
+            if field_value != value and json.dumps(field_value) != value:
+                return False
+        return True
+
+
+def split_file(file_name, job_size):
+    """
+    split the file to the ranges at the line boundaries
+    :param file_name: the file name
+    :param job_size: the bytes of each range
+    :return: a list of ( start, end ) tuple
+    """
+    size = os.path.getsize(file_name)
+    ranges = []
+    with open(file_name, "rb") as fp:
+        start = 0
+        while start < size:
+            fp.seek(min(start + job_size, size))
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+_job_converter = None
+
+
+def _init_job(fields, delimiter, json_backend, where):
+    global _job_converter
+    _job_converter = Json2TextLogConverter(fields, delimiter, None, None, json_backend, where)
+
+
+def _convert_range(args):
+    file_name, start, end = args
+    text_logs = []
+    with open(file_name, "rb") as fp:
+        fp.seek(start)
+        while start < end:
+            data = fp.read(min(BATCH_SIZE, end - start))
+            if not data:
+                break
+            start += len(data)
+            # the range ends at a line boundary, so only the first chunk may be split in a line
+            if start < end:
+                data += fp.readline()
+                start = fp.tell()
+            text_logs.append(_job_converter.convert_lines(data.split(b"\n")))
+    return "".join(text_logs)
+
+
+def run_jobs(fields, delimiter, file_name, log_writer, jobs, json_backend=DEFAULT_JSON_BACKEND, job_size=JOB_SIZE, where=None):
+    """
+    convert the input file with a process pool, the file is split at the line boundaries
+    and the converted text logs are written in the input order
+    :param jobs: the number of processes
+    """
+    ranges = [(file_name, start, end) for start, end in split_file(file_name, job_size)]
+    pool = multiprocessing.Pool(jobs, _init_job, (fields, delimiter, json_backend, where))
+    try:
+        for text_logs in pool.imap(_convert_range, ranges):
+            log_writer.write_logs(text_logs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def generate_log(file_name, size):
+    """
+    generate a json log file for benchmark
+    :param size: the approximate bytes of the file
+    :return: the number of lines
+    """
+    lines = []
+    for i in range(1000):
+        lines.append(json.dumps({"time": "2024-01-01T00:00:%02d.%06dZ" % (i % 60, i),
+                                 "stream": "stdout" if i % 3 else "stderr",
+                                 "level": ["INFO", "WARN", "ERROR", "DEBUG"][i % 4],
+                                 "log": "request %d processed in %d ms from 10.0.%d.%d" % (i, i % 97, i % 255, i % 7),
+                                 "thread": "worker-%d" % (i % 16)}))
+    block = ("\n".join(lines) + "\n").encode("utf-8")
+    count = 0
+    with open(file_name, "wb") as fp:
+        written = 0
+        while written < size:
+            fp.write(block)
+            written += len(block)
+            count += len(lines)
+    return count
+
+
+def run_benchmark(args):
+    """
+    compare the lines per second of the line mode, the batch mode with each json backend and the jobs
+    """
+    fields = args.fields or ["time", "level", "log"]
+    fd, file_name = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        print("generating %d bytes json log in %s" % (args.benchmark_size, file_name))
+        lines = generate_log(file_name, args.benchmark_size)
+        cases = [("line", "json", 0)]
+        cases.extend(("batch", backend, 0) for backend in sorted(JSON_BACKENDS))
+        if args.jobs > 1:
+            cases.append(("jobs=%d" % args.jobs, DEFAULT_JSON_BACKEND, args.jobs))
+        for mode, backend, jobs in cases:
+            log_writer = FileTextLogWriter(os.devnull)
+            start = time.time()
+            if jobs > 1:
+                run_jobs(fields, args.delimiter, file_name, log_writer, jobs, backend)
+            else:
+                log_reader = FileJsonLogReader(file_name)
+                converter = Json2TextLogConverter(fields, args.delimiter, log_reader, log_writer, backend)
+                if mode == "line":
+                    converter.run()
+                else:
+                    converter.run_batch()
+                log_reader.close()
+            log_writer.close()
+            elapsed = time.time() - start
+            print("%-8s %-8s %12.0f lines/s %8.1f MB/s" % (mode, backend, lines / elapsed, args.benchmark_size / elapsed / 1024 / 1024))
+    finally:
+        os.remove(file_name)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="convert log from json to text format")
-    parser.add_argument("--fields", nargs="+", help="the fields will be print in the text", required=True)
+    parser.add_argument("--fields", nargs="+", help="the fields will be print in the text")
     parser.add_argument("--delimiter", help="the delimiter used between the fields", default=" ")
     parser.add_argument("--input-file", help="the input file, read log from stdin if it is missing")
     parser.add_argument("--output-file", help="the output file, print log to stdout if it is missing")
-    return parser.parse_args()
+    parser.add_argument("--line-mode", action="store_true", help="read and convert the log line by line instead of in batch")
+    parser.add_argument("--json-backend", choices=sorted(JSON_BACKENDS), default=DEFAULT_JSON_BACKEND,
+                        help="the json decoder, default is %s" % DEFAULT_JSON_BACKEND)
+    parser.add_argument("--follow", action="store_true",
+                        help="keep reading the lines appended to the input file, the file can be rotated or truncated")
+    parser.add_argument("--checkpoint-file", help="save the offset of the converted input file to it and resume from it")
+    parser.add_argument("--where", nargs="+", metavar="FIELD=VALUE",
+                        help="only convert the logs in which all the fields have the values, for example level=ERROR")
+    parser.add_argument("--jobs", type=int, default=1, help="the number of processes to convert the input file, default is 1")
+    parser.add_argument("--benchmark", action="store_true", help="compare the conversion speed on a generated json log")
+    parser.add_argument("--benchmark-size", type=int, default=1024 * 1024 * 1024,
+                        help="the bytes of the generated json log in benchmark, default is 1G")
+    args = parser.parse_args()
+    if not args.benchmark and not args.fields:
+        parser.error("--fields is required")
+    if (args.follow or args.checkpoint_file) and args.input_file is None:
+        parser.error("--input-file is required by --follow and --checkpoint-file")
+    if (args.follow or args.checkpoint_file) and (args.line_mode or args.jobs > 1):
+        parser.error("--follow and --checkpoint-file can not be used with --line-mode and --jobs")
+    try:
+        args.where = parse_where(args.where)
+    except ValueError as ex:
+        parser.error(str(ex))
+    return args
 
 
 def main():
     args = parse_args()
-    if args.input_file is None:
-        log_reader = StdinJsonLogReader()
-    else:
-        log_reader = FileJsonLogReader(args.input_file)
+    if args.benchmark:
+        run_benchmark(args)
+        return
 
     if args.output_file is None:
         log_writer = StdoutTextLogWriter()
     else:
         log_writer = FileTextLogWriter(args.output_file)
 
-    converter = Json2TextLogConverter(args.fields, args.delimiter, log_reader, log_writer)
-    converter.run()
-    log_reader.close()
-    log_writer.close()
+    if args.jobs > 1 and args.input_file is not None:
+        run_jobs(args.fields, args.delimiter, args.input_file, log_writer, args.jobs, args.json_backend, where=args.where)
+        log_writer.close()
+        return
+
+    if args.input_file is None:
+        log_reader = StdinJsonLogReader()
+    elif args.follow:
+        log_reader = FollowFileJsonLogReader(args.input_file, args.checkpoint_file)
+    else:
+        log_reader = FileJsonLogReader(args.input_file, args.checkpoint_file)
+
+    converter = Json2TextLogConverter(args.fields, args.delimiter, log_reader, log_writer, args.json_backend, args.where)
+    try:
+        if args.line_mode:
+            converter.run()
+        else:
+            converter.run_batch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_reader.close()
+        log_writer.close()
 
 
 if __name__ == "__main__":
@@ -1,17 +1,25 @@
 #!/usr/bin/python
 
 import argparse
+import httplib
 import json
 import os
 import shutil
+import sys
 import tempfile
+import urllib
 import urllib2
+import urlparse
 
 class TextColor:
     @classmethod
     def yellow( cls, text ):
         return '\033[0;33m%s\033[0m' % text
 
+    @classmethod
+    def magenta( cls, text ):
+        return '\033[0;35m%s\033[0m' % text
+
 class LogViewer:
     def __init__( self, url ):
         self.url = url[0:-1] if url.endswith("/") else url
@@ -22,8 +30,7 @@ class LogViewer:
         print "\n".join( nodes )
 
     def list_logs( self, path ):
-        r = urllib2.urlopen( "%s/list?path=%s" % ( self.url, path ) )
-        self.display( r.read() )
+        self.display( self.fan_out( "/list?path=%s" % urllib.quote( path ) ) )
 
     def download_log_file( self, filename, dest, log_view_func = None ):
         r = urllib2.urlopen( "%s/download?path=%s" % ( self.url, filename) )
@@ -42,36 +49,88 @@ class LogViewer:
         self.download_log_file_to_temp( filename, lambda f: os.system( "vi %s" % f ) )
 
     def cat_log_file( self, filename ):
-        self.download_log_file_to_temp( filename, lambda f: os.system( "cat %s" % f ) )
+        r = urllib2.urlopen( "%s/download?path=%s" % ( self.url, urllib.quote( filename ) ) )
+        shutil.copyfileobj( r, sys.stdout )
 
     def tail_log_file( self, filename, lines ):
-        self.download_log_file_to_temp( filename, lambda f: os.system( "tail -n %d %s" % ( lines, f ) ) )
+        r = urllib2.urlopen( "%s/tail?path=%s&lines=%d" % ( self.url, urllib.quote( filename ), lines ) )
+        shutil.copyfileobj( r, sys.stdout )
+
+    def follow_log_file( self, filename, lines ):
+        """
+        print the lines appended to the file on a node or all the nodes like "tail -f"
+        """
+        # urllib2 buffers the response, read the lines from the socket once they arrive
+        url = urlparse.urlparse( self.url )
+        conn = ( httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection )( url.netloc )
+        conn.request( "GET", "%s/follow?path=%s&lines=%d" % ( url.path, urllib.quote( filename ), lines ) )
+        r = conn.getresponse()
+        if r.status != 200:
+            print r.read()
+            return
+        for line in iter( r.fp.readline, "" ):
+            record = json.loads( line )
+            if 'line' in record:
+                print ( "%s %s" % ( TextColor.yellow( record['node'] ), record['line'] ) ).encode( "utf-8" )
+            elif 'event' in record:
+                print "%s --- file is %s ---" % ( TextColor.yellow( record['node'] ), record['event'] )
+            elif 'status' in record:
+                print "%s --- %s %s ---" % ( TextColor.yellow( record['node'] ), record['status'], record.get( 'error', '' ) )
+            sys.stdout.flush()
 
     def grep_log_file( self, path, pattern, recursive = False ):
         data = json.dumps( {'path': path, 'pattern': pattern, 'recursive': recursive } )
-        r = urllib2.urlopen( "%s/grep" % self.url, data = data )
-        self.display( r.read() )
+        self.display( self.fan_out( "/grep", data ), self.display_records )
 
     def find_log_file( self, path, pattern ):
         data = json.dumps( {'path': path, 'pattern': pattern } )
-        r = urllib2.urlopen( "%s/find" % self.url, data = data )
-        self.display( r.read() )
+        self.display( self.fan_out( "/find", data ), self.display_records )
 
     def shell( self, nodes, script ):
         data = {'script': script }
         if nodes is not None and len( nodes ) > 0:
             data['nodes'] = nodes
-        r = urllib2.urlopen( "%s/shell" % self.url, data = json.dumps( data ) )
-        self.display( r.read() )
-
-    def display( self, data ):
-        try:
-            node_data = json.loads( data )
-            for name in node_data:
-                print TextColor.yellow( "From node %s" % name )
-                print node_data[ name ]
-        except Exception as ex:
-            print data
+        self.display( self.fan_out( "/shell", json.dumps( data ) ) )
+
+    def fan_out( self, path, data = None ):
+        """
+        send the request to all the nodes through the proxy
+
+        return: a generator of the node result {"node", "status", "result" or "error", "elapsed"}
+            in the order that the nodes answer
+        """
+        r = urllib2.urlopen( "%s%s%sstream=true" % ( self.url, path, "&" if "?" in path else "?" ), data = data )
+        for line in iter( r.readline, "" ):
+            yield json.loads( line )
+
+    def display( self, results, display_result = None ):
+        for result in results:
+            print TextColor.yellow( "From node %s" % result['node'] )
+            if result['status'] != 'ok':
+                print "%s: %s" % ( result['status'], result['error'] )
+            elif display_result is not None:
+                display_result( result['result'] )
+            else:
+                print result['result'].encode( "utf-8" )
+
+    def display_records( self, data ):
+        """
+        display the NDJSON records of grep/find returned from a node
+        """
+        for line in data.splitlines():
+            try:
+                record = json.loads( line )
+            except ValueError:
+                print line.encode( "utf-8" )
+                continue
+            if 'line' in record:
+                print ( "%s:%s" % ( TextColor.magenta( record['file'] ), record['line'] ) ).encode( "utf-8" )
+            elif 'path' in record:
+                print record['path'].encode( "utf-8" )
+            elif 'error' in record:
+                print ( "%s: %s" % ( record['file'], record['error'] ) ).encode( "utf-8" )
+            elif record.get( 'truncated' ):
+                print "... stopped after %d matches" % record['matches']
 
 
 def get_url( args ):
@@ -104,6 +163,12 @@ def cat_log( args ):
 def tail_log( args ):
     create_log_viewer( args.url ).tail_log_file( args.file, args.lines )
 
+def follow_log( args ):
+    try:
+        create_log_viewer( args.url ).follow_log_file( args.file, args.lines )
+    except KeyboardInterrupt:
+        pass
+
 def execute_shell( args ):
     create_log_viewer( args.url ).shell( args.nodes, args.script )
 
@@ -149,6 +214,11 @@ def parse_args():
     tail_parser.add_argument( "file", help = "the remote file name" )
     tail_parser.set_defaults( func = tail_log )
 
+    follow_parser = subparsers.add_parser( "follow", help = "show the lines appended to the file, the node name can be * for all the nodes" )
+    follow_parser.add_argument( "-n", "--lines", help = "number of last lines to show before following", type = int, default = 10 )
+    follow_parser.add_argument( "file", help = "the remote file name" )
+    follow_parser.set_defaults( func = follow_log )
+
     shell_parser = subparsers.add_parser( "shell", help = "execute shell script" )
     shell_parser.add_argument( "script", help = "the shell script" )
     shell_parser.add_argument( "--nodes", nargs = "*", help = "the nodes" )
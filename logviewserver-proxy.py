@@ -1,18 +1,35 @@
 #!/usr/bin/python
 
 import argparse
+import codecs
+import httplib
 import json
 from flask import request,Flask, Response
 import os
+import Queue
+import socket
 import threading
-import shutil
 import sys
+import tempfile
 import time
 import logging
-import urllib2
+import select
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger( __name__ )
 
+# the size of block read from the log server when streaming a file
+STREAM_BLOCK_SIZE = 64 * 1024
+# the max bytes of a node response kept in memory, the rest is spooled to a temporary file
+SPOOL_MEMORY_SIZE = 1024 * 1024
+# the seconds to wait for a line from the followed file, the log server sends heartbeat every 15 seconds
+FOLLOW_TIMEOUT = 60
+
+def to_boolean( s ):
+    return s.lower() in ( "yes", "y", "t", "true", "1" )
+
 class Path:
     def __init__( self, path ):
         self.path = self._split_path( path )
@@ -41,10 +58,17 @@ class Path:
 
 
 class LogServer:
-    def __init__( self, name, url, timeout = 60 ):
+    def __init__( self, name, url, timeout = 60, max_idle_connections = 4 ):
         self.name = name
         self.url = url[0:-1] if url.endswith('/') else url
         self.expire = time.time() + timeout
+        parsed_url = urlparse.urlparse( self.url )
+        self._connection_class = httplib.HTTPSConnection if parsed_url.scheme == "https" else httplib.HTTPConnection
+        self._host = parsed_url.netloc
+        self._base_path = parsed_url.path
+        self._max_idle_connections = max_idle_connections
+        self._idle_connections = []
+        self._lock = threading.Lock()
 
     def get_name( self ):
         return self.name
@@ -52,58 +76,325 @@ class LogServer:
     def is_expired( self ):
         return time.time() > self.expire
 
-    def list_files( self, path ):
+    def refresh( self, timeout = 60 ):
+        self.expire = time.time() + timeout
+
+    def request( self, method, path, body = None, timeout = None, idempotent = None ):
+        """
+        send a request to the log server with a kept-alive connection, the whole request including
+        reading the response body must be finished in timeout seconds
+
+        idempotent: if the request can be sent again when a kept-alive connection fails, default
+            is True for GET and HEAD. The request which is not idempotent is never sent twice
+
+        return: a NodeResponse to read the response body
+        raise: exception if fail to send the request or the server returns error
+        """
+        if idempotent is None:
+            idempotent = method in ( "GET", "HEAD" )
+        deadline = NodeDeadline( timeout )
+        while True:
+            conn, reused = self._get_connection( deadline.remaining() )
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                deadline.watch( conn )
+                conn.request( method, self._base_path + path, body, {"Content-Type": "application/json"} if body is not None else {} )
+                resp = conn.getresponse()
+            except ( httplib.HTTPException, socket.error ):
+                deadline.cancel()
+                conn.close()
+                deadline.check()
+                # the kept-alive connection may be closed by the server, retry with a new connection
+                if reused and idempotent and not isinstance( sys.exc_info()[1], socket.timeout ):
+                    continue
+                raise
+            node_resp = NodeResponse( self, conn, resp, deadline )
+            if resp.status >= 400:
+                data = node_resp.read( STREAM_BLOCK_SIZE )
+                node_resp.close()
+                raise IOError( "HTTP %d: %s" % ( resp.status, data ) )
+            return node_resp
+
+    def list_files( self, path, timeout = None ):
         """
         list all the files from remote node
         """
-        print "in LogServer.list_files, url=%s, path=%s" % ( self.url, path )
+        return self.request( "GET", "/list?path=%s" % urllib.quote( path ), timeout = timeout )
+
+    def download_file( self, path, headers = None, timeout = None ):
+        """
+        stream the file from the log server, the data is read from the log server only when
+        the client reads it
+
+        headers: the request headers forwarded to the log server, like Range
+        """
+        conn, reused = self._get_connection( timeout )
         try:
-            url =  "%s/list?path=%s" % ( self.url, path )
-            resp = urllib2.urlopen( url )
-            return resp.read()
-        except Exception as ex:
-            logger.error( "fail to list files from path %s with error %s" % ( path, ex ) )
-            print "%s" % ex
-            return "%s" % ex
-    def download_file( self, path ):
+            conn.request( "GET", "%s/download?path=%s" % ( self._base_path, urllib.quote( path ) ), headers = headers or {} )
+            resp = conn.getresponse()
+        except ( httplib.HTTPException, socket.error ) as ex:
+            conn.close()
+            if reused:
+                return self.download_file( path, headers, timeout )
+            return "%s" % ex, 502
+
+        def read_body():
+            completed = False
+            try:
+                while True:
+                    data = resp.read( STREAM_BLOCK_SIZE )
+                    if not data: break
+                    yield data
+                completed = True
+            finally:
+                # the client may disconnect before the body is read, the connection can't be reused
+                if completed and not resp.will_close:
+                    self._put_connection( conn )
+                else:
+                    conn.close()
+
+        response_headers = [ ( name, resp.getheader( name ) ) for name in ( "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Last-Modified", "ETag" ) if resp.getheader( name ) is not None ]
+        return Response( read_body(), status = resp.status, headers = response_headers, direct_passthrough = True )
+
+    def follow_file( self, path, lines, records, stopped ):
+        """
+        follow the file on the log server and put the records tagged with node name to the queue
+        until stopped is set, the heartbeat records from log server are dropped
+
+        return: the connection to the log server, it can be shutdown to stop following
+        """
+        conn = self._connection_class( self._host, timeout = FOLLOW_TIMEOUT )
+
+        def put( record ):
+            record["node"] = self.name
+            while not stopped.is_set():
+                try:
+                    records.put( record, timeout = 1 )
+                    return
+                except Queue.Full:
+                    pass
+
+        def read_records():
+            try:
+                conn.request( "GET", "%s/follow?path=%s&lines=%d" % ( self._base_path, urllib.quote( path ), lines ) )
+                resp = conn.getresponse()
+                if resp.status != 200:
+                    raise IOError( "HTTP %d: %s" % ( resp.status, resp.read() ) )
+                # the log server closes the connection at the end of the stream instead of chunked encoding
+                for line in iter( resp.fp.readline, "" ):
+                    record = json.loads( line )
+                    if "heartbeat" not in record:
+                        put( record )
+                put( {"status": "closed"} )
+            except Exception as ex:
+                if not stopped.is_set():
+                    put( {"status": "error", "error": "%s" % ex} )
+            finally:
+                conn.close()
+
+        th = threading.Thread( target = read_records )
+        th.daemon = True
+        th.start()
+        return conn
+
+    def tail_file( self, path, lines, timeout = None ):
+        return self.request( "GET", "/tail?path=%s&lines=%d" % ( urllib.quote( path ), lines ), timeout = timeout )
+
+    def grep_file( self, path, pattern, recursive = False, timeout = None ):
+        data = json.dumps( {'path':path,'pattern':pattern, 'recursive': recursive } )
+        return self.request( "POST", "/grep", data, timeout = timeout, idempotent = True )
+
+    def find_file( self, path, pattern, timeout = None ):
+        data = json.dumps( {'path':path,'pattern':pattern} )
+        return self.request( "POST", "/find", data, timeout = timeout, idempotent = True )
+
+    def shell( self, script, timeout = None ):
+        data = json.dumps( {'script': script } )
+        return self.request( "POST", "/shell", data, timeout = timeout )
+
+    def _get_connection( self, timeout ):
+        """
+        return: a tuple ( connection, reused )
+        """
+        while True:
+            with self._lock:
+                conn = self._idle_connections.pop() if self._idle_connections else None
+            if conn is None:
+                return self._connection_class( self._host, timeout = timeout ), False
+            # an idle connection is readable only if the server closed it
+            if conn.sock is None or select.select( [ conn.sock ], [], [], 0 )[0]:
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout( timeout )
+            return conn, True
+
+    def _put_connection( self, conn ):
+        with self._lock:
+            if len( self._idle_connections ) < self._max_idle_connections:
+                self._idle_connections.append( conn )
+                return
+        conn.close()
+
+class NodeDeadline:
+    """
+    the deadline of a request to a log server, the socket of the request is shutdown
+    when the deadline is reached
+    """
+    def __init__( self, timeout ):
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.expired = False
+        self._timer = None
+
+    def remaining( self ):
+        """
+        return: the seconds before the deadline or None if there is no deadline
+        """
+        self.check()
+        return None if self.deadline is None else max( self.deadline - time.time(), 0.001 )
+
+    def check( self ):
+        """
+        raise: socket.timeout if the deadline is reached
+        """
+        if self.expired or ( self.deadline is not None and time.time() >= self.deadline ):
+            raise socket.timeout( "no response in %s seconds" % self.timeout )
+
+    def watch( self, conn ):
+        """
+        shutdown the socket of the connection at the deadline
+        """
+        self.cancel()
+        if self.deadline is None: return
+        self._timer = threading.Timer( self.remaining(), self._expire, ( conn, ) )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel( self ):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire( self, conn ):
+        self.expired = True
         try:
-            url = "%s/download?path=%s" % (self.url, path )
-            resp = urllib2.urlopen( url )
-            response = Response()
-            shutil.copyfileobj( resp, response.stream )
-            return response
-        except Exception as ex:
-            return "%s" % ex
-    def grep_file( self, path, pattern, recursive = False ):
+            if conn.sock is not None:
+                conn.sock.shutdown( socket.SHUT_RDWR )
+        except socket.error:
+            pass
+
+class NodeResponse:
+    """
+    the response of a log server, the body is read in blocks before the deadline. The connection
+    is kept alive if the body is read completely, otherwise it is closed
+    """
+    def __init__( self, server, conn, resp, deadline ):
+        self.status = resp.status
+        self._server = server
+        self._conn = conn
+        self._resp = resp
+        self._deadline = deadline
+
+    def read( self, size ):
+        """
+        return: at most size bytes of the body, empty string at the end of the body
+        raise: socket.timeout if the deadline is reached
+        """
+        if self._conn is None: return ""
         try:
-            url = "%s/grep" % self.url
-            data = json.dumps( {'path':path,'pattern':pattern, 'recursive': recursive } )
-            resp = urllib2.urlopen( url, data = data )
-            return resp.read()
-        except Exception as ex:
-            print ex
-            return ""
-
-    def find_file( self, path, pattern ):
+            data = self._resp.read( size )
+        except ( httplib.HTTPException, socket.error ):
+            self.close()
+            self._deadline.check()
+            raise
+        if not data:
+            # the body is cut at the end if the socket is shutdown at the deadline
+            if self._deadline.expired:
+                self.close()
+                self._deadline.check()
+            self._release()
+        return data
+
+    def iter_blocks( self ):
+        """
+        return: a generator of the body blocks, the response is closed when the generator is closed
+        """
         try:
-            url = "%s/find" % self.url
-            data = json.dumps( {'path':path,'pattern':pattern} )
-            print "find url=%s,data=%s" % ( url, data )
-            resp = urllib2.urlopen( url, data = data )
-            return resp.read()
-        except Exception as ex:
-            print ex
-            return ""
-    def shell( self, script ):
+            while True:
+                data = self.read( STREAM_BLOCK_SIZE )
+                if not data: break
+                yield data
+        finally:
+            self.close()
+
+    def close( self ):
+        if self._conn is not None:
+            self._deadline.cancel()
+            self._conn.close()
+            self._conn = None
+
+    def _release( self ):
+        self._deadline.cancel()
+        if self._resp.will_close or self._deadline.expired:
+            self._conn.close()
+        else:
+            self._server._put_connection( self._conn )
+        self._conn = None
+
+class FanOut:
+    """
+    send a request to many log servers concurrently
+
+    at most max_concurrency requests are sent at the same time and every request including its
+    response body is failed if the log server does not finish it in timeout seconds. The response
+    bodies are read concurrently into the spooled temporary files
+    """
+    def __init__( self, max_concurrency = 32, timeout = 30 ):
+        self.timeout = timeout
+        self._pool = ThreadPool( max_concurrency )
+
+    def call( self, servers, func ):
+        """
+        call func( server, timeout ) for every server
+
+        return: a generator of {"node", "status", "result" or "error", "elapsed"} in the order that
+            the servers finish, the status is one of "ok", "timeout" and "error" and the "result" is
+            a temporary file of the body of the NodeResponse returned by func
+        """
+        return self._pool.imap_unordered( lambda server: self._call( server, func ), servers )
+
+    @staticmethod
+    def close( results ):
+        """
+        close the temporary files in the results which are not read
+        """
+        for result in results:
+            if "result" in result:
+                result["result"].close()
+
+    def _call( self, server, func ):
+        start = time.time()
+        result = { "node": server.get_name() }
+        body = tempfile.SpooledTemporaryFile( SPOOL_MEMORY_SIZE )
         try:
-            url = "%s/shell" % self.url
-            data = json.dumps( {'script': script } )
-            resp = urllib2.urlopen( url, data = data )
-            return resp.read()
+            for data in func( server, self.timeout ).iter_blocks():
+                body.write( data )
+            body.seek( 0 )
+            result["result"] = body
+            result["status"] = "ok"
+        except socket.timeout as ex:
+            body.close()
+            result["status"] = "timeout"
+            result["error"] = "no response in %s seconds" % self.timeout
         except Exception as ex:
-            print ex
-            return "%s" % ex
-
+            body.close()
+            logger.error( "fail to call node %s with error %s" % ( server.get_name(), ex ) )
+            result["status"] = "error"
+            result["error"] = "%s" % ex
+        result["elapsed"] = round( time.time() - start, 3 )
+        return result
 
 
 class LogServerMgr:
@@ -113,7 +404,11 @@ class LogServerMgr:
 
     def add_node( self, name, url, timeout = 60 ):
         with self._lock:
-            self.servers[ name ] = LogServer( name, url )
+            # keep the server object and its connections if the node registers again
+            if name in self.servers and self.servers[ name ].url == ( url[0:-1] if url.endswith('/') else url ):
+                self.servers[ name ].refresh( timeout )
+            else:
+                self.servers[ name ] = LogServer( name, url, timeout )
             self._remove_expired()
 
     def get_servers( self ):
@@ -135,8 +430,9 @@ class LogServerMgr:
             del self.servers[ name ]
 
 class LogProxy:
-    def __init__( self ):
+    def __init__( self, max_concurrency = 32, node_timeout = 30 ):
         self.server_mgr = LogServerMgr()
+        self.fan_out = FanOut( max_concurrency, node_timeout )
 
     def list_nodes( self ):
         return json.dumps( [ server.get_name() for server in self.server_mgr.get_servers() ] )
@@ -144,10 +440,7 @@ class LogProxy:
     def list_files( self ):
         path = Path( request.args['path'] if 'path' in request.args else "/" )
         servers = self._get_servers( path )
-        result = {}
-        for server in servers:
-            result[server.get_name()] = server.list_files( path.get_path_without_node() )
-        return json.dumps( result )
+        return self._fan_out( servers, lambda server, timeout: server.list_files( path.get_path_without_node(), timeout = timeout ) )
 
     def download_file( self ):
         path = Path( request.args['path'] if 'path' in request.args else "/" )
@@ -155,7 +448,57 @@ class LogProxy:
         if len( servers ) != 1:
             return "No such file"
         else:
-            return servers[0].download_file( path.get_path_without_node() )
+            headers = dict( [ ( name, request.headers[name] ) for name in ( "Range", "If-Range" ) if name in request.headers ] )
+            return servers[0].download_file( path.get_path_without_node(), headers, timeout = self.fan_out.timeout )
+
+    def follow_file( self ):
+        """
+        follow the file on a node or all the nodes, the records from the nodes are interleaved
+        into one NDJSON stream and every record has a "node" field
+        """
+        path = Path( request.args['path'] if 'path' in request.args else "/" )
+        lines = int( request.args['lines'] ) if 'lines' in request.args else 0
+        servers = self._get_servers( path )
+        if len( servers ) <= 0:
+            return "No such file", 404
+        return Response( self._follow( servers, path.get_path_without_node(), lines ), mimetype = "application/x-ndjson" )
+
+    def _follow( self, servers, path, lines ):
+        records = Queue.Queue( 10000 )
+        stopped = threading.Event()
+        connections = [ server.follow_file( path, lines, records, stopped ) for server in servers ]
+        try:
+            closed = 0
+            while closed < len( servers ):
+                try:
+                    record = records.get( timeout = 15 )
+                except Queue.Empty:
+                    yield "%s\n" % json.dumps( {"heartbeat": time.time()} )
+                    continue
+                if "status" in record:
+                    closed += 1
+                yield "%s\n" % json.dumps( record )
+        finally:
+            # the client is disconnected, stop following the file on all nodes
+            stopped.set()
+            for conn in connections:
+                try:
+                    if conn.sock is not None:
+                        conn.sock.shutdown( socket.SHUT_RDWR )
+                except socket.error:
+                    pass
+
+    def tail_file( self ):
+        path = Path( request.args['path'] if 'path' in request.args else "/" )
+        lines = int( request.args['lines'] ) if 'lines' in request.args else 10
+        servers = self._get_servers( path )
+        if len( servers ) != 1:
+            return "No such file", 404
+        try:
+            resp = servers[0].tail_file( path.get_path_without_node(), lines, timeout = self.fan_out.timeout )
+        except Exception as ex:
+            return "%s" % ex, 502
+        return Response( resp.iter_blocks(), direct_passthrough = True )
 
     def grep_file( self ):
         req_info = json.load( request.stream )
@@ -163,23 +506,14 @@ class LogProxy:
         pattern = req_info['pattern']
         recursive = req_info['recursive']
         servers = self._get_servers( path )
-
-        result = {}
-        for server in servers:
-            result[server.get_name()] = server.grep_file( path.get_path_without_node(), pattern, recursive = recursive )
-
-        return json.dumps( result )
+        return self._fan_out( servers, lambda server, timeout: server.grep_file( path.get_path_without_node(), pattern, recursive = recursive, timeout = timeout ) )
 
     def find_file( self ):
         req_info = json.load( request.stream )
         path = Path( req_info['path'] if 'path' in req_info else '/' )
         pattern = req_info['pattern']
         servers = self._get_servers( path )
-
-        result = {}
-        for server in servers:
-            result[ server.get_name() ] = server.find_file( path.get_path_without_node(), pattern )
-        return json.dumps( result )
+        return self._fan_out( servers, lambda server, timeout: server.find_file( path.get_path_without_node(), pattern, timeout = timeout ) )
 
     def shell( self ):
         """
@@ -193,10 +527,7 @@ class LogProxy:
         else:
             servers = [ self.server_mgr.get_server( name ) for name in nodes ]
             servers = [ server for server in servers if server is not None ]
-        result = {}
-        for server in servers:
-            result[ server.get_name() ] = server.shell( script )
-        return json.dumps( result )
+        return self._fan_out( servers, lambda server, timeout: server.shell( script, timeout = timeout ) )
 
     def register_server( self ):
         try:
@@ -207,6 +538,58 @@ class LogProxy:
             print ex
             return "%s" % ex
 
+    def _fan_out( self, servers, func ):
+        """
+        call the servers concurrently
+
+        if the request has parameter stream=true, the result of every node is returned as a
+        NDJSON record once the node finishes, otherwise all the results are returned in a json object.
+        The response bodies of the nodes are copied from the temporary files into the "result" strings
+        """
+        results = self.fan_out.call( servers, func )
+        if 'stream' in request.args and to_boolean( request.args['stream'] ):
+            return Response( self._encode_results( results, "", "\n", "" ), mimetype = "application/x-ndjson" )
+        return Response( self._encode_results( results, "{", ", ", "}" ), mimetype = "application/json" )
+
+    def _encode_results( self, results, begin, separator, end ):
+        """
+        encode the results to json, the records are prefixed with the node name if begin is "{"
+        """
+        try:
+            yield begin
+            first = True
+            for result in results:
+                if not first:
+                    yield separator
+                first = False
+                for data in self._encode_result( result, begin == "{" ):
+                    yield data
+            if begin != "{":
+                yield separator
+            yield end
+        finally:
+            # the client is disconnected, close the results of the nodes which are not read
+            th = threading.Thread( target = self.fan_out.close, args = ( results, ) )
+            th.daemon = True
+            th.start()
+
+    def _encode_result( self, result, with_node_name ):
+        body = result.pop( "result", None )
+        if with_node_name:
+            yield "%s: " % json.dumps( result["node"] )
+        if body is None:
+            yield json.dumps( result )
+            return
+        # the body is escaped block by block into the "result" string
+        try:
+            yield json.dumps( result )[0:-1] + ', "result": "'
+            decoder = codecs.getincrementaldecoder( "utf-8" )( "replace" )
+            for data in iter( lambda: body.read( STREAM_BLOCK_SIZE ), "" ):
+                yield json.dumps( decoder.decode( data ) )[1:-1]
+            yield json.dumps( decoder.decode( "", True ) )[1:-1] + '"}'
+        finally:
+            body.close()
+
     def _get_servers( self, path ):
         """
         get the servers by the path
@@ -232,6 +615,8 @@ def parse_args():
     parser = argparse.ArgumentParser( description = "logserver proxy" )
     parser.add_argument( "--host", help = "the listening ip/host, default is 127.0.0.1", default = "127.0.0.1" )
     parser.add_argument( "--port", help = "the listening port number, default is 5000", default = 5000, type = int )
+    parser.add_argument( "--max-concurrency", help = "the max number of nodes requested concurrently, default is 32", default = 32, type = int )
+    parser.add_argument( "--node-timeout", help = "the seconds to wait for the response of a node, default is 30", default = 30, type = float )
     return parser.parse_args()
 
 def init_logger( log_file  = None):
@@ -248,12 +633,14 @@ def init_logger( log_file  = None):
 def main():
     args = parse_args()
     init_logger()
-    logproxy = LogProxy()
+    logproxy = LogProxy( args.max_concurrency, args.node_timeout )
     app = Flask( __name__ )
     app.add_url_rule( "/register", "register", logproxy.register_server, methods = ["POST"])
     app.add_url_rule( "/nodes", "nodes", logproxy.list_nodes, methods=['GET'])
     app.add_url_rule( "/list", "list", logproxy.list_files, methods=['GET'])
     app.add_url_rule( "/download", "download", logproxy.download_file, methods=['GET'] )
+    app.add_url_rule( "/tail", "tail", logproxy.tail_file, methods=['GET'] )
+    app.add_url_rule( "/follow", "follow", logproxy.follow_file, methods=['GET'] )
     app.add_url_rule( "/grep", "grep", logproxy.grep_file, methods=['POST'] )
     app.add_url_rule( "/find", "find", logproxy.find_file, methods=['POST'] )
     app.add_url_rule( "/shell", "shell", logproxy.shell, methods = ['POST'] )
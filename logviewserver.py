@@ -1,8 +1,15 @@
 #!/usr/bin/python
 
 import argparse
+import collections
+import fnmatch
+import gzip
+import io
 import logging
-from flask import Flask,request,send_file
+import mmap
+import re
+from flask import Flask,request,send_file,Response
+from werkzeug.serving import WSGIRequestHandler
 import json
 import os
 import subprocess
@@ -10,6 +17,16 @@ import threading
 import time
 import urllib2
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
 def which( process ):
     try:
         return subprocess.check_output(['which', process]).strip()
@@ -19,6 +36,182 @@ def which( process ):
 def get_shell():
     return which( '/bin/bash' ) or which( '/bin/sh' )
 
+def open_log_file( path ):
+    """
+    open the log file, the .gz and .zst files are decompressed transparently
+
+    return: a file object for reading lines
+    """
+    if path.endswith( ".gz" ):
+        return gzip.open( path, "rb" )
+    if path.endswith( ".zst" ):
+        if zstandard is None:
+            raise IOError( "zstandard module is not installed" )
+        fp = open( path, "rb" )
+        try:
+            return io.BufferedReader( zstandard.ZstdDecompressor().stream_reader( fp, closefd = True ) )
+        except Exception:
+            fp.close()
+            raise
+    return open( path, "rb" )
+
+def grep_lines( path, regex ):
+    """
+    find the lines matched with the regex in the file
+
+    the plain file is scanned with mmap, the compressed file is decompressed line by line. Every
+    line is matched without its line separator, so both give the same result. The regex should be
+    compiled with re.MULTILINE to match "^" and "$" at the line boundaries in the plain file
+
+    return: a generator of ( the offset of line, line )
+    """
+    if path.endswith( ".gz" ) or path.endswith( ".zst" ):
+        with open_log_file( path ) as fp:
+            offset = 0
+            for line in fp:
+                start = offset
+                offset += len( line )
+                line = line.rstrip( b"\n" )
+                if regex.search( line ):
+                    yield start, line
+        return
+
+    with open( path, "rb" ) as fp:
+        if os.fstat( fp.fileno() ).st_size == 0:
+            return
+        mm = mmap.mmap( fp.fileno(), 0, access = mmap.ACCESS_READ )
+        try:
+            pos = 0
+            while True:
+                m = regex.search( mm, pos )
+                if m is None:
+                    break
+                start = mm.rfind( b"\n", 0, m.start() ) + 1
+                end = mm.find( b"\n", m.start() )
+                if end < 0:
+                    end = len( mm )
+                line = mm[start:end]
+                # the match may run across the line end or depend on the next line, check the line by itself
+                if regex.search( line ):
+                    yield start, line
+                pos = end + 1
+        finally:
+            mm.close()
+
+def tail_lines( path, lines, block_size = 64 * 1024 ):
+    """
+    read the last lines of the file, the plain file is read backward from the end block by block
+
+    return: the last lines
+    """
+    if lines <= 0:
+        return b""
+    if path.endswith( ".gz" ) or path.endswith( ".zst" ):
+        with open_log_file( path ) as fp:
+            return b"".join( collections.deque( fp, lines ) )
+
+    with open( path, "rb" ) as fp:
+        fp.seek( 0, os.SEEK_END )
+        pos = fp.tell()
+        data = b""
+        # one more newline is needed to make sure the first line is complete
+        while pos > 0 and data.count( b"\n" ) <= lines:
+            n = min( block_size, pos )
+            pos -= n
+            fp.seek( pos )
+            data = fp.read( n ) + data
+    result = data.split( b"\n" )
+    return b"\n".join( result[-( lines + 1 ):] if data.endswith( b"\n" ) else result[-lines:] )
+
+def to_ndjson( record ):
+    return json.dumps( record ) + "\n"
+
+class FileFollower:
+    """
+    follow the lines appended to the file like "tail -F"
+
+    the directory of the file is watched with inotify if inotify_simple is installed, otherwise the
+    file is checked every poll_interval seconds. The file is reopened if it is rotated or truncated.
+    """
+    def __init__( self, path, poll_interval = 1.0, heartbeat_interval = 15 ):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+
+    def follow( self, lines = 0 ):
+        """
+        return: a generator of NDJSON records:
+            - {"line"}, a line appended to the file
+            - {"event"}, the file is "rotated" or "truncated"
+            - {"heartbeat"}, no line is appended in heartbeat_interval seconds
+        """
+        inotify = self._create_inotify()
+        fp = open( self.path, "rb" )
+        try:
+            for line in tail_lines( self.path, lines ).splitlines():
+                yield to_ndjson( {"line": line.decode( "utf-8", "replace" )} )
+            fp.seek( 0, os.SEEK_END )
+            partial = b""
+            last_output = time.time()
+            while True:
+                data = fp.read( 64 * 1024 )
+                if data:
+                    new_lines = ( partial + data ).split( b"\n" )
+                    partial = new_lines.pop()
+                    for line in new_lines:
+                        yield to_ndjson( {"line": line.decode( "utf-8", "replace" )} )
+                    last_output = time.time()
+                    continue
+                event = self._check_rotation( fp )
+                if event is not None:
+                    if partial:
+                        yield to_ndjson( {"line": partial.decode( "utf-8", "replace" )} )
+                        partial = b""
+                    fp.close()
+                    fp = open( self.path, "rb" )
+                    yield to_ndjson( {"event": event} )
+                    last_output = time.time()
+                    continue
+                if time.time() - last_output >= self.heartbeat_interval:
+                    # the server finds the client is disconnected only when writing to it
+                    yield to_ndjson( {"heartbeat": time.time()} )
+                    last_output = time.time()
+                self._wait( inotify )
+        finally:
+            fp.close()
+            if inotify is not None:
+                inotify.close()
+
+    def _create_inotify( self ):
+        if INotify is None:
+            return None
+        inotify = INotify()
+        inotify.add_watch( os.path.dirname( os.path.abspath( self.path ) ),
+                           inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.DELETE )
+        return inotify
+
+    def _wait( self, inotify ):
+        if inotify is None:
+            time.sleep( self.poll_interval )
+        else:
+            inotify.read( timeout = int( self.poll_interval * 1000 ) )
+
+    def _check_rotation( self, fp ):
+        """
+        return: "rotated" if a new file is created with the same name, "truncated" if the file
+            is truncated, None if the file is not changed
+        """
+        try:
+            st = os.stat( self.path )
+        except OSError:
+            # the file is moved and the new file is not created yet
+            return None
+        if st.st_ino != os.fstat( fp.fileno() ).st_ino:
+            return "rotated"
+        if st.st_size < fp.tell():
+            return "truncated"
+        return None
+
 class LogServer:
     def __init__( self, log_dir ):
         os.chdir( log_dir )
@@ -39,38 +232,144 @@ class LogServer:
                 return "Missing path parameter"
             if not os.path.isfile( path ):
                 return "%s is not file or does not exist" % path
-            return send_file( path )
+            return send_file( path, conditional = True )
         except Exception as ex:
             return "%s" % ex
 
+    def tail_file( self ):
+        """
+        get the last lines of file
+
+        Args:
+            parameters from client:
+            - path, the file name
+            - lines(optional), the number of lines, default is 10
+        """
+        try:
+            path = self._get_path( request.args['path'] ) if 'path' in request.args else None
+            if path is None:
+                return "Missing path parameter", 400
+            if not os.path.isfile( path ):
+                return "%s is not file or does not exist" % path, 404
+            lines = int( request.args['lines'] ) if 'lines' in request.args else 10
+            return Response( tail_lines( path, lines ), mimetype = "text/plain" )
+        except Exception as ex:
+            return "%s" % ex, 500
+
+    def follow_file( self ):
+        """
+        follow the lines appended to the file
+
+        Args:
+            parameters from client:
+            - path, the file name
+            - lines(optional), the number of last lines returned before following, default is 0
+        """
+        path = self._get_path( request.args['path'] ) if 'path' in request.args else None
+        if path is None:
+            return "Missing path parameter", 400
+        if not os.path.isfile( path ):
+            return "%s is not file or does not exist" % path, 404
+        lines = int( request.args['lines'] ) if 'lines' in request.args else 0
+        return Response( FileFollower( path ).follow( lines ), mimetype = "application/x-ndjson" )
+
     def grep_file( self ):
+        """
+        find the lines matched with the python regular expression in the files
+
+        the request is a json object with fields:
+        - path, the file or directory
+        - pattern, the regular expression
+        - recursive(optional), grep the files in sub-directories, default is false
+        - max_matches(optional), stop after max_matches lines are found, default is 10000
+        - max_bytes(optional), stop after max_bytes bytes are returned, default is 64M
+
+        the matched lines are streamed as NDJSON records {"file", "offset", "line"} when they are found,
+        and the last record is {"matches": n, "truncated": true/false}
+        """
         try:
             req_info = json.load( request.stream )
-            print req_info
-            path = req_info['path'] if 'path' in req_info else None
-            pattern = req_info['pattern'] if 'pattern' in req_info else None
-            recursive = req_info['recursive'] if 'recursive' in req_info else False
-            shell = get_shell()
-            path = self._get_path( path )
-            if os.path.isdir( path ):
-                path = os.path.join( path, '*' )
-            command = [shell, "-c", "grep -d %s --color=always '%s' %s" % ( 'recurse' if recursive else 'read', pattern, path ) ]
-            print command
-            return subprocess.check_output( command )
-        except subprocess.CalledProcessError as ex:
-            return ex.output
+            path = self._get_path( req_info['path'] if 'path' in req_info else "." )
+            pattern = req_info['pattern']
+            regex = re.compile( pattern if isinstance( pattern, bytes ) else pattern.encode( "utf-8" ), re.MULTILINE )
+        except Exception as ex:
+            return "%s" % ex, 400
+        recursive = req_info['recursive'] if 'recursive' in req_info else False
+        max_matches = req_info['max_matches'] if 'max_matches' in req_info else 10000
+        max_bytes = req_info['max_bytes'] if 'max_bytes' in req_info else 64 * 1024 * 1024
+        return Response( self._grep_files( path, regex, recursive, max_matches, max_bytes ), mimetype = "application/x-ndjson" )
 
     def find_file( self ):
+        """
+        find the files and directories whose name matches the shell pattern
+
+        the request is a json object with fields:
+        - path, the directory
+        - pattern, the shell pattern like "*.log"
+        - max_matches(optional), stop after max_matches paths are found, default is 10000
+
+        the found paths are streamed as NDJSON records {"path"} and the last record is {"matches": n, "truncated": true/false}
+        """
         try:
             req_info = json.load( request.stream )
-            path = req_info['path'] if 'path' in req_info else None
-            pattern = req_info['pattern'] if 'pattern' in req_info else None
-            shell = get_shell()
-            command = [shell, "-c", "find %s -name '%s'" % ( self._get_path( path ), pattern ) ]
-            print command
-            return subprocess.check_output( command )
-        except subprocess.CalledProcessError as ex:
-            return ex.output
+            path = self._get_path( req_info['path'] if 'path' in req_info else "." )
+            pattern = req_info['pattern']
+        except Exception as ex:
+            return "%s" % ex, 400
+        max_matches = req_info['max_matches'] if 'max_matches' in req_info else 10000
+        return Response( self._find_files( path, pattern, max_matches ), mimetype = "application/x-ndjson" )
+
+    def _grep_files( self, path, regex, recursive, max_matches, max_bytes ):
+        """
+        the generator of grep result, it is closed by the server if the client is disconnected
+        """
+        matches = 0
+        n = 0
+        for filename in self._list_files( path, recursive ):
+            try:
+                for offset, line in grep_lines( filename, regex ):
+                    if matches >= max_matches or n >= max_bytes:
+                        yield to_ndjson( {"matches": matches, "truncated": True} )
+                        return
+                    record = to_ndjson( {"file": self._get_relative_path( filename ), "offset": offset, "line": line.decode( "utf-8", "replace" )} )
+                    matches += 1
+                    n += len( record )
+                    yield record
+            except Exception as ex:
+                yield to_ndjson( {"file": self._get_relative_path( filename ), "error": "%s" % ex} )
+        yield to_ndjson( {"matches": matches, "truncated": False} )
+
+    def _find_files( self, path, pattern, max_matches ):
+        matches = 0
+        for dirpath, dirnames, filenames in os.walk( path ):
+            for name in sorted( dirnames + filenames ):
+                if not fnmatch.fnmatch( name, pattern ):
+                    continue
+                if matches >= max_matches:
+                    yield to_ndjson( {"matches": matches, "truncated": True} )
+                    return
+                matches += 1
+                yield to_ndjson( {"path": self._get_relative_path( os.path.join( dirpath, name ) )} )
+        yield to_ndjson( {"matches": matches, "truncated": False} )
+
+    def _list_files( self, path, recursive ):
+        """
+        list the files under the path in order
+        """
+        if not os.path.isdir( path ):
+            yield path
+        elif recursive:
+            for dirpath, dirnames, filenames in os.walk( path ):
+                dirnames.sort()
+                for name in sorted( filenames ):
+                    yield os.path.join( dirpath, name )
+        else:
+            for name in sorted( os.listdir( path ) ):
+                if os.path.isfile( os.path.join( path, name ) ):
+                    yield os.path.join( path, name )
+
+    def _get_relative_path( self, path ):
+        return os.path.relpath( path, self.log_dir )
 
     def shell( self ):
         try:
@@ -117,9 +416,13 @@ def main():
         th.start()
 
     logserver = LogServer( args.dir )
+    # keep the connections from log proxy alive
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app = Flask(__name__)
     app.add_url_rule( "/list", "list", logserver.list_files, methods=['GET'])
     app.add_url_rule( "/download", "download", logserver.download_file, methods=['GET'] )
+    app.add_url_rule( "/tail", "tail", logserver.tail_file, methods=['GET'] )
+    app.add_url_rule( "/follow", "follow", logserver.follow_file, methods=['GET'] )
     app.add_url_rule( "/grep", "grep", logserver.grep_file, methods=["POST"] )
     app.add_url_rule( "/find", "find", logserver.find_file, methods=["POST"] )
     app.add_url_rule( "/shell", "shell", logserver.shell, methods=["POST"] )
@@ -1,94 +1,528 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
-import urllib2
+import aiohttp
 import argparse
+import asyncio
+import bisect
+import datetime
+import json
+import math
+import multiprocessing
+import random
 import time
-import threading
-import traceback
 import sys
+import urllib.parse as urlparse
 import logging
 import logging.handlers
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logger = logging.getLogger( "benchmark" )
+
+PERCENTILES = ( 50, 90, 99, 99.9 )
+
+class Histogram:
+    """
+    HDR style latency histogram
+
+    the values are counted in power of 2 buckets and every bucket is divided to SUB_BUCKETS linear
+    sub buckets, so a recorded value has less than 1% error in any magnitude and the histograms of
+    different processes can be merged by adding the counts.
+    """
+    SUB_BUCKET_BITS = 7
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__( self ):
+        # bucket index => count
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def record( self, value ):
+        """
+        record a value
+
+        Args:
+            value - a non-negative integer, the latency in microseconds
+        """
+        index = self._index( value )
+        self.counts[index] = self.counts.get( index, 0 ) + 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min( self.min, value )
+        self.max = value if self.max is None else max( self.max, value )
+
+    def merge( self, other ):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get( index, 0 ) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.total > 0:
+            self.min = other.min if self.min is None else min( self.min, other.min )
+            self.max = other.max if self.max is None else max( self.max, other.max )
+
+    def percentile( self, p ):
+        """
+        get the value at the percentile
+
+        Args:
+            p - the percentile, from 0 to 100
+        """
+        if self.total == 0:
+            return 0
+        target = max( 1, int( math.ceil( self.total * p / 100.0 ) ) )
+        n = 0
+        for index in sorted( self.counts ):
+            n += self.counts[index]
+            if n >= target:
+                return min( self._highest_value( index ), self.max )
+        return self.max
+
+    def mean( self ):
+        return self.sum / float( self.total ) if self.total > 0 else 0
+
+    def summary( self ):
+        """
+        get the count, min, mean, max and percentiles in milliseconds
+        """
+        r = { "count": self.total, "min": ( self.min or 0 ) / 1000.0, "mean": self.mean() / 1000.0, "max": ( self.max or 0 ) / 1000.0 }
+        for p in PERCENTILES:
+            r[ "p%s" % ( "%g" % p ).replace( ".", "" ) ] = self.percentile( p ) / 1000.0
+        return r
+
+    def to_dict( self ):
+        return { "counts": { str( index ): count for index, count in self.counts.items() },
+                 "total": self.total, "sum": self.sum, "min": self.min, "max": self.max }
+
+    @staticmethod
+    def from_dict( d ):
+        h = Histogram()
+        h.counts = { int( index ): count for index, count in d["counts"].items() }
+        h.total, h.sum, h.min, h.max = d["total"], d["sum"], d["min"], d["max"]
+        return h
+
+    def _index( self, value ):
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        return ( shift + 1 ) * self.SUB_BUCKETS + ( value >> shift ) - self.SUB_BUCKETS
+
+    def _highest_value( self, index ):
+        """
+        get the highest value counted in the bucket
+        """
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        return ( ( ( index % self.SUB_BUCKETS ) + self.SUB_BUCKETS + 1 ) << shift ) - 1
+
+class EndpointStats:
+    """
+    the latency and the results of the requests to an endpoint
+    """
+    def __init__( self ):
+        self.latency = Histogram()
+        self.success = 0
+        self.failed = 0
+        # status code => count
+        self.status = {}
+        # error => count
+        self.errors = {}
+
+    def record( self, latency, status, error ):
+        self.latency.record( latency )
+        if error is None and status // 100 == 2:
+            self.success += 1
+        else:
+            self.failed += 1
+        if error is not None:
+            self.errors[error] = self.errors.get( error, 0 ) + 1
+        else:
+            self.status[ str( status ) ] = self.status.get( str( status ), 0 ) + 1
+
+    def merge( self, other ):
+        self.latency.merge( other.latency )
+        self.success += other.success
+        self.failed += other.failed
+        for name in ( "status", "errors" ):
+            counts = getattr( self, name )
+            for key, count in getattr( other, name ).items():
+                counts[key] = counts.get( key, 0 ) + count
+
+    def to_dict( self ):
+        return { "latency": self.latency.to_dict(), "success": self.success, "failed": self.failed, "status": self.status, "errors": self.errors }
+
+    @staticmethod
+    def from_dict( d ):
+        stats = EndpointStats()
+        stats.latency = Histogram.from_dict( d["latency"] )
+        stats.success, stats.failed, stats.status, stats.errors = d["success"], d["failed"], d["status"], d["errors"]
+        return stats
+
+    def report( self ):
+        return { "requests": self.success + self.failed, "success": self.success, "failed": self.failed,
+                 "latency": self.latency.summary(), "status": self.status, "errors": self.errors }
+
 class RequestManager:
-    def __init__( self, total ):
-        self.total = total
-        self._lock = threading.Lock()
-        self.finished = 0
-        self._failed = 0
-        self._success = 0
-        self._print_num = self._get_print_num()
-        self._success_status = {}
-        self._failed_status = {}
-
-
-    def success( self, millis ):
-        with self._lock:
-            self._success += 1
-            if millis not in self._success_status:
-                self._success_status[ millis ] = 0
-            self._success_status[ millis ] += 1
-
-    def failed( self, millis ):
-        with self._lock:
-            self._failed += 1
-            if millis not in self._failed_status:
-                self._failed_status[ millis ] = 0
-            self._failed_status[ millis ] += 1
-
-
-    def nextRequest( self ):
-        with self._lock:
-            if self.finished >= self.total:
-                return False, False, 0
-            else:
-               self.finished += 1
-               return True, self.finished % self._print_num == 0 if self._print_num > 0 else False, self.finished
+    """
+    collect the results of the requests
+
+    the latency is measured from the intended send time in the open loop mode, so the requests delayed by
+    a slow server are not omitted, and the service time is measured from the actual send time.
+    """
+    def __init__( self, start_time ):
+        self.start_time = start_time
+        self.latency = Histogram()
+        self.service_time = Histogram()
+        self.success = 0
+        self.failed = 0
+        # status code => count
+        self.status = {}
+        # error => count
+        self.errors = {}
+        # second => { "requests", "errors", "latency" }
+        self.time_series = {}
+        # endpoint name => EndpointStats
+        self.endpoints = {}
+
+    def record( self, endpoint, intended_time, send_time, end_time, status, error = None ):
+        """
+        record the result of a request
+
+        Args:
+            endpoint - the name of the endpoint
+            intended_time - the time the request should be sent
+            send_time - the time the request is sent
+            end_time - the time the response is received
+            status - the http status code or None if no response
+            error - the error if no response
+        """
+        latency = int( ( end_time - intended_time ) * 1000000 )
+        self.latency.record( latency )
+        self.service_time.record( int( ( end_time - send_time ) * 1000000 ) )
+        ok = error is None and status // 100 == 2
+        if ok:
+            self.success += 1
+        else:
+            self.failed += 1
+        if error is not None:
+            self.errors[error] = self.errors.get( error, 0 ) + 1
+        else:
+            self.status[ str( status ) ] = self.status.get( str( status ), 0 ) + 1
+        second = int( end_time - self.start_time )
+        if second not in self.time_series:
+            self.time_series[second] = { "requests": 0, "errors": 0, "latency": Histogram() }
+        item = self.time_series[second]
+        item["requests"] += 1
+        if not ok:
+            item["errors"] += 1
+        item["latency"].record( latency )
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = EndpointStats()
+        self.endpoints[endpoint].record( latency, status, error )
+
+    def merge( self, other ):
+        self.latency.merge( other.latency )
+        self.service_time.merge( other.service_time )
+        self.success += other.success
+        self.failed += other.failed
+        for name in ( "status", "errors" ):
+            counts = getattr( self, name )
+            for key, count in getattr( other, name ).items():
+                counts[key] = counts.get( key, 0 ) + count
+        for second, other_item in other.time_series.items():
+            if second not in self.time_series:
+                self.time_series[second] = { "requests": 0, "errors": 0, "latency": Histogram() }
+            item = self.time_series[second]
+            item["requests"] += other_item["requests"]
+            item["errors"] += other_item["errors"]
+            item["latency"].merge( other_item["latency"] )
+        for endpoint, stats in other.endpoints.items():
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointStats()
+            self.endpoints[endpoint].merge( stats )
+
+    def to_dict( self ):
+        return { "start_time": self.start_time, "latency": self.latency.to_dict(), "service_time": self.service_time.to_dict(),
+                 "success": self.success, "failed": self.failed, "status": self.status, "errors": self.errors,
+                 "time_series": { str( second ): { "requests": item["requests"], "errors": item["errors"], "latency": item["latency"].to_dict() }
+                                  for second, item in self.time_series.items() },
+                 "endpoints": { endpoint: stats.to_dict() for endpoint, stats in self.endpoints.items() } }
+
+    @staticmethod
+    def from_dict( d ):
+        req_mgr = RequestManager( d["start_time"] )
+        req_mgr.latency = Histogram.from_dict( d["latency"] )
+        req_mgr.service_time = Histogram.from_dict( d["service_time"] )
+        req_mgr.success, req_mgr.failed = d["success"], d["failed"]
+        req_mgr.status, req_mgr.errors = d["status"], d["errors"]
+        req_mgr.time_series = { int( second ): { "requests": item["requests"], "errors": item["errors"], "latency": Histogram.from_dict( item["latency"] ) }
+                                for second, item in d["time_series"].items() }
+        req_mgr.endpoints = { endpoint: EndpointStats.from_dict( stats ) for endpoint, stats in d["endpoints"].items() }
+        return req_mgr
+
+    def report( self, total_time ):
+        """
+        get the report in json
+        """
+        total = self.success + self.failed
+        return { "requests": total, "success": self.success, "failed": self.failed, "total_time": total_time,
+                 "requests_per_second": total / total_time if total_time > 0 else 0,
+                 "latency": self.latency.summary(), "service_time": self.service_time.summary(),
+                 "status": self.status, "errors": self.errors,
+                 "time_series": [ { "second": second, "requests": self.time_series[second]["requests"],
+                                    "errors": self.time_series[second]["errors"],
+                                    "latency": self.time_series[second]["latency"].summary() } for second in sorted( self.time_series ) ],
+                 "endpoints": { endpoint: stats.report() for endpoint, stats in self.endpoints.items() } }
 
     def print_summary( self, total_time ):
-        for n in self._success_status:
-            print "%%%.2f in %d ms" % ( self._success_status[n] * 100.0 / self.total, n )
-        print "success=%d, failed=%d, total time=%.2fs" % ( self._success, self._failed, total_time )
+        report = self.report( total_time )
+        print( "second  requests  errors  p50(ms)  p99(ms)" )
+        for item in report["time_series"]:
+            print( "%6d  %8d  %6d  %7.2f  %7.2f" % ( item["second"], item["requests"], item["errors"], item["latency"]["p50"], item["latency"]["p99"] ) )
+        for name in ( "latency", "service_time" ):
+            s = report[name]
+            print( "%-12s min=%.2fms mean=%.2fms p50=%.2fms p90=%.2fms p99=%.2fms p999=%.2fms max=%.2fms" % (
+                name, s["min"], s["mean"], s["p50"], s["p90"], s["p99"], s["p999"], s["max"] ) )
+        if len( self.endpoints ) > 1:
+            for endpoint in sorted( self.endpoints ):
+                s = report["endpoints"][endpoint]
+                print( "%s: requests=%d failed=%d p50=%.2fms p90=%.2fms p99=%.2fms max=%.2fms%s" % (
+                    endpoint, s["requests"], s["failed"], s["latency"]["p50"], s["latency"]["p90"], s["latency"]["p99"], s["latency"]["max"],
+                    "".join( " %s=%d" % ( k, v ) for k, v in sorted( s["status"].items() ) + sorted( s["errors"].items() ) if not k.startswith( "2" ) ) ) )
+        print( "status: %s" % ", ".join( "%s=%d" % ( k, v ) for k, v in sorted( self.status.items() ) ) )
+        if self.errors:
+            print( "errors: %s" % ", ".join( "%s=%d" % ( k, v ) for k, v in sorted( self.errors.items() ) ) )
+        print( "success=%d, failed=%d, total time=%.2fs, requests/s=%.1f" % ( self.success, self.failed, total_time, report["requests_per_second"] ) )
+
+class Scenario:
+    """
+    the requests sent in the benchmark
+
+    every request is a dict with the keys:
+        name - the endpoint name in the report, default is the method and the url path
+        method, url, headers, data - the http request
+        weight - the relative frequency of the request in the weighted random mode, default 1
+        timestamp - the time the request was sent in the replay mode
+    """
+    def __init__( self, requests ):
+        self.requests = requests
+        self._cumulative_weights = []
+        total = 0
+        for request in requests:
+            total += request["weight"]
+            self._cumulative_weights.append( total )
 
-    def _get_print_num( self ):
-        possible_nums = ( 1000, 100, 10 )
-        for n in possible_nums:
-            if self.total >= 5 * n:
-                return n
-        return 0
+    def choose( self, rng ):
+        """
+        choose a request randomly by the weight
+        """
+        if len( self.requests ) == 1:
+            return self.requests[0]
+        return self.requests[ bisect.bisect_right( self._cumulative_weights, rng.random() * self._cumulative_weights[-1] ) ]
+
+    @staticmethod
+    def create_request( method, url, headers, data, name = None, weight = 1, timestamp = None ):
+        return { "name": name or "%s %s" % ( method, urlparse.urlsplit( url ).path or "/" ), "method": method, "url": url,
+                 "headers": headers, "data": data, "weight": weight, "timestamp": timestamp }
+
+    @staticmethod
+    def load( file_name, base_url = None, headers = None, replay = False ):
+        """
+        load the scenario from a JSONL file, every line is a request like:
+            {"method": "POST", "url": "/upload", "headers": {}, "body": "...", "weight": 2, "timestamp": 1700000000.5}
+
+        Args:
+            file_name - the scenario file
+            base_url - the relative url in the scenario is joined with it
+            headers - the headers added to every request
+            replay - every request must have the timestamp in the replay mode
+        """
+        requests = []
+        with open( file_name ) as fp:
+            for line_no, line in enumerate( fp, 1 ):
+                line = line.strip()
+                if not line: continue
+                item = json.loads( line )
+                if replay and item.get( "timestamp" ) is None:
+                    raise ValueError( "no timestamp in line %d of scenario %s for replay" % ( line_no, file_name ) )
+                request_headers = dict( headers or {} )
+                request_headers.update( item.get( "headers", {} ) )
+                data = item.get( "body" )
+                if isinstance( data, ( dict, list ) ):
+                    data = json.dumps( data )
+                    if not any( header.lower() == "content-type" for header in request_headers ):
+                        request_headers["Content-Type"] = "application/json"
+                method = item.get( "method", "POST" if data is not None else "GET" ).upper()
+                url = urlparse.urljoin( base_url, item["url"] ) if base_url else item["url"]
+                requests.append( Scenario.create_request( method, url, request_headers, data, item.get( "name" ),
+                                                          float( item.get( "weight", 1 ) ), parse_timestamp( item.get( "timestamp" ) ) ) )
+        if not requests:
+            raise ValueError( "no request in scenario %s" % file_name )
+        return Scenario( requests )
+
+def parse_timestamp( timestamp ):
+    """
+    parse the timestamp in seconds or ISO 8601 format to seconds
+    """
+    if timestamp is None or isinstance( timestamp, ( int, float ) ):
+        return timestamp
+    return datetime.datetime.fromisoformat( timestamp.replace( "Z", "+00:00" ) ).timestamp()
 
 def parse_args():
     parser = argparse.ArgumentParser( description = "http request like apache bench tool" )
     parser.add_argument( "-H", help = "headers", nargs = "+", required = False )
-    parser.add_argument( "-c", help = "concurrency requests, default 1", default = 1, type = int )
-    parser.add_argument( "-n", help = "amount of requests, default 100", default = 100, type = int )
+    parser.add_argument( "-c", help = "concurrency requests in closed loop mode or the max connections in open loop mode, default 1", default = 1, type = int )
+    parser.add_argument( "-n", help = "amount of requests, default 100 if --duration is missing, all the requests in replay mode", type = int )
     parser.add_argument( "-d", "--data", help = "the data to be sent", required = False )
+    parser.add_argument( "-m", "--method", help = "the http method, default POST if the data is sent otherwise GET", required = False )
+    parser.add_argument( "--rate", help = "send the requests at the rate per second in open loop mode", type = float )
+    parser.add_argument( "--duration", help = "send the requests in the seconds", type = float )
+    parser.add_argument( "-p", "--processes", help = "the number of processes, default 1", default = 1, type = int )
+    parser.add_argument( "--timeout", help = "the request timeout in seconds, default 30", default = 30, type = float )
+    parser.add_argument( "--max-pending", help = "the max requests waiting for connections in open loop mode, default 10000", default = 10000, type = int )
+    parser.add_argument( "--scenario", help = "the JSONL file of requests, the requests are chosen randomly by weight", required = False )
+    parser.add_argument( "--replay", help = "send the requests in scenario at their timestamp intervals", action = "store_true" )
+    parser.add_argument( "--speed", help = "the speed multiplier of replay, default 1", default = 1.0, type = float )
+    parser.add_argument( "--json-output", help = "write the report in json to the file, - for stdout", required = False )
     parser.add_argument( "--log-file", help = "the log file", required = False )
-    parser.add_argument( "url", help = "the url" )
-    return parser.parse_args()
+    parser.add_argument( "url", help = "the url, or the base url of the relative urls in scenario", nargs = "?" )
+    args = parser.parse_args()
+    if args.scenario is None and args.url is None:
+        parser.error( "the url is required without scenario" )
+    if args.replay and args.scenario is None:
+        parser.error( "--replay requires --scenario" )
+    if args.replay and args.rate:
+        parser.error( "--replay can not be used with --rate" )
+    if args.speed <= 0:
+        parser.error( "--speed must be greater than 0" )
+    if args.n is None and args.duration is None and not args.replay:
+        args.n = 100
+    return args
 
+async def send_request( session, req_mgr, request, intended_time = None ):
+    send_time = time.time()
+    status, error = None, None
+    try:
+        async with session.request( request["method"], request["url"], headers = request["headers"], data = request["data"] ) as resp:
+            await resp.read()
+            status = resp.status
+    except Exception as ex:
+        logger.debug( "fail to send request to %s with error %r" % ( request["url"], ex ) )
+        error = type( ex ).__name__
+    req_mgr.record( request["name"], intended_time or send_time, send_time, time.time(), status, error )
 
-def do_request( req_mgr, url, headers, data ):
-    while True:
-        ok, print_info, num = req_mgr.nextRequest()
-        if not ok: break
-        start = time.time()
-        try:
-            req = urllib2.Request( url, data = data )
-            for header in headers: req.add_header( header, headers[header] )
-            resp = urllib2.urlopen( req )
-            total = int( (time.time() - start ) * 1000 )
-            if resp.getcode() / 100 == 2:
-               req_mgr.success( total )
-            else:
-                req_mgr.failed( total )
-        except Exception as ex:
-            traceback.print_exc(file=logger)
-            total = int( (time.time() - start ) * 1000 )
-            req_mgr.failed( total )
-
-        if print_info:
-            print "request finished %d" % num
+async def run_closed_loop( session, req_mgr, scenario, rng, concurrency, total, deadline ):
+    """
+    every one of the concurrency workers sends the next request after the response of the previous one is received
+    """
+    sent = [0]
+
+    async def worker():
+        while ( total is None or sent[0] < total ) and ( deadline is None or time.time() < deadline ):
+            sent[0] += 1
+            await send_request( session, req_mgr, scenario.choose( rng ) )
+
+    await asyncio.gather( *[ worker() for i in range( concurrency ) ] )
+
+def rate_schedule( scenario, rng, start, rate, total ):
+    """
+    generate ( intended send time, request ) at the rate
+    """
+    sent = 0
+    while total is None or sent < total:
+        yield start + sent / rate, scenario.choose( rng )
+        sent += 1
+
+def replay_schedule( scenario, start, speed, index, processes, total ):
+    """
+    generate ( intended send time, request ) at the intervals of the request timestamps, the process
+    sends every processes-th request from the index-th one
+    """
+    requests = sorted( scenario.requests, key = lambda request: request["timestamp"] )
+    first = requests[0]["timestamp"]
+    for i in range( index, len( requests ) if total is None else min( total, len( requests ) ), processes ):
+        yield start + ( requests[i]["timestamp"] - first ) / speed, requests[i]
+
+async def run_open_loop( session, req_mgr, schedule, deadline, max_pending ):
+    """
+    send the requests at the intended time in the schedule without waiting for the responses
+    """
+    pending = set()
+    for intended_time, request in schedule:
+        if deadline is not None and intended_time >= deadline:
+            break
+        delay = intended_time - time.time()
+        if delay > 0:
+            await asyncio.sleep( delay )
+        if len( pending ) >= max_pending:
+            done, pending = await asyncio.wait( pending, return_when = asyncio.FIRST_COMPLETED )
+        pending.add( asyncio.ensure_future( send_request( session, req_mgr, request, intended_time ) ) )
+        if len( pending ) >= 1000:
+            pending = set( task for task in pending if not task.done() )
+    if pending:
+        await asyncio.wait( pending )
+
+async def run_benchmark( config ):
+    req_mgr = RequestManager( config["start_time"] )
+    deadline = config["start_time"] + config["duration"] if config["duration"] else None
+    scenario = config["scenario"]
+    # the random generator is created in the process, so the processes choose different requests
+    rng = random.Random()
+    connector = aiohttp.TCPConnector( limit = config["concurrency"], ttl_dns_cache = 300 )
+    timeout = aiohttp.ClientTimeout( total = config["timeout"] )
+    async with aiohttp.ClientSession( connector = connector, timeout = timeout ) as session:
+        await asyncio.sleep( max( 0, config["start_time"] - time.time() ) )
+        if config["replay"]:
+            schedule = replay_schedule( scenario, config["start_time"], config["speed"], config["index"], config["processes"], config["total"] )
+            await run_open_loop( session, req_mgr, schedule, deadline, config["max_pending"] )
+        elif config["rate"]:
+            schedule = rate_schedule( scenario, rng, config["start_time"] + config["offset"], config["rate"], config["total"] )
+            await run_open_loop( session, req_mgr, schedule, deadline, config["max_pending"] )
+        else:
+            await run_closed_loop( session, req_mgr, scenario, rng, config["concurrency"], config["total"], deadline )
+    return req_mgr
+
+def run_process( config ):
+    """
+    run the benchmark in a process
+
+    return: the result of RequestManager.to_dict()
+    """
+    if uvloop is not None:
+        uvloop.install()
+    return asyncio.run( run_benchmark( config ) ).to_dict()
+
+def split( n, parts ):
+    """
+    split n to the parts as even as possible
+    """
+    return [ n // parts + ( 1 if i < n % parts else 0 ) for i in range( parts ) ]
+
+def create_configs( args, scenario ):
+    """
+    create the benchmark configuration of every process
+    """
+    processes = max( 1, args.processes )
+    start_time = time.time() + ( 0.5 if processes > 1 else 0 )
+    # the replay schedule limits the total itself
+    totals = split( args.n, processes ) if args.n is not None and not args.replay else [ args.n ] * processes
+    concurrencies = split( max( args.c, processes ), processes )
+    configs = []
+    for i in range( processes ):
+        configs.append( { "scenario": scenario, "start_time": start_time, "duration": args.duration,
+                          "total": totals[i], "concurrency": concurrencies[i],
+                          "rate": args.rate / processes if args.rate else None,
+                          # the processes send the requests one after another in open loop mode
+                          "offset": i / args.rate if args.rate else 0,
+                          "replay": args.replay, "speed": args.speed, "index": i, "processes": processes,
+                          "timeout": args.timeout, "max_pending": args.max_pending } )
+    return configs
 
 def parseHeaders( headers ):
     r = {}
@@ -96,40 +530,61 @@ def parseHeaders( headers ):
     for header in headers:
         pos = header.find( ':' )
         if pos == -1:
-            print "Invalid header %s" % header
+            print( "Invalid header %s" % header )
         else:
-            r[ header[0:pos] ] = header[pos+1].strip()
+            r[ header[0:pos] ] = header[pos+1:].strip()
     return r
 
 def loadData( data ):
     if data is not None and data.startswith( "@" ):
-        with open( data[1:] ) as fp:
+        with open( data[1:], "rb" ) as fp:
             return fp.read()
     else:
         return data
 
 def init_logger( log_file ):
     if log_file is None:
-        handler = loggging.StreamHandler( sys.stdout )
+        handler = logging.StreamHandler( sys.stderr )
+        handler.setLevel( logging.INFO )
     else:
         handler = logging.handlers.RotatingFileHandler( log_file, maxBytes = 50 * 1024 * 1024, backupCount = 5 )
-    handler.setLevel( logging.DEBUG )
-    handler.setFormat( logging.Formatter( '%(asctime)s %(name)s - %(message)s' ) )
+        handler.setLevel( logging.DEBUG )
+    handler.setFormatter( logging.Formatter( '%(asctime)s %(name)s - %(message)s' ) )
+    logger.setLevel( logging.DEBUG )
     logger.addHandler( handler )
+
 def main():
     args = parse_args()
-    req_mgr = RequestManager( args.n )
-    threads = []
+    init_logger( args.log_file )
     headers = parseHeaders( args.H )
-    data = loadData( args.data )
+    if args.scenario is not None:
+        scenario = Scenario.load( args.scenario, args.url, headers, args.replay )
+    else:
+        data = loadData( args.data )
+        method = args.method or ( "POST" if data is not None else "GET" )
+        scenario = Scenario( [ Scenario.create_request( method, args.url, headers, data ) ] )
+    configs = create_configs( args, scenario )
     start = time.time()
-    for i in xrange( args.c ):
-        th = threading.Thread( target = do_request, args = ( req_mgr, args.url, headers, data ) )
-        th.start()
-        threads.append( th )
-
-    for th in threads:
-        th.join()
-    req_mgr.print_summary( time.time() - start )
+    if len( configs ) == 1:
+        results = [ run_process( configs[0] ) ]
+    else:
+        pool = multiprocessing.Pool( len( configs ) )
+        try:
+            results = pool.map( run_process, configs )
+        finally:
+            pool.close()
+            pool.join()
+    total_time = time.time() - max( start, configs[0]["start_time"] )
+    req_mgr = RequestManager.from_dict( results[0] )
+    for result in results[1:]:
+        req_mgr.merge( RequestManager.from_dict( result ) )
+    if args.json_output == "-":
+        print( json.dumps( req_mgr.report( total_time ), indent = 2 ) )
+        return
+    req_mgr.print_summary( total_time )
+    if args.json_output is not None:
+        with open( args.json_output, "w" ) as fp:
+            json.dump( req_mgr.report( total_time ), fp, indent = 2 )
+
 if __name__ == "__main__":
     main()
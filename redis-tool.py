@@ -1,41 +1,205 @@
 #!/usr/bin/python
 
+import argparse
+import hashlib
+import heapq
+import math
+import random
+import re
 import redis
+import struct
 import sys
+import time
 import json
 
-def get_string_size( redis_client, key ):
-    return redis_client.strlen( key )
+# the commands to get the number of elements/bytes of the value by type
+CARDINALITY_COMMANDS = { "string": "STRLEN",
+                         "list": "LLEN",
+                         "set": "SCARD",
+                         "zset": "ZCARD",
+                         "hash": "HLEN",
+                         "stream": "XLEN" }
 
-def get_list_size( redis_client, key ):
-    return redis_client.llen( key )
+# the key segments replaced with "*" in the key pattern: uuid, long hex string and number
+KEY_PATTERN_RE = re.compile( r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|(?<![0-9a-zA-Z])[0-9a-fA-F]{16,}(?![0-9a-zA-Z])|[0-9]+" )
 
-def get_set_size( redis_client, key ):
-    return redis_client.scard( key )
+def to_str( s ):
+    return s if isinstance( s, str ) else s.decode( "utf-8", "replace" )
 
-def get_zset_size( redis_client, key ):
-    size = 0
-    for v in redis_client.zrange( key, 0, -1 ):
-        size += len( v )
-    return size
+def get_key_pattern( key ):
+    return KEY_PATTERN_RE.sub( "*", to_str( key ) )
 
-def get_hash_size( redis_client, key ):
-    return redis_client.hlen( key )
+class HyperLogLog:
+    """
+    estimate the number of distinct values with 2^p registers
+    """
+    def __init__( self, p = 11 ):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray( self.m )
 
-def get_size( redis_client, key ):
-    t = redis_client.type( key )
-    func_map = { "string": get_string_size,
-                 "list": get_list_size,
-                 "set": get_set_size,
-                 "zset": get_zset_size,
-                 "hash": get_hash_size }
-    func = func_map[t] if t in func_map else None
-    ttl = redis_client.ttl( key )
-    if func is None:
-        print "missing function to get size of %s" % t
-        return t, ttl, -1
-    else:
-        return t, ttl, func( redis_client, key )
+    def add( self, value ):
+        h = struct.unpack( "<Q", hashlib.sha1( value ).digest()[0:8] )[0]
+        index = h >> ( 64 - self.p )
+        w = h & ( ( 1 << ( 64 - self.p ) ) - 1 )
+        rank = 64 - self.p - w.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count( self ):
+        alpha = 0.7213 / ( 1 + 1.079 / self.m )
+        estimate = alpha * self.m * self.m / sum( 2.0 ** -r for r in self.registers )
+        zeros = self.registers.count( b"\x00" )
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # linear counting for small cardinality
+            return int( self.m * math.log( float( self.m ) / zeros ) )
+        return int( estimate )
+
+class KeyPatternStats:
+    """
+    the statistics of the keys matching a pattern
+    """
+    def __init__( self ):
+        self.keys = 0
+        self.memory = 0
+        self.distinct_keys = HyperLogLog()
+        # the memory usage in power of 2 buckets, bit length of the memory => keys
+        self.memory_histogram = {}
+
+    def add( self, key, memory ):
+        self.keys += 1
+        self.memory += memory
+        self.distinct_keys.add( key )
+        bucket = memory.bit_length()
+        self.memory_histogram[bucket] = self.memory_histogram.get( bucket, 0 ) + 1
+
+class KeyspaceAnalyzer:
+    """
+    analyze the memory usage of the keys
+
+    the keys are scanned page by page and the TYPE, PTTL, MEMORY USAGE and the cardinality of the keys
+    in a page are got in two pipelined round trips. Only the biggest keys of every type and the
+    statistics of the key patterns are kept, so the memory used is bounded by the top and max_patterns.
+    """
+    def __init__( self, redis_client, scan_count = 1000, top = 100, sample_rate = 1.0, max_patterns = 10000,
+                  memory_samples = None, progress_interval = 10 ):
+        """
+        Args:
+            redis_client - the redis client
+            scan_count - the COUNT hint of SCAN
+            top - the number of biggest keys kept for every type
+            sample_rate - analyze the ratio of the scanned keys, the totals are estimated from them
+            max_patterns - the max number of key patterns, the keys of more patterns are counted in "<other>"
+            memory_samples - the SAMPLES of MEMORY USAGE for the nested values, None for the redis default
+            progress_interval - print the progress every the seconds, 0 for never
+        """
+        self.redis_client = redis_client
+        self.scan_count = scan_count
+        self.top = top
+        self.sample_rate = sample_rate
+        self.max_patterns = max_patterns
+        self.memory_samples = memory_samples
+        self.progress_interval = progress_interval
+        # type => min heap of ( memory, key, cardinality, ttl )
+        self.biggest_keys = {}
+        # pattern => KeyPatternStats
+        self.patterns = {}
+        self.scanned_keys = 0
+        self.analyzed_keys = 0
+        self.total_memory = 0
+        self.biggest_ttl = -1
+        self._memory_usage_supported = True
+
+    def run( self ):
+        start = last_progress = time.time()
+        cursor = 0
+        while True:
+            cursor, keys = self.redis_client.scan( cursor, count = self.scan_count )
+            self.scanned_keys += len( keys )
+            if self.sample_rate < 1:
+                keys = [ key for key in keys if random.random() < self.sample_rate ]
+            if keys:
+                self._analyze_keys( keys )
+            now = time.time()
+            if self.progress_interval > 0 and now - last_progress >= self.progress_interval:
+                last_progress = now
+                sys.stderr.write( "scanned %d keys, analyzed %d keys, %.0f keys/s\n" % (
+                    self.scanned_keys, self.analyzed_keys, self.scanned_keys / ( now - start ) ) )
+            if cursor == 0: break
+
+    def _analyze_keys( self, keys ):
+        pipe = self.redis_client.pipeline( transaction = False )
+        for key in keys:
+            pipe.type( key )
+            pipe.pttl( key )
+            if self._memory_usage_supported:
+                pipe.memory_usage( key, samples = self.memory_samples )
+        results = pipe.execute( raise_on_error = False )
+        step = 3 if self._memory_usage_supported else 2
+        types = [ to_str( t ) for t in results[0::step] ]
+        ttls = results[1::step]
+        memories = results[2::step] if self._memory_usage_supported else [ None ] * len( keys )
+        if self._memory_usage_supported and memories and isinstance( memories[0], redis.ResponseError ):
+            # MEMORY USAGE is not supported before redis 4.0, the cardinality is used as size
+            sys.stderr.write( "MEMORY USAGE is not supported: %s\n" % memories[0] )
+            self._memory_usage_supported = False
+            memories = [ None ] * len( keys )
+
+        pipe = self.redis_client.pipeline( transaction = False )
+        for key, t in zip( keys, types ):
+            if t in CARDINALITY_COMMANDS:
+                pipe.execute_command( CARDINALITY_COMMANDS[t], key )
+        cardinalities = iter( pipe.execute( raise_on_error = False ) )
+
+        for key, t, ttl, memory in zip( keys, types, ttls, memories ):
+            # the cardinality is taken before the key is skipped to keep it aligned with the key
+            cardinality = next( cardinalities ) if t in CARDINALITY_COMMANDS else -1
+            if t == "none" or isinstance( ttl, Exception ):
+                # the key is deleted after scanned
+                continue
+            if isinstance( cardinality, Exception ): cardinality = -1
+            if memory is None or isinstance( memory, Exception ):
+                memory = max( cardinality, 0 ) + len( key )
+            self._add_key( key, t, ttl, memory, cardinality )
+
+    def _add_key( self, key, t, ttl, memory, cardinality ):
+        self.analyzed_keys += 1
+        self.total_memory += memory
+        if ttl > self.biggest_ttl:
+            self.biggest_ttl = ttl
+
+        if t not in self.biggest_keys: self.biggest_keys[t] = []
+        heap = self.biggest_keys[t]
+        if len( heap ) < self.top:
+            heapq.heappush( heap, ( memory, key, cardinality, ttl ) )
+        elif memory > heap[0][0]:
+            heapq.heapreplace( heap, ( memory, key, cardinality, ttl ) )
+
+        pattern = get_key_pattern( key )
+        if pattern not in self.patterns:
+            if len( self.patterns ) >= self.max_patterns:
+                pattern = "<other>"
+            if pattern not in self.patterns:
+                self.patterns[pattern] = KeyPatternStats()
+        self.patterns[pattern].add( key, memory )
+
+    def print_report( self ):
+        for t in sorted( self.biggest_keys ):
+            for memory, key, cardinality, ttl in sorted( self.biggest_keys[t], reverse = True ):
+                print "%s %s %d %d %d" % ( t, to_str( key ), memory, cardinality, ttl )
+
+        print "pattern keys distinct_keys memory memory_histogram"
+        for pattern, stats in sorted( self.patterns.items(), key = lambda x: x[1].memory, reverse = True ):
+            histogram = " ".join( "<%d:%d" % ( 1 << bucket, stats.memory_histogram[bucket] ) for bucket in sorted( stats.memory_histogram ) )
+            print "%s %d %d %d %s" % ( pattern, stats.keys, stats.distinct_keys.count(), stats.memory, histogram )
+
+        if self.sample_rate < 1:
+            print "sampled keys:%d" % self.analyzed_keys
+            print "estimated total size:%d" % ( self.total_memory / self.sample_rate )
+        else:
+            print "total size:%d" % self.total_memory
+        print "total keys:%d" % self.scanned_keys
+        print "biggest ttl:%d" % ( self.biggest_ttl / 1000 if self.biggest_ttl > 0 else self.biggest_ttl )
 
 def dump_string( redis_client, key ):
     return json.dumps( { "key": key, "value": redis_client.get( key ) } )
@@ -52,40 +216,6 @@ def dump_key( redis_client, key ):
     func = func_map[t] if t in func_map else None
     return func( redis_client, key )
 
-def redis_size_summary( r ):
-    cursor = 0
-    typed_keys_size = {}
-    total_size = 0
-    total_keys = 0
-    biggest_ttl = -1
-    while True:
-        cursor, keys = r.scan( cursor )
-        total_keys += len( keys )
-        for key in keys:
-            t, ttl, size = get_size( r, key )
-            size += len( key )
-            if biggest_ttl == -1 or biggest_ttl < ttl:
-                biggest_ttl = ttl
-
-            if t not in typed_keys_size: typed_keys_size[t] = {}
-            typed_keys_size[t][key] = size
-            if size > 0: total_size += size
-
-        if cursor == 0 : break
-
-    for t in typed_keys_size:
-        keys_size = typed_keys_size[t]
-        keys_size = sorted( keys_size.items(), key=lambda x: x[1], reverse = True )
-        print_count = 100
-        for item in keys_size:
-            print "%s %s %d" % ( t, item[0], item[1] )
-            print_count -= 1
-            if print_count == 0: break
-
-    print "total size:%d" % total_size
-    print "total keys:%d" % total_keys
-    print "biggest ttl:%d" % biggest_ttl
-
 def dump_redis( r ):
     cursor = 0
     loops = 100000
@@ -96,6 +226,31 @@ def dump_redis( r ):
         loops -= 1
         if cursor == 0 or loops == 0: break
 
-r = redis.Redis( host = sys.argv[1], port = int( sys.argv[2] ), db = 0 )
+def parse_args():
+    parser = argparse.ArgumentParser( description = "redis tool" )
+    parser.add_argument( "host", help = "the redis host" )
+    parser.add_argument( "port", help = "the redis port", type = int )
+    parser.add_argument( "command", help = "dump the keys or print the memory summary of the keys, default dump", nargs = "?", choices = ["dump", "summary"], default = "dump" )
+    parser.add_argument( "--db", help = "the redis db, default 0", type = int, default = 0 )
+    parser.add_argument( "--scan-count", help = "the COUNT hint of SCAN, default 1000", type = int, default = 1000 )
+    parser.add_argument( "--top", help = "print the biggest keys of every type, default 100", type = int, default = 100 )
+    parser.add_argument( "--sample-rate", help = "analyze the ratio of keys and estimate the total, default 1", type = float, default = 1.0 )
+    parser.add_argument( "--max-patterns", help = "the max number of key patterns, default 10000", type = int, default = 10000 )
+    parser.add_argument( "--memory-samples", help = "the SAMPLES of MEMORY USAGE for the nested values", type = int )
+    parser.add_argument( "--progress-interval", help = "print the progress every the seconds, default 10", type = int, default = 10 )
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    r = redis.Redis( host = args.host, port = args.port, db = args.db )
+    if args.command == "summary":
+        analyzer = KeyspaceAnalyzer( r, scan_count = args.scan_count, top = args.top, sample_rate = args.sample_rate,
+                                     max_patterns = args.max_patterns, memory_samples = args.memory_samples,
+                                     progress_interval = args.progress_interval )
+        analyzer.run()
+        analyzer.print_report()
+    else:
+        dump_redis( r )
 
-dump_redis( r )
+if __name__ == "__main__":
+    main()
@@ -4,27 +4,51 @@ import argparse
 import sys
 
 import flask
+import hashlib
 import json
 import logging
 import logging.handlers
 import mmap
 import os
+import random
 import re
-import shutil
 import subprocess
 import threading
 import time
 import socket
 from flask import request, Response
+from werkzeug.serving import WSGIRequestHandler
+from stat import S_ISREG
 import traceback
+import uuid
+import zlib
 from abc import ABCMeta, abstractmethod
 
 try:
     from Queue import Queue
     from urllib2 import urlopen, Request
+    from httplib import HTTPConnection
+    from urllib import quote
 except ImportError:
     from queue import Queue
     from urllib.request import urlopen, Request
+    from http.client import HTTPConnection
+    from urllib.parse import quote
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
@@ -148,16 +172,456 @@ class OperationMonitor:
 operation_monitor = OperationMonitor()
 
 
-def is_modified_before(filename, modified_before):
+class PatternSet:
     """
-    check if the file is modified before modified_before seconds
-    :param filename: the file name
-    :param modified_before: in seconds
-    :return: True if the file is modified before modified_before seconds
+    a set of regular expression patterns matched with re.match()
+
+    The patterns like ".*\\.log$", ".+\\.log$" or "core\\." are checked with str.endswith()/str.startswith()
+    and the others are combined into one alternation regular expression
     """
-    if not os.path.exists(filename):
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns or [])
+        suffixes = []
+        min_length_suffixes = []
+        prefixes = []
+        others = []
+        for pattern in self.patterns:
+            if pattern.endswith("$") and pattern[0:2] in (".*", ".+"):
+                literal = self._parse_literal(pattern[2:-1])
+                if literal is not None:
+                    if pattern.startswith(".*"):
+                        suffixes.append(literal)
+                    else:
+                        min_length_suffixes.append(literal)
+                    continue
+            literal = self._parse_literal(pattern[0:-2] if pattern.endswith(".*") else pattern)
+            if literal is not None:
+                prefixes.append(literal)
+            else:
+                others.append(pattern)
+        self._suffixes = tuple(suffixes)
+        self._min_length_suffixes = tuple(min_length_suffixes)
+        self._prefixes = tuple(prefixes)
+        self._regexes = self._compile(others)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, name):
+        """
+        :return: True if the name matches any one of the patterns
+        """
+        # "." does not match the new line
+        if "\n" not in name:
+            if len(self._suffixes) > 0 and name.endswith(self._suffixes):
+                return True
+            for suffix in self._min_length_suffixes:
+                if len(name) > len(suffix) and name.endswith(suffix):
+                    return True
+        elif len(self._suffixes) > 0 or len(self._min_length_suffixes) > 0:
+            return any(re.match(pattern, name) is not None for pattern in self.patterns)
+        if len(self._prefixes) > 0 and name.startswith(self._prefixes):
+            return True
+        for regex in self._regexes:
+            if regex.match(name) is not None:
+                return True
         return False
-    return os.path.getmtime(filename) + modified_before < time.time()
+
+    @classmethod
+    def _parse_literal(cls, pattern):
+        """
+        get the literal string of the pattern
+        :return: the literal string or None if the pattern is not a literal string
+        """
+        literal = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == "\\":
+                if i + 1 >= len(pattern) or pattern[i + 1].isalnum() or pattern[i + 1] == "_":
+                    return None
+                literal.append(pattern[i + 1])
+                i += 2
+            elif c in ".^$*+?{}[]|()":
+                return None
+            else:
+                literal.append(c)
+                i += 1
+        return "".join(literal) if len(literal) > 0 else None
+
+    @classmethod
+    def _compile(cls, patterns):
+        """
+        compile the patterns into one alternation regular expression if possible
+        :return: a list of compiled regular expressions
+        """
+        if len(patterns) <= 1:
+            return [re.compile(pattern) for pattern in patterns]
+        default_flags = re.compile("").flags
+        regexes = [re.compile(pattern) for pattern in patterns]
+        # the group references and the inline flags can't be combined
+        for pattern, regex in zip(patterns, regexes):
+            if regex.flags != default_flags or re.search(r"\\[1-9]|\(\?P=", pattern) is not None:
+                return regexes
+        try:
+            return [re.compile("|".join("(?:{})".format(pattern) for pattern in patterns))]
+        except re.error:
+            # the patterns can't be combined, e.g. the same group name is used in the patterns
+            return regexes
+
+
+class FileNameMatcher:
+    """
+    match the file names with the include patterns and the exclude patterns
+
+    a name is matched if it matches any one of include patterns(or there is no include pattern) and
+    does not match any one of the exclude patterns. The results are cached by the name
+    """
+
+    def __init__(self, include_patterns, exclude_patterns, cache_size=100000):
+        self._include_patterns = PatternSet(include_patterns)
+        self._exclude_patterns = PatternSet(exclude_patterns)
+        self._cache_size = cache_size
+        self._cache = {}
+
+    def match(self, name):
+        """
+        :return: True if the name matches the include patterns and does not match the exclude patterns
+        """
+        result = self._cache.get(name)
+        if result is None:
+            result = self._match(name)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[name] = result
+        return result
+
+    def _match(self, name):
+        if len(self._include_patterns) > 0 and not self._include_patterns.match(name):
+            return False
+        return len(self._exclude_patterns) <= 0 or not self._exclude_patterns.match(name)
+
+
+class DirectoryWatcher:
+    """
+    watch the file changes under a directory with inotify
+    """
+
+    def __init__(self, path, recursive):
+        self.path = path
+        self.recursive = recursive
+        self._inotify = INotify()
+        self._watch_mask = (inotify_flags.CREATE | inotify_flags.MODIFY | inotify_flags.ATTRIB |
+                            inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO |
+                            inotify_flags.DELETE | inotify_flags.MOVE_SELF)
+        self._watch_paths = {}
+        self._changed_files = set()
+        self._changed_dirs = set()
+        self._need_rescan = False
+        self._lock = threading.Lock()
+        self._add_watches(path)
+        th = threading.Thread(target=self._read_events)
+        th.daemon = True
+        th.start()
+
+    @classmethod
+    def create(cls, path, recursive):
+        """
+        create a watcher for the directory
+        :param path: the directory to watch
+        :param recursive: True to watch the sub-directories also
+        :return: a DirectoryWatcher or None if the inotify is not available
+        """
+        if INotify is None or not os.path.isdir(path):
+            return None
+        try:
+            return cls(path, recursive)
+        except Exception as ex:
+            logger.error("fail to watch the directory {} with error:{}".format(path, ex))
+        return None
+
+    def take_changes(self):
+        """
+        take the changes since last call
+        :return: a tuple (changed files, changed directories, need_rescan). If need_rescan is True,
+        the changes are not reliable and a full scan is required
+        """
+        with self._lock:
+            changes = (self._changed_files, self._changed_dirs, self._need_rescan)
+            self._changed_files = set()
+            self._changed_dirs = set()
+            self._need_rescan = False
+            return changes
+
+    def _add_watches(self, path):
+        dirs = [path]
+        while len(dirs) > 0:
+            d = dirs.pop()
+            wd = self._inotify.add_watch(d, self._watch_mask)
+            self._watch_paths[wd] = d
+            if self.recursive:
+                for entry in scandir(d):
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+
+    def _remove_watches(self, path):
+        prefix = os.path.join(path, "")
+        for wd, d in list(self._watch_paths.items()):
+            if d == path or d.startswith(prefix):
+                del self._watch_paths[wd]
+                try:
+                    self._inotify.rm_watch(wd)
+                except Exception:
+                    pass
+
+    def _read_events(self):
+        while True:
+            try:
+                events = self._inotify.read()
+            except Exception as ex:
+                logger.error("fail to read inotify events of {} with error:{}".format(self.path, ex))
+                with self._lock:
+                    self._need_rescan = True
+                time.sleep(1)
+                continue
+            with self._lock:
+                for event in events:
+                    self._process_event(event)
+
+    def _process_event(self, event):
+        if event.mask & inotify_flags.Q_OVERFLOW:
+            logger.info("inotify event queue of {} is overflow".format(self.path))
+            self._need_rescan = True
+            return
+        dirname = self._watch_paths.get(event.wd)
+        if event.mask & inotify_flags.IGNORED:
+            self._watch_paths.pop(event.wd, None)
+            if dirname == self.path:
+                self._need_rescan = True
+            return
+        if dirname is None:
+            return
+        if event.mask & inotify_flags.MOVE_SELF:
+            if dirname == self.path:
+                self._need_rescan = True
+            return
+        filename = os.path.join(dirname, event.name)
+        if not event.mask & inotify_flags.ISDIR:
+            self._changed_files.add(filename)
+        elif not self.recursive:
+            return
+        elif event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+            try:
+                self._add_watches(filename)
+            except Exception as ex:
+                logger.error("fail to watch the directory {} with error:{}".format(filename, ex))
+                self._need_rescan = True
+            self._changed_dirs.add(filename)
+        elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+            # the files under the removed directory can't be known without a full scan
+            self._remove_watches(filename)
+            self._need_rescan = True
+
+
+class DirectoryIndex:
+    """
+    the index of files under a directory
+
+    the index is built by a full scan and kept up to date with the changes reported by
+    a DirectoryWatcher, so only the changed files are checked between two full scans
+    """
+
+    def __init__(self, module_name, path, recursive, name_filter, modified_before, watch):
+        self.module_name = module_name
+        self.path = path
+        self.recursive = recursive
+        self.modified_before = modified_before
+        self.files = {}
+        self._name_filter = name_filter
+        self._watch = watch
+        self._watcher = None
+        # the matched files modified within modified_before seconds, they are not in the index yet
+        self._pending_files = {}
+
+    def is_watched(self):
+        return self._watcher is not None
+
+    def scan(self):
+        """
+        rebuild the index by scanning all the files under the path
+        :return: None if succeed to scan the files, otherwise the exception
+        """
+        if self._watch and self._watcher is None:
+            self._watcher = DirectoryWatcher.create(self.path, self.recursive)
+        if self._watcher is not None:
+            # the scan will find all the changes happened before it
+            self._watcher.take_changes()
+        try:
+            logger.info("start to update files under path {}".format(self.path))
+            files = {}
+            pending_files = {}
+            if os.path.isfile(self.path):
+                stat = os.stat(self.path)
+                files[self.get_name(self.path)] = [stat.st_size, stat.st_mtime]
+            else:
+                now = time.time()
+                for filename, stat in self._scan_dir(self.path):
+                    self._add_file(filename, stat, now, files, pending_files)
+            self.files = files
+            self._pending_files = pending_files
+            logger.info("{} files are founded under {}".format(len(files), self.path))
+            return None
+        except Exception as ex:
+            logger.error("fail to update files in path {} with error {}s".format(self.path, ex))
+            traceback.print_exc()
+            return ex
+
+    def apply_changes(self):
+        """
+        update the index with the file changes reported by the watcher
+
+        :return: the names of changed files or None if the changes are unknown and a full scan is required
+        """
+        if self._watcher is None:
+            return []
+        changed_files, changed_dirs, need_rescan = self._watcher.take_changes()
+        if need_rescan:
+            return None
+        changes = {}
+        removed_names = set()
+        for d in changed_dirs:
+            try:
+                for filename, stat in self._scan_dir(d):
+                    changes[filename] = stat
+            except OSError as ex:
+                # the directory is removed before it is scanned, so the files under it are removed
+                logger.info("fail to scan the changed directory {} with error:{}".format(d, ex))
+                prefix = self.get_name(d) + "/"
+                removed_names.update(name for name in self.files if name.startswith(prefix))
+                removed_names.update(name for name in self._pending_files if name.startswith(prefix))
+        for filename in changed_files.union(self._pending_files.values()):
+            if filename in changes or not self._is_candidate(filename):
+                continue
+            try:
+                stat = os.stat(filename)
+                changes[filename] = stat if S_ISREG(stat.st_mode) else None
+            except OSError:
+                changes[filename] = None
+
+        now = time.time()
+        changed_names = []
+        for filename in changes:
+            name = self.get_name(filename)
+            old_value = self.files.pop(name, None)
+            self._pending_files.pop(name, None)
+            if changes[filename] is not None:
+                self._add_file(filename, changes[filename], now, self.files, self._pending_files)
+            if self.files.get(name) != old_value:
+                changed_names.append(name)
+        for name in removed_names.difference(changed_names):
+            self._pending_files.pop(name, None)
+            if self.files.pop(name, None) is not None:
+                changed_names.append(name)
+        if len(changed_names) > 0:
+            logger.debug("{} files are changed under {}".format(len(changed_names), self.path))
+        return changed_names
+
+    def get_name(self, filename):
+        """
+        get the file name with module
+        """
+        if filename == self.path:
+            return os.path.join("/", self.module_name, os.path.basename(filename))
+        return os.path.join("/", self.module_name, filename[len(self.path) + 1:])
+
+    def _add_file(self, filename, stat, now, files, pending_files):
+        name = self.get_name(filename)
+        if stat.st_mtime + self.modified_before < now:
+            files[name] = [stat.st_size, stat.st_mtime]
+        else:
+            pending_files[name] = filename
+
+    def _is_candidate(self, filename):
+        if not self.recursive and os.path.dirname(filename) != self.path:
+            return False
+        return self._name_filter(os.path.basename(filename))
+
+    def _scan_dir(self, path):
+        """
+        find all the matched files under the path
+        :return: a generator of (filename, stat) tuples
+        """
+        dirs = [path]
+        while len(dirs) > 0:
+            d = dirs.pop()
+            try:
+                entries = list(scandir(d))
+            except OSError as ex:
+                if d == path:
+                    raise
+                logger.error("fail to list directory {} with error:{}".format(d, ex))
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if self.recursive and not entry.is_symlink():
+                            dirs.append(entry.path)
+                    elif self._name_filter(entry.name) and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    # the file is removed during scanning
+                    pass
+
+
+class ChangeJournal:
+    """
+    a bounded journal of the file changes
+
+    every change gets a monotonically increasing generation. The epoch identifies the journal, so
+    a generation got from another journal(e.g. before the server is restarted) can be detected
+    """
+
+    def __init__(self, max_changes=100000):
+        self.epoch = uuid.uuid4().hex
+        self.generation = 0
+        self._max_changes = max_changes
+        self._changes = []
+
+    def record(self, kind, name, value):
+        """
+        record a change
+        :param kind: "files" or "backups"
+        :param name: the file name with module
+        :param value: the [file-size, file-last-modified-time] or None if the file is removed
+        """
+        self.generation += 1
+        self._changes.append((self.generation, kind, name, value))
+        if len(self._changes) > 2 * self._max_changes:
+            del self._changes[:len(self._changes) - self._max_changes]
+
+    def record_diff(self, kind, old_files, new_files):
+        """
+        record the changes between old_files and new_files
+        """
+        for name in old_files:
+            if name not in new_files:
+                self.record(kind, name, None)
+        for name in new_files:
+            if old_files.get(name) != new_files[name]:
+                self.record(kind, name, new_files[name])
+
+    def get_changes(self, epoch, generation):
+        """
+        get the changes after the generation
+        :return: a list of (generation, kind, name, value) tuples or None if the changes are not available
+        """
+        if epoch != self.epoch or generation > self.generation:
+            return None
+        first_generation = self._changes[0][0] if len(self._changes) > 0 else self.generation + 1
+        if generation + 1 < first_generation:
+            return None
+        return self._changes[generation + 1 - first_generation:]
 
 
 class ModuleFiles:
@@ -173,7 +637,10 @@ class ModuleFiles:
                  include_patterns,
                  exclude_patterns,
                  modified_before,
-                 update_interval):
+                 update_interval,
+                 watch=True,
+                 reconcile_interval=3600,
+                 journal_size=100000):
         self.module_name = module_name
         self.path = os.path.abspath(path)
         self.recursive = recursive
@@ -181,90 +648,141 @@ class ModuleFiles:
         self.include_patterns = include_patterns
         self.exclude_patterns = exclude_patterns
         self.update_interval = 300 if update_interval is None else update_interval
+        self.reconcile_interval = reconcile_interval
         self.modified_before = modified_before
         self.next_update_time = 0
         self.files = {'files': {}, 'backups': {}}
+        self.journal = ChangeJournal(journal_size)
+        self._matcher = FileNameMatcher(include_patterns, exclude_patterns)
+        self._index = DirectoryIndex(module_name, self.path, recursive, self._match_file_item, modified_before, watch)
+        if self.backup_path is None:
+            self._backup_index = None
+        else:
+            self._backup_index = DirectoryIndex(module_name,
+                                                self.backup_path,
+                                                recursive,
+                                                self._match_file_item,
+                                                modified_before,
+                                                watch)
         self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
 
-    def update_files(self, force=False):
+    def update_files(self, force=False, copy=True):
         """
         update the local files
 
         :param force: force to update the files immediately even if the update time does not meet
-        :return: the updated files
+        :param copy: False to not copy the files, get them with get_size(), find_files() and get_backups()
+        :return: a copy of the updated files or None if copy is False
         """
         op_name = "update_files_of_{}".format(self.module_name)
         operation_monitor.add_operation(op_name, 600)
-        files = self._update_files(force)
-        operation_monitor.remove_operation(op_name)
-        return files
+        try:
+            return self._update_files(force, copy)
+        finally:
+            operation_monitor.remove_operation(op_name)
 
-    def _update_files(self, force=False):
+    def _update_files(self, force=False, copy=True):
         """
         update the files
+
+        If the directories are watched, only the changed files are updated and a full scan is
+        done every reconcile_interval seconds. Otherwise a full scan is done every update_interval seconds.
         """
-        with self._lock:
-            if not force and self.next_update_time > time.time():
-                return self.files.copy()
-            self.next_update_time = time.time() + self.update_interval
+        with self._update_lock:
+            with self._lock:
+                if not force and self.next_update_time > time.time() and self._apply_changes():
+                    return self._copy_files() if copy else None
 
-        all_files, ex = self._get_files(self.path)
-        if self.backup_path is None:
-            all_backup_files, backup_ex = {}, None
-        else:
-            all_backup_files, backup_ex = self._get_files(self.backup_path)
+            ex = self._index.scan()
+            backup_ex = None if self._backup_index is None else self._backup_index.scan()
 
-        with self._lock:
-            if ex is None:
-                event_stat.clear("file_read_failure")
-                self.files['files'] = all_files
-            else:
-                event_stat.increase("file_read_failure")
-            if backup_ex is None:
-                event_stat.clear("backup_file_read_failure")
-                self.files['backups'] = all_backup_files
-            else:
-                event_stat.increase("backup_file_read_failure")
-            return self.files
+            with self._lock:
+                self.next_update_time = time.time() + self._get_scan_interval()
+                if ex is None:
+                    event_stat.clear("file_read_failure")
+                    self.journal.record_diff('files', self.files['files'], self._index.files)
+                    self.files['files'] = self._index.files
+                else:
+                    event_stat.increase("file_read_failure")
+                if backup_ex is None:
+                    event_stat.clear("backup_file_read_failure")
+                    if self._backup_index is not None:
+                        self.journal.record_diff('backups', self.files['backups'], self._backup_index.files)
+                        self.files['backups'] = self._backup_index.files
+                else:
+                    event_stat.increase("backup_file_read_failure")
+                return self._copy_files() if copy else None
 
-    def _get_files(self, path):
+    def _apply_changes(self):
+        """
+        apply the changes of watched directories to the files
+        :return: False if a full scan is required
         """
-        get all the files under path
-        :param path: the file path
+        for kind, index in (('files', self._index), ('backups', self._backup_index)):
+            if index is None:
+                continue
+            try:
+                changed_names = index.apply_changes()
+            except Exception as ex:
+                logger.error("fail to apply the changes under {} with error {}".format(index.path, ex))
+                return False
+            if changed_names is None:
+                return False
+            for name in changed_names:
+                self.journal.record(kind, name, index.files.get(name))
+        return True
+
+    def _get_scan_interval(self):
+        if self._index.is_watched() and (self._backup_index is None or self._backup_index.is_watched()):
+            return max(self.update_interval, self.reconcile_interval)
+        return self.update_interval
+
+    def _copy_files(self):
+        return {'files': dict(self.files['files']), 'backups': dict(self.files['backups'])}
+
+    def get_files_since(self, epoch, generation, time_within=0):
+        """
+        get the files changed since the generation
+
+        :param epoch: the journal epoch returned by previous call
+        :param generation: the generation returned by previous call, None to get all the files
+        :param time_within: only return the files modified within time_within seconds if it is greater than 0
         :return: a dict like:
         {
-            "file1": (file_size, file_change_time),
-            "file2": (file_size, file_change_time)
+            "epoch": "the journal epoch",
+            "generation": 123,
+            "delta": true,
+            "files": [ ("/module/file-1", [file-size, file-last-modified-time]),
+                       ("/module/file-2", None) ],
+            "backups": [ ("/module/backup-1", [file-size, file-last-modified-time]) ]
         }
+        the files and backups are iterables of (name, value) tuples sorted by name, the removed files
+        are None in the delta. If the changes since the generation are not available any more, all
+        the files are returned and the "delta" is false
         """
-        try:
-            logger.info("start to update files under path {}".format(path))
-            if os.path.isfile(path):
-                name = os.path.join("/", self.module_name, os.path.basename(path))
-                stat = os.stat(path)
-                return {name: [stat.st_size, stat.st_mtime]}, None
-
-            tmp_files = []
-            for root, dirs, names in os.walk(path):
-                if self.recursive or os.path.samefile(root, path):
-                    for name in names:
-                        if not self._match_file_item(name):
-                            continue
-                        filename = os.path.join(root, name)
-                        if is_modified_before(filename, self.modified_before):
-                            tmp_files.append(filename)
-            all_files = {}
-            for f in tmp_files:
-                if os.path.isfile(f):
-                    name = os.path.join("/", self.module_name, f[len(path) + 1:])
-                    stat = os.stat(f)
-                    all_files[name] = [stat.st_size, stat.st_mtime]
-            logger.info("{} files are founded under {}".format(len(all_files), path))
-            return all_files, None
-        except Exception as ex:
-            logger.error("fail to update files in path {} with error {}s".format(self.path, ex))
-            traceback.print_exc()
-            return {}, ex
+        min_change_time = time.time() - time_within if time_within > 0 else None
+        with self._lock:
+            changes = None if generation is None else self.journal.get_changes(epoch, generation)
+            result = {"epoch": self.journal.epoch,
+                      "generation": self.journal.generation,
+                      "delta": changes is not None}
+            if changes is None:
+                # only the references are copied under the lock, the files are sorted without it
+                items = {kind: list(self.files[kind].items()) for kind in ('files', 'backups')}
+            else:
+                items = {'files': {}, 'backups': {}}
+                for _, kind, name, value in changes:
+                    if value is None or min_change_time is None or value[1] > min_change_time:
+                        items[kind][name] = value
+                items = {kind: list(items[kind].items()) for kind in items}
+        for kind in ('files', 'backups'):
+            items[kind].sort(key=lambda item: item[0])
+            if changes is None and min_change_time is not None:
+                result[kind] = [(name, value) for name, value in items[kind] if value[1] > min_change_time]
+            else:
+                result[kind] = items[kind]
+        return result
 
     def file_added(self, name):
         """
@@ -279,6 +797,7 @@ class ModuleFiles:
             last_change_time = stat.st_mtime
         with self._lock:
             self.files['files'][name] = [size, last_change_time]
+            self.journal.record('files', name, [size, last_change_time])
 
     def get_size(self, name, backup=False):
         """
@@ -293,6 +812,29 @@ class ModuleFiles:
             else:
                 return self.files['files'][name][0] if name in self.files['files'] else None
 
+    def count_files(self):
+        """
+        :return: a tuple (number of files, number of backup files)
+        """
+        with self._lock:
+            return len(self.files['files']), len(self.files['backups'])
+
+    def get_backups(self):
+        """
+        :return: a copy of the backup files
+        """
+        with self._lock:
+            return dict(self.files['backups'])
+
+    def find_files(self, predicate):
+        """
+        find the files
+        :param predicate: a function called with the file name
+        :return: the names of files which the predicate returns True
+        """
+        with self._lock:
+            return [name for name in self.files['files'] if predicate(name)]
+
     def get_module_name(self):
         return self.module_name
 
@@ -318,30 +860,66 @@ class ModuleFiles:
                     return os.path.join(self.path, name[len(prefix) + 1:])
         return None
 
-    @classmethod
-    def _match_pattern(cls, name, pattern):
-        """
-        check if the file basename matches the pattern or not
-        """
-        return re.match(pattern, name) is not None
+    def _match_file_item(self, name):
+        # the temporary files written by FileSaver
+        if name.endswith(TEMP_FILE_SUFFIX):
+            return False
+        return self._matcher.match(name)
 
-    def _match_any_patterns(self, name, patterns):
-        for pattern in patterns:
-            if self._match_pattern(name, pattern):
-                return True
-        return False
 
-    def _match_file_item(self, name):
-        # check if the name matches any one of 'include-patterns'
-        if self.include_patterns is not None and len(self.include_patterns) > 0:
-            if not self._match_any_patterns(name, self.include_patterns):
-                return False
+PREFIX_CHECKSUM_SIZE = 64 * 1024
 
-        # check if the name matches any one of 'exclude-patterns'
-        if self.exclude_patterns is not None and len(self.exclude_patterns) > 0:
-            if self._match_any_patterns(name, self.exclude_patterns):
-                return False
-        return True
+
+def get_prefix_checksum(filename, offset):
+    """
+    get the checksum of the data before the offset in the file
+
+    only the last PREFIX_CHECKSUM_SIZE bytes before the offset are checked, it is enough to find out
+    if the file is rotated or truncated
+    :param filename: the file name
+    :param offset: the end of the data to check
+    :return: the sha1 hex digest of the data
+    """
+    start = max(offset - PREFIX_CHECKSUM_SIZE, 0)
+    with open(filename, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(offset - start)
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_resume_offset(filename, remote_size, with_checksum):
+    """
+    get the offset to resume the download of a file which is smaller in local
+
+    :param filename: the local file name
+    :param remote_size: the size of the file in remote
+    :param with_checksum: True to get the checksum of the local data before the offset
+    :return: a tuple (offset, checksum), the offset is 0 if the file must be downloaded completely
+    """
+    try:
+        local_size = os.path.getsize(filename)
+        if 0 < local_size < remote_size:
+            return local_size, get_prefix_checksum(filename, local_size) if with_checksum else None
+    except OSError:
+        pass
+    return 0, None
+
+
+def is_resumable(filename, offset, checksum):
+    """
+    check if the file can be sent from the offset
+
+    :param filename: the file name
+    :param offset: the offset asked by the client
+    :param checksum: the checksum of the client data before the offset, None to skip the check
+    :return: True if the data before the offset is same in client
+    """
+    try:
+        if offset <= 0 or offset > os.path.getsize(filename):
+            return False
+        return checksum is None or checksum == get_prefix_checksum(filename, offset)
+    except OSError:
+        return False
 
 
 class AsyncPush:
@@ -371,11 +949,20 @@ class AsyncPush:
             logger.info("push file {} to url {}".format(push_request['filename'], push_request['url']))
             op_name = "push_file_{}".format(push_request['filename'])
             operation_monitor.add_operation(op_name, 600)
-            self._push_file(push_request['filename'], push_request['url'])
+            self._push_file(push_request['filename'],
+                            push_request['url'],
+                            push_request.get('offset', 0),
+                            push_request.get('checksum'))
             operation_monitor.remove_operation(op_name)
 
     @classmethod
-    def _push_file(cls, filename, url):
+    def _push_file(cls, filename, url, offset=0, checksum=None):
+        """
+        push the file to the url
+
+        if the data before the offset is same in the client, only the data after the offset is pushed
+        with the "FileOffset" header
+        """
         try:
             if filename is None or not os.path.exists(filename):
                 req = Request(url, data="".encode(), headers={"FileNotExist": "true"})
@@ -388,6 +975,9 @@ class AsyncPush:
                     headers = {"FileLastAccessTime": str(stat_info.st_atime),
                                "FileLastModifiedTime": str(stat_info.st_mtime)}
                     mmapped_file_as_string = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    if is_resumable(filename, offset, checksum):
+                        headers["FileOffset"] = str(offset)
+                        mmapped_file_as_string = mmapped_file_as_string[offset:]
                     req = Request(url, data=mmapped_file_as_string, headers=headers)
                     urlopen(req, timeout=300)
             event_stat.clear("push_file_failure")
@@ -411,6 +1001,200 @@ def check_health():
     return "OK"
 
 
+FILE_LIST_MIME_TYPE = "application/x-file-list"
+FILE_LIST_MAGIC = b"FLS1"
+
+
+def get_file_list_encodings():
+    """
+    :return: the supported transfer compressions of the file list, the preferred is the first
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+class FileListEncoder:
+    """
+    encode the files to the compact file list format
+
+    The format is the magic "FLS1" followed by the backups section and the files section. Each
+    section is a sequence of entries sorted by the name and ended by an empty entry(both the shared
+    length and the suffix length are 0). An entry is:
+
+        varint: the length of the prefix shared with the previous name(in utf-8 bytes)
+        varint: the length of the remaining suffix, followed by the suffix in utf-8
+        varint: the flags, bit 0 is set if the file is removed
+        zigzag varint: the file size, absent if the file is removed
+        zigzag varint: the file last modified time in microseconds, absent if the file is removed
+
+    The encoded data is generated in chunks and optionally compressed with gzip or zstd
+    """
+
+    def __init__(self, compression=None, chunk_size=64 * 1024):
+        self.compression = compression
+        self.chunk_size = chunk_size
+
+    def encode(self, files):
+        """
+        encode the files
+        :param files: a dict with "files" and "backups" sorted by name, see ModuleFiles.get_files_since()
+        :return: a generator of the encoded chunks
+        """
+        compressor = self._create_compressor()
+        buf = bytearray(FILE_LIST_MAGIC)
+        for kind in ('backups', 'files'):
+            prev_name = b""
+            for name, value in files[kind]:
+                name = name.encode("utf-8")
+                shared = self._shared_prefix_length(prev_name, name)
+                self._write_varint(buf, shared)
+                self._write_varint(buf, len(name) - shared)
+                buf.extend(name[shared:])
+                if value is None:
+                    self._write_varint(buf, 1)
+                else:
+                    self._write_varint(buf, 0)
+                    self._write_zigzag(buf, int(value[0]))
+                    self._write_zigzag(buf, int(round(value[1] * 1000000)))
+                prev_name = name
+                if len(buf) >= self.chunk_size:
+                    data = compressor.compress(bytes(buf)) if compressor is not None else bytes(buf)
+                    del buf[:]
+                    if len(data) > 0:
+                        yield data
+            self._write_varint(buf, 0)
+            self._write_varint(buf, 0)
+        if compressor is None:
+            yield bytes(buf)
+        else:
+            yield compressor.compress(bytes(buf)) + compressor.flush()
+
+    def _create_compressor(self):
+        if self.compression == "gzip":
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif self.compression == "zstd":
+            return zstandard.ZstdCompressor().compressobj()
+        return None
+
+    @classmethod
+    def _shared_prefix_length(cls, s1, s2):
+        n = min(len(s1), len(s2))
+        i = 0
+        while i < n and s1[i] == s2[i]:
+            i += 1
+        return i
+
+    @classmethod
+    def _write_varint(cls, buf, n):
+        while n >= 0x80:
+            buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    @classmethod
+    def _write_zigzag(cls, buf, n):
+        cls._write_varint(buf, n * 2 if n >= 0 else -n * 2 - 1)
+
+
+class FileListDecoder:
+    """
+    decode the compact file list format in streaming, see FileListEncoder for the format
+    """
+
+    def __init__(self, stream, compression=None, read_size=64 * 1024):
+        self._stream = stream
+        self._read_size = read_size
+        self._decompressor = self._create_decompressor(compression)
+        self._buf = b""
+        self._pos = 0
+        self._eof = False
+
+    def read_backups(self):
+        """
+        read the backups section
+        :return: a dict of the backup files
+        """
+        magic = self._read_bytes(len(FILE_LIST_MAGIC))
+        if magic != FILE_LIST_MAGIC:
+            raise ValueError("not a file list")
+        return dict(self._read_entries())
+
+    def read_files(self):
+        """
+        read the files section, it must be called after read_backups()
+        :return: a generator of (name, value) tuples sorted by name
+        """
+        return self._read_entries()
+
+    def _read_entries(self):
+        prev_name = b""
+        while True:
+            shared = self._read_varint()
+            suffix = self._read_bytes(self._read_varint())
+            if shared == 0 and len(suffix) == 0:
+                break
+            name = prev_name[0:shared] + suffix
+            prev_name = name
+            if self._read_varint() & 1:
+                value = None
+            else:
+                size = self._read_zigzag()
+                value = [size, self._read_zigzag() / 1000000.0]
+            yield name.decode("utf-8"), value
+
+    @classmethod
+    def _create_decompressor(cls, compression):
+        if compression == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif compression == "zstd":
+            if zstandard is None:
+                raise ValueError("zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompressobj()
+        elif compression:
+            raise ValueError("unsupported compression {}".format(compression))
+        return None
+
+    def _fill(self):
+        while not self._eof:
+            data = self._stream.read(self._read_size)
+            if not data:
+                self._eof = True
+            elif self._decompressor is not None:
+                data = self._decompressor.decompress(data)
+            if data:
+                self._buf = self._buf[self._pos:] + data
+                self._pos = 0
+                return
+        raise ValueError("unexpected end of file list")
+
+    def _read_byte(self):
+        if self._pos >= len(self._buf):
+            self._fill()
+        b = self._buf[self._pos]
+        self._pos += 1
+        return b if isinstance(b, int) else ord(b)
+
+    def _read_bytes(self, n):
+        while len(self._buf) - self._pos < n:
+            self._fill()
+        data = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+    def _read_varint(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self._read_byte()
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def _read_zigzag(self):
+        n = self._read_varint()
+        return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+
 class ReplicateServer:
     def __init__(self, file_config):
         self.module_files = {}
@@ -431,6 +1215,9 @@ class ReplicateServer:
             backup_dir = item['backup-dir'] if 'backup-dir' in item else None
             recursive = item['recursive'] if 'recursive' in item else False
             modified_before = item['modified-before'] if 'modified-before' in item else 120
+            watch = item['watch'] if 'watch' in item else True
+            reconcile_interval = item['reconcile-interval'] if 'reconcile-interval' in item else 3600
+            journal_size = item['journal-size'] if 'journal-size' in item else 100000
             self.module_files[item['name']] = ModuleFiles(item['name'],
                                                           item['dir'],
                                                           recursive,
@@ -438,7 +1225,10 @@ class ReplicateServer:
                                                           inc_patterns,
                                                           exc_patterns,
                                                           modified_before,
-                                                          update_interval)
+                                                          update_interval,
+                                                          watch,
+                                                          reconcile_interval,
+                                                          journal_size)
 
     def get_files(self):
         """
@@ -452,13 +1242,51 @@ class ReplicateServer:
             "backups": {"/module/backup-1":[file-size, file-last-modified-time],
                         "/module/backup-2":[file-size, file-last-modified-time]}
         }
+
+        if the module is specified, the "epoch" and "generation" of the module journal are also returned.
+        A client can pass them back with "epoch" and "since" parameters to get only the changed
+        files, see ModuleFiles.get_files_since()
+
+        if the module is specified and the client accepts FILE_LIST_MIME_TYPE, the files are streamed in
+        the compact format(see FileListEncoder) and the "epoch", "generation" and "delta" are returned in
+        the X-File-List-Epoch, X-File-List-Generation and X-File-List-Delta headers
         """
         time_within = int(request.args['within']) if 'within' in request.args else 0
         module_name = request.args['module'] if 'module' in request.args else None
+        if module_name in self.module_files:
+            epoch = request.args['epoch'] if 'epoch' in request.args else None
+            since = int(request.args['since']) if 'since' in request.args else None
+            logger.info("get files of module {} since generation {}".format(module_name, since))
+            files = self.module_files[module_name].get_files_since(epoch, since, time_within)
+            if FILE_LIST_MIME_TYPE in request.headers.get('Accept', ''):
+                return self._create_file_list_response(files)
+            files['files'] = dict(files['files'])
+            files['backups'] = dict(files['backups'])
+            return Response(json.dumps(files), status=200, mimetype='application/json')
         logger.info("get all files for all modules")
         with self._lock:
             all_files = self._get_module_files_within(module_name, time_within)
-            return Response(json.dumps(all_files), status=200, mimetype='application/json')
+        return Response(json.dumps(all_files), status=200, mimetype='application/json')
+
+    @classmethod
+    def _create_file_list_response(cls, files):
+        """
+        create a streaming response with the files in the compact format
+        """
+        headers = {"X-File-List-Epoch": files['epoch'],
+                   "X-File-List-Generation": str(files['generation']),
+                   "X-File-List-Delta": "true" if files['delta'] else "false"}
+        accept_encodings = [item.split(';')[0].strip() for item in request.headers.get('Accept-Encoding', '').split(',')]
+        compression = None
+        for encoding in get_file_list_encodings():
+            if encoding in accept_encodings:
+                compression = encoding
+                headers['Content-Encoding'] = encoding
+                break
+        return Response(FileListEncoder(compression).encode(files),
+                        status=200,
+                        mimetype=FILE_LIST_MIME_TYPE,
+                        headers=headers)
 
     def update_files(self):
         """
@@ -505,6 +1333,11 @@ class ReplicateServer:
         """
         process download file request from http client
 
+        the standard Range header is supported. If the "offset" parameter is provided and the data
+        before the offset matches the optional "checksum" parameter(see get_prefix_checksum()), only the
+        data after the offset is sent with status 206 and the "FileOffset" header. Otherwise the whole
+        file is sent
+
         :return: the file content response object
         """
         if 'file' not in request.args:
@@ -513,8 +1346,16 @@ class ReplicateServer:
         filename = self._get_download_file_abspath(name)
         if filename is None or not os.path.exists(filename):
             return "Not found", 404
+        offset = int(request.args['offset']) if 'offset' in request.args else 0
+        checksum = request.args['checksum'] if 'checksum' in request.args else None
         try:
-            r = flask.send_file(filename)
+            stat_info = os.stat(filename)
+            if offset > 0 and is_resumable(filename, offset, checksum):
+                r = self._send_file_from_offset(filename, offset, stat_info.st_size)
+            else:
+                r = flask.send_file(filename, conditional=True)
+            r.headers["FileLastAccessTime"] = str(stat_info.st_atime)
+            r.headers["FileLastModifiedTime"] = str(stat_info.st_mtime)
             event_stat.clear("send_file_failure")
             return r
         except Exception as ex:
@@ -522,6 +1363,28 @@ class ReplicateServer:
             event_stat.increase("send_file_failure")
             raise ex
 
+    @classmethod
+    def _send_file_from_offset(cls, filename, offset, size):
+        """
+        send the data of file in [offset, size)
+        """
+
+        def read_file():
+            with open(filename, "rb") as fp:
+                fp.seek(offset)
+                remaining = size - offset
+                while remaining > 0:
+                    data = fp.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+
+        headers = {"FileOffset": str(offset),
+                   "Content-Length": str(size - offset),
+                   "Content-Range": "bytes {}-{}/{}".format(offset, size - 1, size)}
+        return Response(read_file(), status=206, mimetype="application/octet-stream", headers=headers)
+
     def async_push_file(self):
         """
         process the async push request from http client
@@ -537,7 +1400,9 @@ class ReplicateServer:
             url = item['url']
             filename = item['file']
             push_request = {"filename": self._get_download_file_abspath(filename),
-                            "url": '{}?file={}'.format(url, filename)}
+                            "url": '{}?file={}'.format(url, filename),
+                            "offset": item.get('offset', 0),
+                            "checksum": item.get('checksum')}
             push_requests.append(push_request)
         if self.async_push.add_requests(push_requests):
             return "schedule for push", 200
@@ -556,7 +1421,11 @@ class ReplicateServer:
 
     def _start_file_retrieve(self):
         while True:
-            self._retrieve_files()
+            try:
+                self._retrieve_files()
+            except Exception as ex:
+                logger.error("fail to retrieve the files with error {}".format(ex))
+                traceback.print_exc()
             time.sleep(10)
 
     def _retrieve_files(self, force=False):
@@ -567,7 +1436,14 @@ class ReplicateServer:
         """
         files = {}
         for module_name in self.module_files:
-            files[module_name] = self.module_files[module_name].update_files(force)
+            try:
+                files[module_name] = self.module_files[module_name].update_files(force)
+            except Exception as ex:
+                logger.error("fail to update the files of module {} with error {}".format(module_name, ex))
+                traceback.print_exc()
+                with self._lock:
+                    if module_name in self.files:
+                        files[module_name] = self.files[module_name]
 
         with self._lock:
             self.files = files
@@ -586,7 +1462,10 @@ def load_server_file_config(filename):
         "modified-before": 120,
         "include-patterns": [ ".+\\.txt"],
         "exclude-patterns": [ ".+\\.tmp"],
-        "update-interval": 300
+        "update-interval": 300,
+        "watch": true,
+        "reconcile-interval": 3600,
+        "journal-size": 100000
       },
       {
         "name": "the module name",
@@ -596,15 +1475,25 @@ def load_server_file_config(filename):
         "modified-before": 120,
         "include-patterns": [ ".+\\.txt"],
         "exclude-patterns": [ ".+\\.tmp"],
-        "update-interval": 300
+        "update-interval": 300,
+        "watch": true,
+        "reconcile-interval": 3600,
+        "journal-size": 100000
       }
     ]
+
+    the changes of "dir" and "backup-dir" are watched with inotify if "watch" is true(the default) and
+    the inotify_simple package is installed, a full scan is done every "reconcile-interval" seconds then.
+    The last "journal-size" file changes are kept for the delta listing
+    
     """
     with open(filename) as fp:
         return json.load(fp)
 
 
 def run_server(args):
+    # keep the connections alive for the clients downloading files with DownloadEngine
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     replicate_server = ReplicateServer(load_server_file_config(args.file_config))
     app = flask.Flask(__name__)
     app.add_url_rule("/list", "list", replicate_server.get_files, methods=['GET'])
@@ -638,22 +1527,193 @@ def load_push_config(filename):
         return json.load(fp)
 
 
+TEMP_FILE_SUFFIX = ".replicating"
+
+
+class DirectorySyncer:
+    """
+    fsync the directories with group commit
+
+    the directories asked to be synced by the concurrent callers are collected into a batch and
+    synced by one of the callers, the others wait until the batch containing their directory is synced
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending_dirs = set()
+        self._collecting_batch = 0
+        self._synced_batch = -1
+        self._syncing = False
+
+    def sync(self, dirname):
+        """
+        fsync the directory and wait until it is done
+        """
+        with self._cond:
+            self._pending_dirs.add(dirname)
+            batch = self._collecting_batch
+            while self._synced_batch < batch:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                dirs = self._pending_dirs
+                self._pending_dirs = set()
+                synced_batch = self._collecting_batch
+                self._collecting_batch += 1
+                self._cond.release()
+                try:
+                    self._sync_dirs(dirs)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._synced_batch = synced_batch
+                    self._cond.notify_all()
+
+    @classmethod
+    def _sync_dirs(cls, dirs):
+        for dirname in dirs:
+            try:
+                fd = os.open(dirname, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except Exception as ex:
+                logger.error("fail to fsync directory {} with error:{}".format(dirname, ex))
+        if len(dirs) > 1:
+            logger.debug("{} directories are synced in one batch".format(len(dirs)))
+
+
+class FileSaver:
+    """
+    save the replicated files to local disk
+
+    A file is written to a temporary file in the same directory and then renamed to the real file, so
+    a half-written file is never seen with the real name. If fsync is enabled, the file data is synced
+    before the rename and the directory is synced after it with the group commit of DirectorySyncer
+    """
+
+    def __init__(self, buffer_size=1024 * 1024, preallocate=False, fsync=True):
+        """
+        :param buffer_size: the buffer size to copy the data
+        :param preallocate: True to preallocate the disk space of file if its size is known
+        :param fsync: True to fsync the file and its directory
+        """
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self.fsync = fsync
+        self._dir_syncer = DirectorySyncer()
+
+    def save(self, stream, filename, last_access_time, last_modified_time, offset=0, size=None):
+        """
+        save the data in the stream to local file
+        :param stream: the stream contains the file data
+        :param filename: the local file name
+        :param last_access_time: the file last access time
+        :param last_modified_time: the file last modified time
+        :param offset: if it is greater than 0, the data is appended to the file at the offset
+        :param size: the size of data in the stream if it is known
+        :return: True if save the data to file successfully
+        """
+        try:
+            if offset > 0:
+                if not self._append(stream, filename, offset, size):
+                    return False
+                os.utime(filename, (last_access_time, last_modified_time))
+            else:
+                self._write(stream, filename, last_access_time, last_modified_time, size)
+            return True
+        except Exception as ex:
+            logger.error("Fail to save to file {} with error:{}".format(filename, ex))
+        return False
+
+    def _write(self, stream, filename, last_access_time, last_modified_time, size):
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        temp_filename = os.path.join(dirname, ".{}.{}{}".format(os.path.basename(filename),
+                                                                uuid.uuid4().hex[0:8],
+                                                                TEMP_FILE_SUFFIX))
+        try:
+            fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with os.fdopen(fd, "wb") as fp:
+                if self.preallocate and size is not None and size > 0:
+                    os.posix_fallocate(fd, 0, size)
+                written = self._copy(stream, fp)
+                fp.flush()
+                if size is not None and written != size:
+                    # the preallocated file must not be taken as complete
+                    os.ftruncate(fd, written)
+                    raise IOError("only {} of {} bytes are received".format(written, size))
+                if self.fsync:
+                    os.fsync(fd)
+            os.utime(temp_filename, (last_access_time, last_modified_time))
+            os.rename(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        if self.fsync:
+            self._dir_syncer.sync(dirname)
+
+    def _copy(self, stream, fp):
+        """
+        copy the data from the stream to the file
+        :return: the number of bytes written
+        """
+        written = 0
+        while True:
+            data = stream.read(self.buffer_size)
+            if not data:
+                return written
+            fp.write(data)
+            written += len(data)
+
+    def _append(self, stream, filename, offset, size=None):
+        """
+        append the data in the stream to the file at the offset
+
+        the file is truncated back to the offset if fail to append all the data, so a partial append
+        will not be taken as a bigger file
+        :return: True if the data is appended
+        """
+        with open(filename, "r+b") as fp:
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() != offset:
+                logger.error("the size of file {} is changed from {} to {}".format(filename, offset, fp.tell()))
+                return False
+            try:
+                written = self._copy(stream, fp)
+                if size is not None and written != size:
+                    raise IOError("only {} of {} bytes are received".format(written, size))
+                fp.flush()
+                if self.fsync:
+                    os.fsync(fp.fileno())
+            except Exception:
+                fp.truncate(offset)
+                raise
+        return True
+
+
 class PushServer:
     """
     A push server will be started in the client side to accept the file push operation from the server side
     """
 
-    def __init__(self, push_host, push_port, module_files, notifier):
+    def __init__(self, push_host, push_port, module_files, notifier, file_saver=None):
         """
         create a push server
         :param push_host: the listening host/ip
         :param push_port: the listening port
         :param notifier:
+        :param file_saver: the FileSaver to save the pushed files
         """
         self.push_host = push_host
         self.push_port = push_port
         self.module_files = module_files
         self.notifier = notifier
+        self.file_saver = file_saver or FileSaver()
 
     def start(self):
         app = flask.Flask(__name__)
@@ -682,9 +1742,14 @@ class PushServer:
 
         last_access_time = float(request.headers.get("FileLastAccessTime"))
         last_modified_time = float(request.headers.get("FileLastModifiedTime"))
+        offset = int(request.headers.get("FileOffset", 0))
         op_name = "save_file_{}".format(filename)
         operation_monitor.add_operation(op_name, 600)
-        save_success = self._save_request_stream_to_file(request.stream, filename, last_access_time, last_modified_time)
+        save_success = self._save_request_stream_to_file(request.stream,
+                                                         filename,
+                                                         last_access_time,
+                                                         last_modified_time,
+                                                         offset)
         operation_monitor.remove_operation(op_name)
 
         self._notify_file_saved(request.args['file'])
@@ -708,30 +1773,19 @@ class PushServer:
                 return self.module_files[module_name].get_abspath(filename)
         return None
 
-    @classmethod
-    def _save_request_stream_to_file(cls, stream, filename, last_access_time, last_modified_time):
+    def _save_request_stream_to_file(self, stream, filename, last_access_time, last_modified_time, offset=0):
         """
         save the data in the request to local file
         :param stream: the stream contains the file data
         :param filename: the local file name
         :param last_access_time: the file last access time
         :param last_modified_time: the file last modified time
+        :param offset: the offset to append the data, 0 to save the whole file
         :return: True if save the request data to file successfully
         """
-        dirname = os.path.dirname(filename)
-        try:
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-
-            with open(filename, "wb") as fp:
-                shutil.copyfileobj(stream, fp)
-
-            os.utime(filename, (last_access_time, last_modified_time))
-
+        if self.file_saver.save(stream, filename, last_access_time, last_modified_time, offset, request.content_length):
             logger.info("succeed to save module file %s to real file %s" % (request.args['file'], filename))
             return True
-        except Exception as ex:
-            logger.error("Fail to save to file {} with error:{}".format(filename, ex))
         return False
 
     def _notify_file_saved(self, filename):
@@ -888,6 +1942,202 @@ class BackupFiles:
         return len(self._backup_files)
 
 
+class DownloadEngine:
+    """
+    download the files from the replication servers with a bounded pool of workers
+
+    Every worker keeps one keep-alive connection per server and the number of concurrent downloads
+    from one server is limited. The result of every file is put to the completion queue of its batch,
+    so the caller waits on the queue instead of polling the local files
+    """
+
+    def __init__(self,
+                 module_files,
+                 notifier,
+                 workers=8,
+                 connections_per_server=4,
+                 timeout=300,
+                 ranged_download=True,
+                 prefix_checksum=True,
+                 file_saver=None):
+        """
+        :param module_files: the modules to save the downloaded files
+        :param notifier: called with the file name(with module) after the file is downloaded
+        :param workers: the number of download workers
+        :param connections_per_server: the max number of concurrent downloads from one server
+        :param timeout: the socket timeout in seconds
+        :param ranged_download: True to download only the missing tail of a file smaller in local
+        :param prefix_checksum: True to check the local data before the tail in server
+        :param file_saver: the FileSaver to save the downloaded files
+        """
+        self.module_files = module_files
+        self.notifier = notifier
+        self.connections_per_server = connections_per_server
+        self.timeout = timeout
+        self.ranged_download = ranged_download
+        self.prefix_checksum = prefix_checksum
+        self.file_saver = file_saver or FileSaver()
+        self._tasks = Queue()
+        self._server_slots = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            th = threading.Thread(target=self._start_download_worker)
+            th.daemon = True
+            th.start()
+
+    def download(self, server, server_port, files):
+        """
+        download the files from the server and wait until all of them are finished
+
+        :param server: the server name or ip
+        :param server_port: the server port
+        :param files: a dict of file name(with module) to [file-size, file-last-modified-time]
+        :return: the number of downloaded files
+        """
+        completion = Queue()
+        start = time.time()
+        for name in files:
+            self._tasks.put((server, server_port, name, files[name][0], completion))
+        downloaded_files = 0
+        downloaded_bytes = 0
+        for _ in range(len(files)):
+            success, size = completion.get()
+            if success:
+                downloaded_files += 1
+                downloaded_bytes += size
+        elapsed = max(time.time() - start, 0.001)
+        if len(files) > 0:
+            logger.info("download {} files({} bytes) from {}:{} in {:.3f} seconds, {:.2f} MB/s".format(
+                downloaded_files, downloaded_bytes, server, server_port, elapsed,
+                downloaded_bytes / elapsed / 1024 / 1024))
+        return downloaded_files
+
+    def get_stats(self):
+        """
+        get the download statistics of all servers
+        :return: a dict of "server:port" to {"files": n, "bytes": n, "seconds": n}. The seconds is the sum
+        of the download time of all the files
+        """
+        with self._lock:
+            return dict((key, dict(value)) for key, value in self._stats.items())
+
+    def _get_server_slots(self, server, server_port):
+        with self._lock:
+            key = (server, server_port)
+            if key not in self._server_slots:
+                self._server_slots[key] = threading.Semaphore(self.connections_per_server)
+            return self._server_slots[key]
+
+    def _start_download_worker(self):
+        connections = {}
+        while True:
+            server, server_port, name, remote_size, completion = self._tasks.get()
+            slots = self._get_server_slots(server, server_port)
+            slots.acquire()
+            op_name = "download_file_{}".format(name)
+            operation_monitor.add_operation(op_name, 600)
+            try:
+                completion.put(self._download_file(connections, server, server_port, name, remote_size))
+            except Exception as ex:
+                logger.error("Fail to download file {} with error {}".format(name, ex))
+                completion.put((False, 0))
+            finally:
+                operation_monitor.remove_operation(op_name)
+                slots.release()
+
+    def _download_file(self, connections, server, server_port, name, remote_size):
+        """
+        download a file with the keep-alive connection to the server
+        :return: a tuple (success, downloaded bytes)
+        """
+        filename = self._get_save_file(name)
+        if filename is None:
+            logger.error("no module to save the file {}".format(name))
+            return False, 0
+        url = "/download?file={}".format(quote(name))
+        if self.ranged_download:
+            offset, checksum = get_resume_offset(filename, remote_size, self.prefix_checksum)
+            if offset > 0:
+                url = "{}&offset={}".format(url, offset)
+            if checksum is not None:
+                url = "{}&checksum={}".format(url, checksum)
+        key = (server, server_port)
+        start = time.time()
+        for retry in range(2):
+            if key not in connections:
+                connections[key] = HTTPConnection(server, server_port, timeout=self.timeout)
+            conn = connections[key]
+            try:
+                conn.request("GET", url)
+                resp = conn.getresponse()
+            except Exception as ex:
+                # the keep-alive connection may be closed by the server, retry with a new connection
+                conn.close()
+                del connections[key]
+                if retry > 0:
+                    raise ex
+                continue
+            try:
+                result = self._save_response(resp, name, filename, key, start)
+            except Exception:
+                conn.close()
+                del connections[key]
+                raise
+            if not resp.isclosed():
+                # the response is not read completely, the connection can't be reused
+                conn.close()
+                del connections[key]
+            return result
+        return False, 0
+
+    def _save_response(self, resp, name, filename, key, start):
+        if resp.status == 404:
+            resp.read()
+            logger.error("the file {} does not exist in server {}:{}".format(name, key[0], key[1]))
+            self._notify_file_saved(name)
+            return True, 0
+        if resp.status // 100 != 2:
+            resp.read()
+            logger.error("fail to download file {} with status code {}".format(name, resp.status))
+            event_stat.increase("save_file_failure")
+            return False, 0
+        last_modified_time = float(resp.getheader("FileLastModifiedTime", time.time()))
+        last_access_time = float(resp.getheader("FileLastAccessTime", last_modified_time))
+        offset = int(resp.getheader("FileOffset", 0)) if resp.status == 206 else 0
+        size = resp.getheader("Content-Length")
+        if not self.file_saver.save(resp,
+                                    filename,
+                                    last_access_time,
+                                    last_modified_time,
+                                    offset,
+                                    int(size) if size is not None else None):
+            event_stat.increase("save_file_failure")
+            return False, 0
+        event_stat.clear("save_file_failure")
+        size = os.path.getsize(filename) - offset
+        logger.info("succeed to download module file {} to real file {} from offset {}".format(name,
+                                                                                              filename,
+                                                                                              offset))
+        self._notify_file_saved(name)
+        with self._lock:
+            stats = self._stats.setdefault("{}:{}".format(key[0], key[1]), {"files": 0, "bytes": 0, "seconds": 0})
+            stats["files"] += 1
+            stats["bytes"] += size
+            stats["seconds"] += time.time() - start
+        return True, size
+
+    def _get_save_file(self, name):
+        elements = split_path(name)
+        if len(elements) > 0 and elements[0] in self.module_files:
+            return self.module_files[elements[0]].get_abspath(name)
+        return None
+
+    def _notify_file_saved(self, name):
+        if self.notifier is not None:
+            self.notifier(name)
+
+
 class ReplicateClient:
     def __init__(self,
                  replicate_servers_discover,
@@ -896,7 +2146,14 @@ class ReplicateClient:
                  module_files,
                  unremovable_dirs,
                  backup_only_base_compare,
-                 time_within):
+                 time_within,
+                 list_format="compact",
+                 download_mode="pull",
+                 download_workers=8,
+                 connections_per_server=4,
+                 ranged_download=True,
+                 prefix_checksum=True,
+                 file_saver=None):
         """
         init a ReplicateClient with parameters
 
@@ -906,6 +2163,14 @@ class ReplicateClient:
         push_port - the listening port number
         module_files - the modules will be replicated to this node from master
         backup_only_base_compare - true if compare the basename part for backup files
+        list_format - "compact" to accept the compact file list format, "json" to use json only
+        download_mode - "pull" to download files from /download of server, "push" to ask the server
+                        to push files to the push server with /async_push
+        download_workers - the number of workers to download files in pull mode
+        connections_per_server - the max number of concurrent downloads from one server in pull mode
+        ranged_download - true to download only the missing tail of the files which are smaller in local
+        prefix_checksum - true to check the local data before the missing tail in server
+        file_saver - the FileSaver to save the downloaded files
         """
         self.replicate_servers_discover = replicate_servers_discover
         self.push_host = push_host
@@ -914,6 +2179,21 @@ class ReplicateClient:
         self.unremovable_dirs = unremovable_dirs or []
         self.backup_only_base_compare = backup_only_base_compare
         self.time_within = time_within
+        self.list_format = list_format
+        self.ranged_download = ranged_download
+        self.prefix_checksum = prefix_checksum
+        if download_mode == "pull":
+            self.download_engine = DownloadEngine(module_files,
+                                                  self.file_pushed,
+                                                  download_workers,
+                                                  connections_per_server,
+                                                  ranged_download=ranged_download,
+                                                  prefix_checksum=prefix_checksum,
+                                                  file_saver=file_saver)
+        else:
+            self.download_engine = None
+        # the remote module files got from the servers, keyed by (server, server_port, module_name)
+        self._remote_files = {}
 
     def start_replicate(self):
         """
@@ -936,6 +2216,7 @@ class ReplicateClient:
                             sleep_seconds.append(10)
                         else:
                             sleep_seconds.append(0)
+                        self._log_download_stats(server_name, server_port)
                     except Exception as ex:
                         logger.error(
                             "Fail to replicate files from server {}:{} to local with error:{} in module {}".format(
@@ -944,6 +2225,17 @@ class ReplicateClient:
 
             time.sleep(min(sleep_seconds))
 
+    def _log_download_stats(self, server, server_port):
+        """
+        log the total download statistics of the server
+        """
+        if self.download_engine is None:
+            return
+        stats = self.download_engine.get_stats().get("{}:{}".format(server, server_port))
+        if stats is not None:
+            logger.info("downloaded {} files({} bytes) from {}:{} in total, download time is {:.3f} seconds".format(
+                stats["files"], stats["bytes"], server, server_port, stats["seconds"]))
+
     def _replicate_module(self, server, server_port, module_name):
         """
         replicate modules files from remote server
@@ -962,24 +2254,26 @@ class ReplicateClient:
             logger.info("no remote files downloaded from server {}:{}".format(server, server_port))
             return 0
         else:
-            logger.info(
-                "in module {}, \n\tnumber of remote files is {}, "
-                "\n\tnumber of remote backup files is {}".format(module_name,
-                                                                 len(remote_files['files']),
-                                                                 len(remote_files['backups'])))
-            local_files = self.module_files[module_name].update_files()
+            logger.info("in module {}, \n\tnumber of remote backup files is {}".format(module_name,
+                                                                                     len(remote_files['backups'])))
+            # the local files are probed in the index instead of being copied
+            module_files = self.module_files[module_name]
+            module_files.update_files(copy=False)
+            local_file_count, local_backup_count = module_files.count_files()
             logger.info(
                 "in module {}, \n\tnumber of local files is {}, \n\tnumber of local backup files is {}".format(
-                    module_name, len(
-                        local_files['files']), len(local_files['backups'])))
+                    module_name, local_file_count, local_backup_count))
             backup_files = BackupFiles(remote_files['backups'], self.backup_only_base_compare)
-            local_backup_files = BackupFiles(local_files['backups'], self.backup_only_base_compare)
+            local_backup_files = BackupFiles(module_files.get_backups(), self.backup_only_base_compare)
 
             new_files = {}
             remote_in_local_backups = 0
             remote_in_remote_backups = 0
             existing_in_local = 0
-            for f in remote_files['files']:
+            remote_file_count = 0
+            # the remote files may be decoded from the response while iterating
+            for f, remote_file in remote_files['files']:
+                remote_file_count += 1
                 # if the remote file is in the deleted path, don't replicate it
                 if local_backup_files.exist(f):
                     remote_in_local_backups += 1
@@ -993,28 +2287,29 @@ class ReplicateClient:
                     continue
 
                 # if the remote file exists in the local directory
-                if f in local_files['files'] and local_files["files"][f][0] >= remote_files["files"][f][0]:
+                local_size = module_files.get_size(f)
+                if local_size is not None and local_size >= remote_file[0]:
                     existing_in_local += 1
                     logger.debug("the remote file {} is in local directory already, no download is needed".format(f))
                 else:
-                    new_files[f] = remote_files['files'][f]
-                    if f not in local_files["files"]:
+                    new_files[f] = remote_file
+                    if local_size is None:
                         logger.info("the remote file {} is not in local directory, download it".format(f))
                     else:
                         logger.info("the size of file {} in remote is bigger than in local, "
                                     "local size is {}, remote size is {}".format(f,
-                                                                                 local_files["files"][f][0],
-                                                                                 remote_files["files"][f][0]))
+                                                                                 local_size,
+                                                                                 remote_file[0]))
 
             logger.info(
                 "in module {}, \n\tnumber of remote files is {}, \n\tnumber of local files is {}, \n\tnumber of remote files in "
                 "local backups is {}, \n\tnumber of remote files in remote backups is {}, \n\tnumber of remote files in local "
                 "is {}, \n\tnumber of new files is {}, \n\t"
                 "number of remote backup files is {}".format(
-                    module_name, len(remote_files['files']), len(local_files['files']), remote_in_local_backups,
+                    module_name, remote_file_count, local_file_count, remote_in_local_backups,
                     remote_in_remote_backups, existing_in_local, len(new_files), len(backup_files)))
-            self._delete_files(local_backup_files, local_files['files'])
-            self._delete_files(backup_files, local_files['files'])
+            self._delete_files(local_backup_files, module_files.find_files(local_backup_files.exist))
+            self._delete_files(backup_files, module_files.find_files(backup_files.exist))
             op_name = "download_files_from_{}".format(server)
             operation_monitor.add_operation(op_name, 3600)
             downloaded_files = self._download_files(server, server_port, new_files)
@@ -1027,7 +2322,7 @@ class ReplicateClient:
         """
         delete the backup files from local
         :param backup_files: the backup_files files
-        :param local_files: the local files
+        :param local_files: the names of the local files
         :return:
         """
         dirs = set()
@@ -1060,11 +2355,21 @@ class ReplicateClient:
         """
         download the remote files to local
         """
+        if self.download_engine is not None:
+            return self.download_engine.download(server, server_port, files)
         url = "http://{}:{}/save".format(self.push_host, self.push_port)
         pushed_files = []
         pushed_files_info = {}
         for file in files:
-            pushed_files.append({"url": url, "file": file})
+            pushed_file = {"url": url, "file": file}
+            if self.ranged_download:
+                real_filename = self._get_real_filename(file)
+                if real_filename is not None:
+                    offset, checksum = get_resume_offset(real_filename, files[file][0], self.prefix_checksum)
+                    if offset > 0:
+                        pushed_file["offset"] = offset
+                        pushed_file["checksum"] = checksum
+            pushed_files.append(pushed_file)
             pushed_files_info[file] = files[file]
             if len(pushed_files) == 1000:
                 break
@@ -1149,24 +2454,99 @@ class ReplicateClient:
         """
         downlolad all files in one module
 
+        only the changes since last download are downloaded if the server supports it, and they
+        are merged to the files downloaded before
+
         :param server: the replication server name or ip
         :param server_port: the replication server port number
         :param module_name: the module name
         """
-        if self.time_within is None or self.time_within <= 0:
-            url = "http://{}:{}/list?module={}".format(server, server_port, module_name)
-        else:
-            url = "http://{}:{}/list?module={}&within={}".format(server, server_port, module_name, self.time_within)
+        key = (server, server_port, module_name)
+        remote_files = self._remote_files.get(key)
+        url = "http://{}:{}/list?module={}".format(server, server_port, module_name)
+        if self.time_within is not None and self.time_within > 0:
+            url = "{}&within={}".format(url, self.time_within)
+        if remote_files is not None:
+            url = "{}&epoch={}&since={}".format(url, remote_files['epoch'], remote_files['generation'])
+        headers = {}
+        if self.list_format == "compact":
+            headers = {"Accept": "{}, application/json".format(FILE_LIST_MIME_TYPE),
+                       "Accept-Encoding": ", ".join(get_file_list_encodings())}
         try:
             logger.info("start to download module files from {}".format(url))
-            resp = urlopen(url, timeout=300)
+            resp = urlopen(Request(url, headers=headers), timeout=300)
             if resp.getcode() / 100 in (2, 3):
-                data = resp.read()
-                return json.loads(data)
+                return self._merge_remote_files(key, self._read_module_files(resp))
         except Exception as ex:
             logger.error("fail to download files from {} in module {}:{}".format(url, module_name, ex))
         return None
 
+    @classmethod
+    def _read_module_files(cls, resp):
+        """
+        read the module files from the /list response
+
+        :return: a dict like the json response of /list except the "files" is an iterable of
+        (name, value) tuples. If the response is in compact format, the files are decoded
+        while they are iterated
+        """
+        info = resp.info()
+        if (info.get("Content-Type") or "").startswith(FILE_LIST_MIME_TYPE):
+            decoder = FileListDecoder(resp, info.get("Content-Encoding"))
+            generation = info.get("X-File-List-Generation")
+            return {"epoch": info.get("X-File-List-Epoch"),
+                    "generation": int(generation) if generation is not None else None,
+                    "delta": info.get("X-File-List-Delta") == "true",
+                    "backups": decoder.read_backups(),
+                    "files": decoder.read_files()}
+        files = json.loads(resp.read())
+        files['files'] = files['files'].items()
+        return files
+
+    def _merge_remote_files(self, key, files):
+        """
+        merge the downloaded files to the remote files got before
+
+        :param key: the (server, server_port, module_name) tuple
+        :param files: the files returned by _read_module_files()
+        :return: all the remote files, the "files" is an iterable of (name, value) tuples
+        """
+        remote_files = self._remote_files.pop(key, None)
+        if files.get('generation') is None:
+            # the server does not support the delta listing
+            return files
+        if not files.get('delta') or remote_files is None:
+            remote_files = {"epoch": files['epoch'],
+                            "generation": files['generation'],
+                            "files": {},
+                            "backups": files['backups']}
+            return {"backups": remote_files['backups'],
+                    "files": self._cache_remote_files(key, remote_files, files['files'])}
+        changes = 0
+        for kind, items in (('backups', files['backups'].items()), ('files', files['files'])):
+            for name, value in items:
+                changes += 1
+                if value is None:
+                    remote_files[kind].pop(name, None)
+                else:
+                    remote_files[kind][name] = value
+        logger.info("{} changed files are downloaded, the remote generation is {}".format(changes,
+                                                                                       files['generation']))
+        remote_files['generation'] = files['generation']
+        self._remote_files[key] = remote_files
+        return {"backups": remote_files['backups'], "files": remote_files['files'].items()}
+
+    def _cache_remote_files(self, key, remote_files, files):
+        """
+        cache the remote files while they are iterated
+
+        the cache is used by the next delta listing only after all the files are iterated
+        """
+        for name, value in files:
+            remote_files['files'][name] = value
+            yield name, value
+        self._remote_files[key] = remote_files
+
     @classmethod
     def _get_module_name(cls, name):
         """
@@ -1198,7 +2578,8 @@ def create_module_files_from_push_config(push_config):
         name = item['name']
         recursive = item['recursive'] if 'recursive' in item else False
         backup_dir = item['backup-dir'] if 'backup-dir' in item else None
-        module_files[name] = ModuleFiles(name, item['dir'], recursive, backup_dir, None, None, 0, 0)
+        watch = item['watch'] if 'watch' in item else True
+        module_files[name] = ModuleFiles(name, item['dir'], recursive, backup_dir, None, None, 0, 0, watch)
     return module_files
 
 
@@ -1269,6 +2650,7 @@ def run_client(args):
     time.sleep(2)
     replicate_server_discover = create_replicate_server_discovery(args.server_discovery)
     replicate_server_discover = ExcludeReplicateServersDiscover(replicate_server_discover, args.exclude_server)
+    file_saver = FileSaver(args.write_buffer_size, args.preallocate, not args.no_fsync)
 
     replicate_client = ReplicateClient(replicate_server_discover,
                                        args.push_host,
@@ -1276,17 +2658,61 @@ def run_client(args):
                                        module_files,
                                        unremovable_dirs,
                                        args.backup_only_base_compare,
-                                       time_within)
+                                       time_within,
+                                       args.list_format,
+                                       args.download_mode,
+                                       args.download_workers,
+                                       args.connections_per_server,
+                                       not args.disable_ranged_download,
+                                       not args.disable_prefix_checksum,
+                                       file_saver)
     push_server = PushServer(args.push_host,
                              args.push_port,
                              module_files,
-                             replicate_client.file_pushed)
+                             replicate_client.file_pushed,
+                             file_saver)
     th = threading.Thread(target=replicate_client.start_replicate)
     th.daemon = True
     th.start()
     push_server.start()
 
 
+def run_matcher_benchmark(args):
+    """
+    compare the FileNameMatcher with matching the patterns one by one with re.match() on a synthetic tree
+    """
+    random.seed(args.seed)
+    base_names = ["app", "access", "error", "gc", "audit", "core", "metrics", "trace"]
+    suffixes = [".log", ".log.1", ".log.2.gz", ".txt", ".tmp", ".json", ""]
+    names = []
+    for i in range(args.names):
+        # a tree with args.dirs directories, the names in different directories are partially duplicated
+        names.append("{}-{}{}".format(random.choice(base_names),
+                                      random.randint(0, args.names // args.dirs),
+                                      random.choice(suffixes)))
+    include_patterns = args.include_patterns
+    exclude_patterns = args.exclude_patterns
+
+    start = time.time()
+    expected = []
+    for name in names:
+        matched = len(include_patterns) <= 0 or any(re.match(p, name) is not None for p in include_patterns)
+        expected.append(matched and not any(re.match(p, name) is not None for p in exclude_patterns))
+    baseline_time = time.time() - start
+
+    matcher = FileNameMatcher(include_patterns, exclude_patterns)
+    start = time.time()
+    results = [matcher.match(name) for name in names]
+    matcher_time = time.time() - start
+
+    if results != expected:
+        print("the results of FileNameMatcher are different from re.match()")
+        sys.exit(1)
+    print("{} names, {} matched".format(len(names), sum(1 for r in results if r)))
+    print("re.match:        {:.3f} seconds, {:.0f} names/s".format(baseline_time, len(names) / baseline_time))
+    print("FileNameMatcher: {:.3f} seconds, {:.0f} names/s".format(matcher_time, len(names) / matcher_time))
+
+
 def parse_args():
     """
     parse the command line arguments
@@ -1347,6 +2773,39 @@ def parse_args():
                                nargs="*")
     client_parser.add_argument("--replicate-within",
                                help="replicate all files within 1d/1h/1m/10")
+    client_parser.add_argument("--list-format",
+                               help="the format of file list downloaded from server, default is compact",
+                               choices=["compact", "json"],
+                               default="compact")
+    client_parser.add_argument("--download-mode",
+                               help="pull: download files from server, push: ask server to push files to "
+                                    "the push server, default is pull",
+                               choices=["pull", "push"],
+                               default="pull")
+    client_parser.add_argument("--download-workers",
+                               help="the number of workers to download files in pull mode, default is 8",
+                               type=int,
+                               default=8)
+    client_parser.add_argument("--connections-per-server",
+                               help="the max concurrent downloads from one server in pull mode, default is 4",
+                               type=int,
+                               default=4)
+    client_parser.add_argument("--disable-ranged-download",
+                               help="always download the whole file even if the local file is a prefix of it",
+                               action="store_true")
+    client_parser.add_argument("--disable-prefix-checksum",
+                               help="don't check the local data before the missing tail of a file in server",
+                               action="store_true")
+    client_parser.add_argument("--write-buffer-size",
+                               help="the buffer size in bytes to write the replicated files, default is 1048576",
+                               type=int,
+                               default=1024 * 1024)
+    client_parser.add_argument("--preallocate",
+                               help="preallocate the disk space of the replicated files",
+                               action="store_true")
+    client_parser.add_argument("--no-fsync",
+                               help="don't fsync the replicated files and their directories",
+                               action="store_true")
     client_parser.add_argument("--log-file",
                                help="the log filename",
                                required=False)
@@ -1360,6 +2819,30 @@ def parse_args():
                                default="text")
     client_parser.set_defaults(func=run_client)
 
+    benchmark_parser = subparsers.add_parser("benchmark-matcher",
+                                             help="benchmark the include/exclude patterns matching")
+    benchmark_parser.add_argument("--names",
+                                  help="the number of file names, default is 1000000",
+                                  type=int,
+                                  default=1000000)
+    benchmark_parser.add_argument("--dirs",
+                                  help="the number of directories in the synthetic tree, default is 100",
+                                  type=int,
+                                  default=100)
+    benchmark_parser.add_argument("--include-patterns",
+                                  help="the include patterns",
+                                  nargs="*",
+                                  default=[".+\\.log$", ".+\\.log\\.[0-9]+(\\.gz)?$", "core-"])
+    benchmark_parser.add_argument("--exclude-patterns",
+                                  help="the exclude patterns",
+                                  nargs="*",
+                                  default=[".*\\.tmp$", "audit-.*"])
+    benchmark_parser.add_argument("--seed",
+                                  help="the random seed, default is 0",
+                                  type=int,
+                                  default=0)
+    benchmark_parser.set_defaults(func=run_matcher_benchmark, log_file=None, log_level="INFO", log_format="text")
+
     return parser.parse_args()
 
 
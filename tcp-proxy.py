@@ -1,31 +1,66 @@
 #!/usr/bin/python
 
+import errno
 import os
+import select
 import socket
+import subprocess
 import sys
-import thread
+import threading
+import time
 import argparse
 import logging
 import logging.handlers
-import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 logger = logging.getLogger( "tcp-proxy" )
 
+# os.splice() is available in python 3.10+ on linux
+SPLICE_AVAILABLE = hasattr( os, "splice" )
+
 def toHex( s ):
     r = []
-    for c in s:
-        t = hex( ord(c) )
+    for c in bytearray( s ):
+        t = hex( c )
         t = t.replace( '0x', '')
         if len( t ) == 1:
             t = "0%s" % t
         r.append(t)
     return "".join( r )
 
+def is_would_block( ex ):
+    return ex.errno in ( errno.EAGAIN, errno.EWOULDBLOCK )
+
+def raise_file_limit():
+    """
+    raise the limit of open files to the hard limit, every connection needs two sockets
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit( resource.RLIMIT_NOFILE )
+    if soft < hard:
+        try:
+            resource.setrlimit( resource.RLIMIT_NOFILE, ( hard, hard ) )
+        except ( ValueError, EnvironmentError ) as ex:
+            logger.error( "fail to raise the open file limit to %d with error %s" % ( hard, ex ) )
+
 class Debug:
     def __init__( self, debug, debug_format ):
         self._debug = debug
         self._debug_format = debug_format
 
+    def is_enabled( self ):
+        return self._debug
+
     def debug( self, src, dest, text ):
         if not self._debug:
             return
@@ -36,10 +71,16 @@ class Debug:
             logger.debug( "%s -> %s: %s" % (src, dest, toHex( text ) ) )
 
 class TcpProxy:
-    def __init__( self, proxy_host, proxy_port, debug ):
+    """
+    forward the connections with two threads per connection, one thread for each direction
+    """
+    def __init__( self, proxy_host, proxy_port, debug, buffer_size = 2048, backlog = 10 ):
         self.proxy_host = proxy_host
         self.proxy_port = proxy_port
         self._debug = debug
+        self.buffer_size = buffer_size
+        self.backlog = backlog
+
     def connect_remote_proxy( self ):
         addrinfo = socket.getaddrinfo( self.proxy_host, self.proxy_port )
         s = socket.socket(addrinfo[0][0], socket.SOCK_STREAM)
@@ -49,10 +90,11 @@ class TcpProxy:
     def do_proxy( self, conn ):
         try:
             remote_proxy_conn = self.connect_remote_proxy()
-            thread.start_new_thread( self.do_forward, (conn, remote_proxy_conn ) )
-            thread.start_new_thread( self.do_forward, (remote_proxy_conn, conn ) )
+            self._start_thread( self.do_forward, (conn, remote_proxy_conn ) )
+            self._start_thread( self.do_forward, (remote_proxy_conn, conn ) )
         except Exception as ex:
-            print ex
+            logger.error( "fail to proxy connection with error %s" % ex )
+            conn.close()
 
     def do_forward(self, recv_conn, forward_conn):
         try:
@@ -61,11 +103,12 @@ class TcpProxy:
             dest = forward_conn.getpeername()
             dest = "%s:%s" % ( dest[0], dest[1] )
             while True:
-                data = recv_conn.recv(2048)
+                data = recv_conn.recv( self.buffer_size )
                 if data:
                     forward_conn.sendall(data )
                     self._debug.debug( src, dest, data )
                 else:
+                    forward_conn.shutdown( socket.SHUT_WR )
                     break
         except:
             pass
@@ -76,28 +119,510 @@ class TcpProxy:
             listen_ok = False
             s = socket.socket( item[0], socket.SOCK_STREAM )
             try:
+                s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
                 s.bind((item[4][0], item[4][1]))
-                s.listen( 10 )
+                s.listen( self.backlog )
                 listen_ok = True
                 while True:
                     conn, remote_addr = s.accept()
                     self.do_proxy( conn )
             except Exception as ex:
-                print ex
+                logger.error( "%s" % ex )
             try:
                 s.close()
             except:
                 pass
             if listen_ok: break
 
+    def _start_thread( self, target, args ):
+        th = threading.Thread( target = target, args = args )
+        th.daemon = True
+        th.start()
+
+class Poller:
+    """
+    wait for the socket events with epoll if it is available, otherwise with poll
+    """
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+    def __init__( self ):
+        if hasattr( select, "epoll" ):
+            self._poller = select.epoll()
+            self._timeout_scale = 1
+        else:
+            self._poller = select.poll()
+            self._timeout_scale = 1000
+
+    def register( self, fd, events ):
+        self._poller.register( fd, events )
+
+    def modify( self, fd, events ):
+        self._poller.modify( fd, events )
+
+    def unregister( self, fd ):
+        self._poller.unregister( fd )
+
+    def poll( self, timeout ):
+        """
+        return: a list of ( fd, events )
+        """
+        return self._poller.poll( timeout * self._timeout_scale )
+
+class Direction:
+    """
+    forward the data from the src socket to the dest socket
+
+    if splice is enabled, the data is moved by os.splice() through a pipe without copying to user space,
+    otherwise it is copied by recv()/send(). The src is not read until all the data read before is written
+    to dest, so a slow receiver slows down the sender.
+    """
+    def __init__( self, src, dest, buffer_size, splice, debug ):
+        self.src = src
+        self.dest = dest
+        self.buffer_size = buffer_size
+        self.debug = debug
+        self.pending = None
+        self.pipe = None
+        self.pipe_size = 0
+        # the src returns EOF
+        self.eof = False
+        # the dest is shutdown for writing after EOF
+        self.closed = False
+        self.bytes = 0
+        if splice:
+            self.pipe = os.pipe()
+            for fd in self.pipe:
+                fcntl.fcntl( fd, fcntl.F_SETFL, fcntl.fcntl( fd, fcntl.F_GETFL ) | os.O_NONBLOCK )
+            if hasattr( fcntl, "F_SETPIPE_SZ" ):
+                try:
+                    fcntl.fcntl( self.pipe[1], fcntl.F_SETPIPE_SZ, buffer_size )
+                except EnvironmentError:
+                    pass
+
+    def has_pending( self ):
+        return self.pipe_size > 0 or self.pending is not None
+
+    def want_read( self ):
+        return not self.eof and not self.has_pending()
+
+    def want_write( self ):
+        return self.has_pending()
+
+    def on_readable( self ):
+        """
+        read the data from src and write it to dest as much as possible
+
+        return: the number of bytes read
+        """
+        try:
+            if self.pipe is not None:
+                n = os.splice( self.src.fileno(), self.pipe[1], self.buffer_size, flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK )
+                self.pipe_size += n
+            else:
+                data = self.src.recv( self.buffer_size )
+                n = len( data )
+                if n > 0:
+                    self.pending = memoryview( data )
+                    self._debug( data )
+        except EnvironmentError as ex:
+            if is_would_block( ex ):
+                return 0
+            raise
+        if n == 0:
+            self.eof = True
+        self.bytes += n
+        self.on_writable()
+        return n
+
+    def on_writable( self ):
+        """
+        write the pending data to dest, shutdown dest for writing if all the data from src is written
+        """
+        try:
+            while self.pipe_size > 0:
+                self.pipe_size -= os.splice( self.pipe[0], self.dest.fileno(), self.pipe_size, flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK )
+            while self.pending is not None:
+                n = self.dest.send( self.pending )
+                self.pending = self.pending[n:] if n < len( self.pending ) else None
+        except EnvironmentError as ex:
+            if not is_would_block( ex ):
+                raise
+        if self.eof and not self.has_pending() and not self.closed:
+            self.closed = True
+            try:
+                self.dest.shutdown( socket.SHUT_WR )
+            except EnvironmentError:
+                pass
+
+    def close( self ):
+        if self.pipe is not None:
+            os.close( self.pipe[0] )
+            os.close( self.pipe[1] )
+            self.pipe = None
+
+    def _debug( self, data ):
+        if self.debug.is_enabled():
+            self.debug.debug( self.src.getpeername(), self.dest.getpeername(), data )
+
+class Session:
+    """
+    a client connection and its upstream connection
+    """
+    def __init__( self, client, client_addr ):
+        self.client = client
+        self.client_addr = client_addr
+        self.upstream = None
+        self.connecting = True
+        self.to_upstream = None
+        self.to_client = None
+        self.start_time = time.time()
+        self.connect_time = None
+        self.last_active = self.start_time
+
+    def is_closed( self ):
+        return self.to_upstream is not None and self.to_upstream.closed and self.to_client.closed
+
+    def get_events( self, sock ):
+        """
+        get the events waited on the socket
+        """
+        if self.connecting:
+            return Poller.WRITE if sock is self.upstream else 0
+        src, dest = ( self.to_upstream, self.to_client ) if sock is self.client else ( self.to_client, self.to_upstream )
+        return ( Poller.READ if src.want_read() else 0 ) | ( Poller.WRITE if dest.want_write() else 0 )
+
+class EventTcpProxy:
+    """
+    forward all the connections in one thread with epoll/poll and non-blocking sockets
+    """
+    def __init__( self, proxy_host, proxy_port, debug, buffer_size = 256 * 1024, backlog = 4096,
+                  idle_timeout = 0, splice = True, stats_interval = 0 ):
+        """
+        proxy_host, proxy_port: the upstream address
+        buffer_size: the max number of bytes forwarded in one read
+        backlog: the listen backlog
+        idle_timeout: close the connection if no data is forwarded in idle_timeout seconds, 0 for never
+        splice: forward the data with os.splice() if it is available, it is disabled in debug mode
+        stats_interval: log the statistics every stats_interval seconds, 0 for never
+        """
+        self.proxy_addr = socket.getaddrinfo( proxy_host, proxy_port, 0, socket.SOCK_STREAM )[0]
+        self._debug = debug
+        self.buffer_size = buffer_size
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.splice = splice and SPLICE_AVAILABLE and fcntl is not None and not debug.is_enabled()
+        self.stats_interval = stats_interval
+        self._poller = Poller()
+        # fd => session
+        self._sessions = {}
+        self.stats = { "accepted": 0, "closed": 0, "failed": 0, "bytes_up": 0, "bytes_down": 0 }
+
+    def create_listener( self, addr, port ):
+        addrinfo = socket.getaddrinfo( addr, port, 0, socket.SOCK_STREAM )
+        for item in addrinfo:
+            s = socket.socket( item[0], socket.SOCK_STREAM )
+            try:
+                s.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+                s.bind( item[4] )
+                s.listen( self.backlog )
+            except Exception as ex:
+                logger.error( "fail to listen on %s with error %s" % ( item[4], ex ) )
+                s.close()
+                continue
+            s.setblocking( False )
+            logger.info( "listen on %s, splice is %s" % ( item[4], "enabled" if self.splice else "disabled" ) )
+            self.run( s )
+            return
+
+    def run( self, listener ):
+        self._poller.register( listener.fileno(), Poller.READ )
+        last_check = last_stats = time.time()
+        while True:
+            for fd, events in self._poller.poll( 1 ):
+                if fd == listener.fileno():
+                    self._accept( listener )
+                elif fd in self._sessions:
+                    self._handle_event( self._sessions[fd], fd, events )
+            now = time.time()
+            if now - last_check >= 1:
+                self._check_idle( now )
+                if self.stats_interval > 0 and now - last_stats >= self.stats_interval:
+                    self._log_stats()
+                    last_stats = now
+                last_check = now
+
+    def _accept( self, listener ):
+        while True:
+            try:
+                client, client_addr = listener.accept()
+            except EnvironmentError as ex:
+                if not is_would_block( ex ) and ex.errno != errno.ECONNABORTED:
+                    logger.error( "fail to accept connection with error %s" % ex )
+                return
+            self.stats["accepted"] += 1
+            client.setblocking( False )
+            session = Session( client, client_addr )
+            try:
+                upstream = socket.socket( self.proxy_addr[0], socket.SOCK_STREAM )
+            except EnvironmentError as ex:
+                logger.error( "fail to create upstream socket with error %s" % ex )
+                client.close()
+                self.stats["failed"] += 1
+                continue
+            upstream.setblocking( False )
+            session.upstream = upstream
+            self._sessions[ client.fileno() ] = session
+            self._sessions[ upstream.fileno() ] = session
+            self._poller.register( client.fileno(), 0 )
+            self._poller.register( upstream.fileno(), 0 )
+            err = upstream.connect_ex( self.proxy_addr[4] )
+            if err not in ( 0, errno.EINPROGRESS, errno.EWOULDBLOCK ):
+                self._close_session( session, "fail to connect upstream: %s" % os.strerror( err ) )
+                continue
+            self._update_events( session )
+
+    def _handle_event( self, session, fd, events ):
+        try:
+            sock = session.client if fd == session.client.fileno() else session.upstream
+            if session.connecting:
+                err = session.upstream.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+                if err != 0:
+                    self._close_session( session, "fail to connect upstream: %s" % os.strerror( err ) )
+                    return
+                self._on_connected( session )
+            else:
+                src, dest = ( session.to_upstream, session.to_client ) if sock is session.client else ( session.to_client, session.to_upstream )
+                if events & ( Poller.READ | Poller.ERROR ) and src.want_read():
+                    src.on_readable()
+                if events & Poller.WRITE and dest.want_write():
+                    dest.on_writable()
+                if events & Poller.ERROR and not events & ( Poller.READ | Poller.WRITE ):
+                    self._close_session( session, "connection is closed" )
+                    return
+            session.last_active = time.time()
+            if session.is_closed():
+                self._close_session( session )
+            else:
+                self._update_events( session )
+        except EnvironmentError as ex:
+            self._close_session( session, "%s" % ex )
+
+    def _on_connected( self, session ):
+        session.connecting = False
+        session.connect_time = time.time()
+        session.to_upstream = Direction( session.client, session.upstream, self.buffer_size, self.splice, self._debug )
+        session.to_client = Direction( session.upstream, session.client, self.buffer_size, self.splice, self._debug )
+
+    def _update_events( self, session ):
+        for sock in ( session.client, session.upstream ):
+            self._poller.modify( sock.fileno(), session.get_events( sock ) )
+
+    def _check_idle( self, now ):
+        if self.idle_timeout <= 0:
+            return
+        idle_sessions = set( [ session for session in self._sessions.values() if now - session.last_active > self.idle_timeout ] )
+        for session in idle_sessions:
+            self._close_session( session, "idle timeout" )
+
+    def _close_session( self, session, error = None ):
+        for sock in ( session.client, session.upstream ):
+            if sock is None: continue
+            fd = sock.fileno()
+            if fd in self._sessions:
+                del self._sessions[fd]
+                self._poller.unregister( fd )
+            sock.close()
+        bytes_up = bytes_down = 0
+        for direction in ( session.to_upstream, session.to_client ):
+            if direction is not None:
+                direction.close()
+        if session.to_upstream is not None:
+            bytes_up, bytes_down = session.to_upstream.bytes, session.to_client.bytes
+        self.stats["closed"] += 1
+        self.stats["bytes_up"] += bytes_up
+        self.stats["bytes_down"] += bytes_down
+        if error is not None:
+            self.stats["failed"] += 1
+        if self._debug.is_enabled() or ( error is not None and session.connect_time is None ):
+            logger.info( "connection from %s closed%s: %d bytes up, %d bytes down, connect %s, duration %.3fs" % (
+                session.client_addr, "" if error is None else " with error %s" % error, bytes_up, bytes_down,
+                "%.1fms" % ( ( session.connect_time - session.start_time ) * 1000 ) if session.connect_time else "-",
+                time.time() - session.start_time ) )
+
+    def _log_stats( self ):
+        logger.info( "active connections: %d, accepted: %d, closed: %d, failed: %d, bytes up: %d, bytes down: %d" % (
+            len( self._sessions ) // 2, self.stats["accepted"], self.stats["closed"], self.stats["failed"],
+            self.stats["bytes_up"], self.stats["bytes_down"] ) )
+
+class BenchmarkEchoServer:
+    """
+    the upstream server of benchmark, it echoes all the received data
+    """
+    def __init__( self, buffer_size ):
+        self.listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.listener.bind( ( "127.0.0.1", 0 ) )
+        self.listener.listen( 4096 )
+        self.listener.setblocking( False )
+        self.port = self.listener.getsockname()[1]
+        self.buffer_size = buffer_size
+        self._poller = Poller()
+        self._echoes = {}
+        th = threading.Thread( target = self._run )
+        th.daemon = True
+        th.start()
+
+    def _run( self ):
+        debug = Debug( False, "text" )
+        self._poller.register( self.listener.fileno(), Poller.READ )
+        while True:
+            for fd, events in self._poller.poll( 1 ):
+                if fd == self.listener.fileno():
+                    try:
+                        while True:
+                            conn, addr = self.listener.accept()
+                            conn.setblocking( False )
+                            self._echoes[ conn.fileno() ] = Direction( conn, conn, self.buffer_size, False, debug )
+                            self._poller.register( conn.fileno(), Poller.READ )
+                    except EnvironmentError:
+                        pass
+                    continue
+                echo = self._echoes[fd]
+                try:
+                    if echo.want_read():
+                        echo.on_readable()
+                    elif echo.want_write():
+                        echo.on_writable()
+                except EnvironmentError:
+                    echo.eof = echo.closed = True
+                if echo.closed:
+                    self._poller.unregister( fd )
+                    del self._echoes[fd]
+                    echo.src.close()
+                else:
+                    self._poller.modify( fd, ( Poller.READ if echo.want_read() else 0 ) | ( Poller.WRITE if echo.want_write() else 0 ) )
+
+def measure_throughput( port, total_bytes, streams ):
+    """
+    send total_bytes through the proxy in streams connections and read the echoed data
+
+    return: the forwarded bytes per second in both directions
+    """
+    data = b"x" * ( 256 * 1024 )
+    per_stream = total_bytes // streams
+
+    def send( sock ):
+        sent = 0
+        while sent < per_stream:
+            n = min( len( data ), per_stream - sent )
+            sock.sendall( data[:n] )
+            sent += n
+
+    def receive( sock ):
+        received = 0
+        while received < per_stream:
+            n = len( sock.recv( 256 * 1024 ) )
+            if n == 0: break
+            received += n
+
+    socks = [ socket.create_connection( ( "127.0.0.1", port ) ) for i in range( streams ) ]
+    start = time.time()
+    threads = [ threading.Thread( target = func, args = ( sock, ) ) for sock in socks for func in ( send, receive ) ]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    elapsed = time.time() - start
+    for sock in socks: sock.close()
+    return 2 * per_stream * streams / elapsed
+
+def measure_capacity( port, connections ):
+    """
+    open connections through the proxy and keep them open, every connection makes a round trip
+
+    return: a tuple ( the number of connections opened successfully, average round trip in ms )
+    """
+    socks = []
+    round_trip = 0
+    try:
+        for i in range( connections ):
+            start = time.time()
+            sock = socket.create_connection( ( "127.0.0.1", port ), timeout = 5 )
+            socks.append( sock )
+            sock.sendall( b"ping" )
+            if sock.recv( 4 ) != b"ping":
+                break
+            round_trip += time.time() - start
+    except EnvironmentError as ex:
+        logger.info( "connection %d failed with error %s" % ( len( socks ), ex ) )
+    for sock in socks: sock.close()
+    n = len( socks )
+    return n, round_trip * 1000 / n if n > 0 else 0
+
+def wait_listening( port, timeout = 10 ):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection( ( "127.0.0.1", port ), timeout = 1 ).close()
+            return True
+        except EnvironmentError:
+            time.sleep( 0.1 )
+    return False
+
+def get_free_port():
+    s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    s.bind( ( "127.0.0.1", 0 ) )
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def run_benchmark( args ):
+    """
+    compare the thread engine and the event engine on localhost
+    """
+    raise_file_limit()
+    server = BenchmarkEchoServer( args.buffer_size )
+    engines = [ ( "thread", [] ), ( "event", [ "--no-splice" ] ) ]
+    if SPLICE_AVAILABLE:
+        engines.append( ( "event", [] ) )
+    for engine, options in engines:
+        port = get_free_port()
+        command = [ sys.executable, os.path.abspath( __file__ ), "--listen", "127.0.0.1:%d" % port, "--proxy", "127.0.0.1:%d" % server.port,
+                    "--engine", engine, "--buffer-size", str( args.buffer_size ), "--backlog", str( args.backlog ) ] + options
+        proc = subprocess.Popen( command )
+        try:
+            if not wait_listening( port ):
+                logger.error( "the %s proxy is not started" % engine )
+                continue
+            throughput = measure_throughput( port, args.benchmark_bytes, args.benchmark_streams )
+            opened, round_trip = measure_capacity( port, args.benchmark_connections )
+            name = engine if engine == "thread" else "event%s" % ( "" if options else "+splice" )
+            logger.info( "%-13s throughput: %8.1f MB/s, connections: %d/%d, average connect+round trip: %.2f ms" % (
+                name, throughput / 1024 / 1024, opened, args.benchmark_connections, round_trip ) )
+        finally:
+            proc.terminate()
+            proc.wait()
+
 def parse_args():
     parser = argparse.ArgumentParser( description = "TCP proxy" )
-    parser.add_argument( "--listen", help = "the listen address in IP:PORT format", required = True )
-    parser.add_argument( "--proxy", help = "the proxy address in IP:PORT format", required = True )
+    parser.add_argument( "--listen", help = "the listen address in IP:PORT format" )
+    parser.add_argument( "--proxy", help = "the proxy address in IP:PORT format" )
+    parser.add_argument( "--engine", help = "the forwarding engine, event: all connections in one thread with epoll, thread: two threads per connection, default is event", choices = ["event", "thread"], default = "event" )
+    parser.add_argument( "--buffer-size", help = "the max bytes forwarded in one read, default is 262144", type = int, default = 256 * 1024 )
+    parser.add_argument( "--backlog", help = "the listen backlog, default is 4096", type = int, default = 4096 )
+    parser.add_argument( "--idle-timeout", help = "close the connection if no data is forwarded in the seconds, default is 0 for never", type = int, default = 0 )
+    parser.add_argument( "--no-splice", help = "do not forward data with splice in event engine", action = "store_true" )
+    parser.add_argument( "--stats-interval", help = "log the statistics every N seconds, default is 0 for never", type = int, default = 0 )
     parser.add_argument( "--debug", "-d", action = "store_true", help = "in debug mode", required = False )
     parser.add_argument( "--debug-format", help = "the output data format in debug", choices = ["text", "hex"], default = "text" )
     parser.add_argument( "--log-file", help = "the log file", required = False )
-    return parser.parse_args()
+    parser.add_argument( "--benchmark", help = "compare the throughput and connection capacity of the engines on localhost", action = "store_true" )
+    parser.add_argument( "--benchmark-bytes", help = "the bytes sent in throughput benchmark, default is 1G", type = int, default = 1024 * 1024 * 1024 )
+    parser.add_argument( "--benchmark-streams", help = "the connections in throughput benchmark, default is 4", type = int, default = 4 )
+    parser.add_argument( "--benchmark-connections", help = "the connections opened in capacity benchmark, default is 5000", type = int, default = 5000 )
+    args = parser.parse_args()
+    if not args.benchmark and ( args.listen is None or args.proxy is None ):
+        parser.error( "--listen and --proxy are required" )
+    return args
 
 def parse_ip_address( addr ):
     pos = addr.rfind( ":" )
@@ -114,10 +639,18 @@ def init_logger( log_file ):
 def main():
     args = parse_args()
     init_logger( args.log_file )
+    if args.benchmark:
+        run_benchmark( args )
+        return
+    raise_file_limit()
     proxy_addr = parse_ip_address( args.proxy )
     listen_addr = parse_ip_address( args.listen )
     debug = Debug( args.debug, args.debug_format )
-    proxy = TcpProxy( proxy_addr[0], proxy_addr[1], debug = debug )
+    if args.engine == "thread":
+        proxy = TcpProxy( proxy_addr[0], proxy_addr[1], debug = debug, buffer_size = args.buffer_size, backlog = args.backlog )
+    else:
+        proxy = EventTcpProxy( proxy_addr[0], proxy_addr[1], debug = debug, buffer_size = args.buffer_size, backlog = args.backlog,
+                               idle_timeout = args.idle_timeout, splice = not args.no_splice, stats_interval = args.stats_interval )
     proxy.create_listener( listen_addr[0], listen_addr[1] )
 
 if __name__== "__main__":